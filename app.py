@@ -1,34 +1,334 @@
+import time
+
+# Startup profile: wall-clock cost of each boot phase, reported once the module
+# has finished loading so slow worker boots are visible in the app logs.
+_BOOT_STARTED = time.perf_counter()
+_startup_profile = {}
+
+import base64
+import bisect
+import csv
+import fcntl
+import fnmatch
+import functools
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import json
+import math
+import mmap
 import os
-from flask import Flask, render_template, request, jsonify, session
-from databricks.sdk import WorkspaceClient
-from databricks.sdk.core import Config
+import pickle
+import random
+import re
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import traceback
+import urllib.request
 import uuid
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+_startup_profile['import_stdlib_ms'] = round((time.perf_counter() - _BOOT_STARTED) * 1000, 1)
+
+_phase_started = time.perf_counter()
+from flask import (Flask, Response, g, has_request_context, render_template, request, jsonify, send_from_directory,
+                   session, stream_with_context)
+
+from flask.json.provider import DefaultJSONProvider, JSONProvider
+_startup_profile['import_flask_ms'] = round((time.perf_counter() - _phase_started) * 1000, 1)
+
+# orjson is optional: several times faster than the stdlib encoder when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "skyscanner-intelligence-hub-secret")
 
+
+def dumps_json_bytes(obj):
+    """Encode ``obj`` to compact UTF-8 JSON bytes, with orjson when it is available"""
+    if orjson is not None:
+        # Dates go through Flask's default hook so output matches the stdlib provider
+        return orjson.dumps(obj, default=DefaultJSONProvider.default,
+                            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(obj, default=DefaultJSONProvider.default, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson; ``jsonify`` writes the encoded bytes directly"""
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps_json_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps_json_bytes(obj) + b"\n", mimetype=self.mimetype)
+
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+
 # Disable caching for all responses
 @app.after_request
 def add_header(response):
+    # Pre-encoded cached bodies carry an ETag and are revalidated instead (see cached_json_response)
+    if response.headers.get('ETag'):
+        return response
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
     response.headers['Pragma'] = 'no-cache'
     response.headers['Expires'] = '-1'
     return response
 
-# Initialize Databricks Workspace Client
-# When running as Databricks App, uses provided service principal credentials
-# When running locally, uses the default profile from ~/.databrickscfg
-if os.environ.get("DATABRICKS_HOST") and os.environ.get("DATABRICKS_CLIENT_ID"):
-    # Running in Databricks Apps environment
-    config = Config(
-        host=os.environ.get("DATABRICKS_HOST"),
-        client_id=os.environ.get("DATABRICKS_CLIENT_ID"),
-        client_secret=os.environ.get("DATABRICKS_CLIENT_SECRET")
-    )
-    w = WorkspaceClient(config=config)
-else:
-    # Running locally - use default profile
-    w = WorkspaceClient()
+# Databricks Workspace Client
+# The SDK import and client construction (config + credential resolution) are
+# deferred until the first request that needs the workspace, so a worker can
+# boot and answer /health without touching the network.
+_workspace_client = None
+_workspace_client_lock = threading.Lock()
+
+# The SDK's own retry budget (its default of 300s would let a degraded
+# workspace hold a worker for the whole gunicorn timeout)
+SDK_RETRY_TIMEOUT = int(os.environ.get("SDK_RETRY_TIMEOUT", "30"))
+
+# HTTP connection pool shared by every thread in a worker. Requests wait for a
+# free connection (pool_block) instead of opening throwaway ones, so concurrent
+# fan-out reuses warm TLS connections, but for at most SDK_POOL_TIMEOUT seconds
+# (then the call fails with a transient TimeoutError). Serving calls, which run
+# for minutes, may hold only SDK_SERVING_MAX_CONNECTIONS of the connections, so
+# statement polls always find one. TCP keep-alive stops idle connections from
+# being silently dropped by load balancers between requests.
+#
+# The adapter is mounted on the SDK's internal requests session, a layout
+# checked against the databricks-sdk range pinned in requirements.txt. If it is
+# missing, creating the client fails loudly unless SDK_POOL_TUNING=false.
+SDK_POOL_TUNING = os.environ.get("SDK_POOL_TUNING", "true").lower() == "true"
+SDK_POOL_CONNECTIONS = int(os.environ.get("SDK_POOL_CONNECTIONS", "4"))
+SDK_POOL_MAXSIZE = int(os.environ.get("SDK_POOL_MAXSIZE", "16"))
+SDK_POOL_BLOCK = os.environ.get("SDK_POOL_BLOCK", "true").lower() == "true"
+SDK_POOL_TIMEOUT = float(os.environ.get("SDK_POOL_TIMEOUT", "10"))
+SDK_SERVING_MAX_CONNECTIONS = int(os.environ.get("SDK_SERVING_MAX_CONNECTIONS", str(SDK_POOL_MAXSIZE // 2)))
+SDK_TCP_KEEPALIVE_IDLE = int(os.environ.get("SDK_TCP_KEEPALIVE_IDLE", "30"))
+SDK_TCP_KEEPALIVE_INTERVAL = int(os.environ.get("SDK_TCP_KEEPALIVE_INTERVAL", "10"))
+
+# Serving endpoint calls run agents and get a longer read timeout
+SERVING_TIMEOUT = int(os.environ.get("SERVING_TIMEOUT", "120"))
+SDK_CONNECT_TIMEOUT = float(os.environ.get("SDK_CONNECT_TIMEOUT", "5"))
+
+# Call type -> (connect, read) timeout in seconds. Statement submission waits
+# inline for up to 50s server-side; polls and chunk fetches should be quick.
+SDK_TIMEOUTS = {
+    'submit': (SDK_CONNECT_TIMEOUT, float(os.environ.get("SDK_SUBMIT_TIMEOUT", "65"))),
+    'poll': (SDK_CONNECT_TIMEOUT, float(os.environ.get("SDK_POLL_TIMEOUT", "30"))),
+    'serving': (SDK_CONNECT_TIMEOUT, float(SERVING_TIMEOUT)),
+    'other': (SDK_CONNECT_TIMEOUT, float(os.environ.get("SDK_HTTP_TIMEOUT", "60")))
+}
+
+_sdk_adapter = None
+_sdk_pool_stats = {'in_flight': 0, 'peak_in_flight': 0, 'pool_timeouts': 0,
+                   'requests': {call_type: 0 for call_type in SDK_TIMEOUTS}}
+_sdk_pool_stats_lock = threading.Lock()
+
+# Connections a request may hold; with pool_block, waits are bounded by SDK_POOL_TIMEOUT
+_sdk_pool_slots = threading.BoundedSemaphore(SDK_POOL_MAXSIZE)
+_sdk_serving_slots = threading.BoundedSemaphore(max(1, SDK_SERVING_MAX_CONNECTIONS))
+
+
+class SDKPoolTimeout(TimeoutError):
+    """Raised when no SDK HTTP connection frees up within SDK_POOL_TIMEOUT"""
+
+
+def _sdk_call_type(method, path):
+    if '/serving-endpoints/' in path:
+        return 'serving'
+    if '/sql/statements' in path:
+        if method == 'POST' and not path.rstrip('/').endswith('/cancel'):
+            return 'submit'
+        if method == 'GET':
+            return 'poll'
+    return 'other'
+
+
+def _mount_sdk_adapter(client):
+    """Replace the SDK session's HTTP adapter with the tuned, instrumented one"""
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection
+
+    socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        socket_options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, SDK_TCP_KEEPALIVE_IDLE),
+                           (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, SDK_TCP_KEEPALIVE_INTERVAL)]
+
+    class PooledAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            kwargs['socket_options'] = socket_options
+            super().init_poolmanager(*args, **kwargs)
+
+        def send(self, request, **kwargs):
+            call_type = _sdk_call_type(request.method, request.path_url)
+            kwargs['timeout'] = SDK_TIMEOUTS[call_type]
+            # requests never passes urllib3 a pool timeout, so a blocking pool would wait forever
+            slots = [_sdk_serving_slots] if call_type == 'serving' else []
+            if SDK_POOL_BLOCK:
+                slots.append(_sdk_pool_slots)
+            deadline = time.monotonic() + SDK_POOL_TIMEOUT
+            acquired = []
+            try:
+                for slot in slots:
+                    if not slot.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                        with _sdk_pool_stats_lock:
+                            _sdk_pool_stats['pool_timeouts'] += 1
+                        raise SDKPoolTimeout(f"No SDK HTTP connection free within {SDK_POOL_TIMEOUT:.0f}s "
+                                             f"({call_type} call)")
+                    acquired.append(slot)
+
+                with _sdk_pool_stats_lock:
+                    _sdk_pool_stats['requests'][call_type] += 1
+                    _sdk_pool_stats['in_flight'] += 1
+                    _sdk_pool_stats['peak_in_flight'] = max(_sdk_pool_stats['peak_in_flight'],
+                                                            _sdk_pool_stats['in_flight'])
+                try:
+                    return super().send(request, **kwargs)
+                finally:
+                    with _sdk_pool_stats_lock:
+                        _sdk_pool_stats['in_flight'] -= 1
+            finally:
+                for slot in acquired:
+                    slot.release()
+
+    # The requests session lives on the SDK's internal base client (attribute names vary by version)
+    import requests
+
+    api_client = client.api_client
+    session = getattr(getattr(api_client, '_api_client', api_client), '_session', None)
+    if not isinstance(session, requests.Session):
+        raise RuntimeError(
+            "Cannot find the databricks-sdk HTTP session to tune its connection pool; this SDK version's "
+            "internals differ from the pinned range in requirements.txt. Pin databricks-sdk back, or set "
+            "SDK_POOL_TUNING=false to use the SDK's default pool."
+        )
+
+    adapter = PooledAdapter(pool_connections=SDK_POOL_CONNECTIONS, pool_maxsize=SDK_POOL_MAXSIZE,
+                            pool_block=SDK_POOL_BLOCK)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not isinstance(session.get_adapter(client.config.host or 'https://'), PooledAdapter):
+        raise RuntimeError("The tuned HTTP adapter did not take effect on the databricks-sdk session; "
+                           "set SDK_POOL_TUNING=false to use the SDK's default pool")
+    return adapter
+
+
+def get_sdk_pool_stats():
+    """Return this worker's SDK connection pool configuration and utilisation"""
+    with _sdk_pool_stats_lock:
+        stats = {
+            'tuned': _sdk_adapter is not None,
+            'pool_maxsize': SDK_POOL_MAXSIZE,
+            'pool_block': SDK_POOL_BLOCK,
+            'pool_timeout': SDK_POOL_TIMEOUT,
+            'serving_max_connections': SDK_SERVING_MAX_CONNECTIONS,
+            'pool_timeouts': _sdk_pool_stats['pool_timeouts'],
+            'in_flight': _sdk_pool_stats['in_flight'],
+            'peak_in_flight': _sdk_pool_stats['peak_in_flight'],
+            'utilisation': round(_sdk_pool_stats['in_flight'] / SDK_POOL_MAXSIZE, 2),
+            'requests': dict(_sdk_pool_stats['requests']),
+            'pools': []
+        }
+
+    adapter = _sdk_adapter
+    if adapter is None:
+        return stats
+    # urllib3 pool internals: best effort, they are only diagnostics
+    try:
+        for key in list(adapter.poolmanager.pools.keys()):
+            try:
+                pool = adapter.poolmanager.pools[key]
+            except KeyError:
+                continue
+            # Opened connections vs. requests sent shows how often a warm connection was reused
+            stats['pools'].append({
+                'host': pool.host,
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+                'reuse_rate': round(1 - pool.num_connections / pool.num_requests, 2) if pool.num_requests else None
+            })
+    except AttributeError as e:
+        stats['pools'] = None
+        stats['pools_error'] = f"urllib3 pool internals unavailable: {str(e)}"
+    return stats
+
+
+def _create_workspace_client():
+    """Construct a WorkspaceClient with the app's credentials and the shared, tuned connection pool"""
+    global _sdk_adapter
+    from databricks.sdk import WorkspaceClient
+    from databricks.sdk.core import Config
+
+    if os.environ.get("DATABRICKS_HOST") and os.environ.get("DATABRICKS_CLIENT_ID"):
+        # Running in Databricks Apps environment
+        config = Config(
+            host=os.environ.get("DATABRICKS_HOST"),
+            client_id=os.environ.get("DATABRICKS_CLIENT_ID"),
+            client_secret=os.environ.get("DATABRICKS_CLIENT_SECRET"),
+            http_timeout_seconds=SDK_TIMEOUTS['other'][1],
+            retry_timeout_seconds=SDK_RETRY_TIMEOUT
+        )
+    else:
+        # Running locally - use default profile
+        config = Config(http_timeout_seconds=SDK_TIMEOUTS['other'][1], retry_timeout_seconds=SDK_RETRY_TIMEOUT)
+    client = WorkspaceClient(config=config)
+    if SDK_POOL_TUNING:
+        _sdk_adapter = _mount_sdk_adapter(client)
+    return client
+
+
+def get_workspace_client():
+    """Return the shared WorkspaceClient, creating it on first use.
+
+    When running as Databricks App, uses provided service principal credentials.
+    When running locally, uses the default profile from ~/.databrickscfg.
+    """
+    global _workspace_client
+
+    client = _workspace_client
+    if client is not None:
+        return client
+
+    with _workspace_client_lock:
+        if _workspace_client is None:
+            phase_started = time.perf_counter()
+            import databricks.sdk  # noqa: F401
+            _startup_profile['import_databricks_sdk_ms'] = round((time.perf_counter() - phase_started) * 1000, 1)
+
+            phase_started = time.perf_counter()
+            _workspace_client = _create_workspace_client()
+            _startup_profile['workspace_client_init_ms'] = round((time.perf_counter() - phase_started) * 1000, 1)
+            print(f"DEBUG: Workspace client initialised (sdk import {_startup_profile['import_databricks_sdk_ms']}ms, "
+                  f"init {_startup_profile['workspace_client_init_ms']}ms)")
+
+        return _workspace_client
+
+
+# Application version, reported by /health and used to version client-side caches
+APP_VERSION = os.environ.get("APP_VERSION", "1.0.0")
 
 # Multi-agent supervisor endpoint name
 ENDPOINT_NAME = os.environ.get("DATABRICKS_SERVING_ENDPOINT", "mas-0359371c-endpoint")
@@ -38,6 +338,1902 @@ CATALOG = os.environ.get("CATALOG", "users")
 SCHEMA = os.environ.get("SCHEMA", "sultan_alawar")
 
 
+# Synced Unity Catalog tables behind the dashboards, keyed by dashboard name
+SYNCED_TABLES = {
+    'flights': 'synced_flights',
+    'hotels': 'synced_hotels',
+    'packages': 'synced_packages',
+    'reviews': 'synced_reviews'
+}
+
+# How often (seconds) the table version probe may hit the warehouse
+TABLE_VERSION_PROBE_INTERVAL = int(os.environ.get("TABLE_VERSION_PROBE_INTERVAL", "30"))
+
+# Fallback expiry (seconds) for stats caches when table versions are unavailable
+STATS_CACHE_TTL = int(os.environ.get("STATS_CACHE_TTL", "600"))
+
+# Local directory shared by all workers for on-disk indexes and snapshots
+HUB_DATA_DIR = os.environ.get("HUB_DATA_DIR", "/tmp/intelligence_hub")
+
+
+# ============================================================================
+# Circuit Breakers
+# ============================================================================
+# Calls to the SQL warehouse APIs and to the serving endpoint go through a
+# per-process circuit breaker. A breaker opens when, over its last
+# BREAKER_WINDOW calls, the error rate or the slow-call rate crosses its
+# threshold. While open, calls fail in microseconds with CircuitOpenError
+# instead of tying up a worker. After BREAKER_OPEN_SECONDS one probe call is
+# let through (half-open): success closes the breaker, failure re-opens it.
+# Idempotent reads are also retried with exponential backoff and full jitter.
+
+BREAKER_WINDOW = int(os.environ.get("BREAKER_WINDOW", "20"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "5"))
+BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_CALL_RATE = float(os.environ.get("BREAKER_SLOW_CALL_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))
+WAREHOUSE_SLOW_CALL_SECONDS = float(os.environ.get("WAREHOUSE_SLOW_CALL_SECONDS", "10"))
+SERVING_SLOW_CALL_SECONDS = float(os.environ.get("SERVING_SLOW_CALL_SECONDS", "60"))
+
+RETRY_ATTEMPTS = int(os.environ.get("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = 0.2
+RETRY_MAX_DELAY = 2.0
+
+# SDK errors that mean the service (not the request) is at fault
+_TRANSIENT_ERRORS = frozenset({
+    'TemporarilyUnavailable', 'DeadlineExceeded', 'ResourceExhausted', 'TooManyRequests',
+    'InternalError', 'Aborted', 'Unknown', 'DataLoss'
+})
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling a dependency while its circuit breaker is open"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable (circuit open, retry in {retry_after:.0f}s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def _is_transient(error):
+    return isinstance(error, (OSError, TimeoutError)) or type(error).__name__ in _TRANSIENT_ERRORS
+
+
+class CircuitBreaker:
+    """Error-rate and slow-call-rate circuit breaker with half-open probing"""
+
+    def __init__(self, name, slow_call_seconds):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.outcomes = deque(maxlen=BREAKER_WINDOW)
+        self.probe_in_flight = False
+        self.counts = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0, 'opened': 0}
+        self.lock = threading.Lock()
+
+    def _open(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.counts['opened'] += 1
+        print(f"ERROR: Circuit breaker {self.name} opened")
+
+    def _before_call(self):
+        with self.lock:
+            if self.state == 'open':
+                remaining = BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    self.counts['rejected'] += 1
+                    raise CircuitOpenError(self.name, remaining)
+                self.state = 'half_open'
+            if self.state == 'half_open':
+                if self.probe_in_flight:
+                    self.counts['rejected'] += 1
+                    raise CircuitOpenError(self.name, 1)
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def _record(self, probe, failed, slow):
+        with self.lock:
+            self.counts['calls'] += 1
+            self.counts['failures'] += failed
+            self.counts['slow_calls'] += slow
+            if probe:
+                self.probe_in_flight = False
+                if failed or slow:
+                    self._open()
+                else:
+                    self.state = 'closed'
+                    self.outcomes.clear()
+                    print(f"DEBUG: Circuit breaker {self.name} closed")
+                return
+
+            self.outcomes.append((failed, slow))
+            if self.state == 'closed' and len(self.outcomes) >= BREAKER_MIN_CALLS:
+                failure_rate = sum(f for f, _ in self.outcomes) / len(self.outcomes)
+                slow_rate = sum(s for _, s in self.outcomes) / len(self.outcomes)
+                if failure_rate >= BREAKER_FAILURE_RATE or slow_rate >= BREAKER_SLOW_CALL_RATE:
+                    self._open()
+
+    def call(self, fn, slow_after=None):
+        """Run ``fn()`` through the breaker; calls slower than ``slow_after`` seconds count as slow"""
+        probe = self._before_call()
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception as e:
+            # Client errors (bad SQL, missing objects) say nothing about the dependency's health
+            self._record(probe, _is_transient(e), False)
+            raise
+        except BaseException:
+            if probe:
+                with self.lock:
+                    self.probe_in_flight = False
+            raise
+        self._record(probe, False, time.monotonic() - started > (slow_after or self.slow_call_seconds))
+        return result
+
+    def stats(self):
+        with self.lock:
+            outcomes = list(self.outcomes)
+            return {
+                'state': self.state,
+                'open_for_s': round(max(0.0, BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at)), 1)
+                if self.state == 'open' else 0,
+                'window_failure_rate': round(sum(f for f, _ in outcomes) / len(outcomes), 2) if outcomes else 0,
+                'window_slow_rate': round(sum(s for _, s in outcomes) / len(outcomes), 2) if outcomes else 0,
+                **self.counts
+            }
+
+
+warehouse_breaker = CircuitBreaker('SQL warehouse', WAREHOUSE_SLOW_CALL_SECONDS)
+serving_breaker = CircuitBreaker('Serving endpoint', SERVING_SLOW_CALL_SECONDS)
+
+
+def get_breaker_stats():
+    """Return the state and counters of every circuit breaker in this worker"""
+    return {breaker.name: breaker.stats() for breaker in (warehouse_breaker, serving_breaker)}
+
+
+def retry_idempotent(fn, breaker, slow_after=None):
+    """Call an idempotent read through ``breaker``, retrying transient errors with jittered backoff"""
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return breaker.call(fn, slow_after=slow_after)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not _is_transient(e):
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            print(f"DEBUG: Retrying {breaker.name} read in {delay:.2f}s after {type(e).__name__}: {str(e)}")
+            time.sleep(delay)
+
+
+# ============================================================================
+# Warehouse Admission Control
+# ============================================================================
+# Every statement takes a slot from its warehouse's scheduler before it is
+# submitted and holds it until the statement finishes. Waiting statements are
+# admitted strictly by priority class, then FIFO. A statement that cannot get a
+# slot within its class's queue timeout fails fast with WarehouseQueueTimeout
+# instead of piling up behind a large scan. WAREHOUSE_MAX_CONCURRENCY is a
+# host-wide cap: on top of the worker's own queue, a statement holds one of the
+# warehouse's file-lock slots under HUB_DATA_DIR, shared by all gunicorn workers
+# (a crashed worker's slots are released by the OS). Queue heads poll for a free
+# slot, interactive ones more often, so they win contended slots across workers.
+
+WAREHOUSE_MAX_CONCURRENCY = int(os.environ.get("WAREHOUSE_MAX_CONCURRENCY", "4"))
+
+# Priority class -> seconds between a queue head's attempts at a host-wide slot
+WAREHOUSE_SLOT_POLL_INTERVAL = {'interactive': 0.05, 'background': 0.25, 'export': 0.25}
+
+# Priority class -> (rank, max seconds to wait for a slot); lower rank wins
+STATEMENT_PRIORITIES = {
+    'interactive': (0, float(os.environ.get("WAREHOUSE_QUEUE_TIMEOUT_INTERACTIVE", "15"))),
+    'background': (1, float(os.environ.get("WAREHOUSE_QUEUE_TIMEOUT_BACKGROUND", "120"))),
+    'export': (2, float(os.environ.get("WAREHOUSE_QUEUE_TIMEOUT_EXPORT", "60")))
+}
+
+
+class HandledError(Exception):
+    """Base class for errors answered by their own errorhandler (warehouse, rate limit, abandoned request).
+
+    Route and helper catch-alls re-raise it instead of turning it into a 500 or
+    a fallback.
+    """
+
+
+class WarehouseUnavailable(HandledError):
+    """Base class for errors meaning the warehouse cannot take a statement right now"""
+
+
+class WarehouseQueueTimeout(WarehouseUnavailable):
+    """Raised when a statement waits longer than its queue timeout for a warehouse slot"""
+
+
+class WarehouseStarting(WarehouseUnavailable):
+    """Raised while the SQL warehouse is being started; the request should be retried"""
+
+
+# warehouse_id -> scheduler state
+_warehouse_schedulers = {}
+_warehouse_schedulers_lock = threading.Lock()
+
+
+def _get_scheduler(warehouse_id):
+    with _warehouse_schedulers_lock:
+        scheduler = _warehouse_schedulers.get(warehouse_id)
+        if scheduler is None:
+            scheduler = {
+                'condition': threading.Condition(),
+                'running': 0,
+                'waiting': [],  # heap of (rank, sequence)
+                'sequence': 0,
+                'admitted': {name: 0 for name in STATEMENT_PRIORITIES},
+                'rejected': {name: 0 for name in STATEMENT_PRIORITIES},
+                'wait_times': {name: deque(maxlen=500) for name in STATEMENT_PRIORITIES}
+            }
+            _warehouse_schedulers[warehouse_id] = scheduler
+        return scheduler
+
+
+def caller_priority():
+    """'interactive' for statements a request is waiting on, 'background' for refresh threads"""
+    if getattr(_background_thread, 'active', False) or not has_request_context():
+        return 'background'
+    return 'interactive'
+
+
+def _try_host_slot(warehouse_id):
+    """Take a free host-wide slot of the warehouse (an open, locked file), or return None"""
+    slot_dir = os.path.join(HUB_DATA_DIR, 'warehouse_slots')
+    os.makedirs(slot_dir, exist_ok=True)
+    for slot in range(WAREHOUSE_MAX_CONCURRENCY):
+        slot_file = open(os.path.join(slot_dir, f'{warehouse_id}-{slot}.lock'), 'w')
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot_file
+        except BlockingIOError:
+            slot_file.close()
+    return None
+
+
+@contextmanager
+def warehouse_slot(warehouse_id, priority):
+    """Hold one of the warehouse's host-wide concurrency slots for the duration of the block"""
+    rank, queue_timeout = STATEMENT_PRIORITIES[priority]
+    scheduler = _get_scheduler(warehouse_id)
+    condition = scheduler['condition']
+    queued_at = time.monotonic()
+
+    with condition:
+        scheduler['sequence'] += 1
+        ticket = (rank, scheduler['sequence'])
+        heapq.heappush(scheduler['waiting'], ticket)
+
+        slot_file = None
+        while True:
+            wait = None
+            if scheduler['waiting'][0] == ticket and scheduler['running'] < WAREHOUSE_MAX_CONCURRENCY:
+                slot_file = _try_host_slot(warehouse_id)
+                if slot_file is not None:
+                    break
+                # Other workers hold every slot; they do not notify this condition, so poll
+                wait = WAREHOUSE_SLOT_POLL_INTERVAL[priority]
+            remaining = queue_timeout - (time.monotonic() - queued_at)
+            if remaining <= 0:
+                scheduler['waiting'].remove(ticket)
+                heapq.heapify(scheduler['waiting'])
+                scheduler['rejected'][priority] += 1
+                condition.notify_all()
+                raise WarehouseQueueTimeout(
+                    f"SQL warehouse is busy: waited {queue_timeout:.0f}s for a slot "
+                    f"({len(scheduler['waiting'])} statements queued, {scheduler['running']} running here)"
+                )
+            condition.wait(remaining if wait is None else min(remaining, wait))
+
+        heapq.heappop(scheduler['waiting'])
+        scheduler['running'] += 1
+        scheduler['admitted'][priority] += 1
+        scheduler['wait_times'][priority].append(time.monotonic() - queued_at)
+        # The next ticket may also fit under the cap
+        condition.notify_all()
+
+    try:
+        yield
+    finally:
+        slot_file.close()
+        with condition:
+            scheduler['running'] -= 1
+            condition.notify_all()
+
+
+def get_scheduler_stats():
+    """Queue depth, running statements and wait times per warehouse and priority class"""
+    stats = {}
+    for warehouse_id, scheduler in list(_warehouse_schedulers.items()):
+        with scheduler['condition']:
+            rank_names = {rank: name for name, (rank, _) in STATEMENT_PRIORITIES.items()}
+            queued = {name: 0 for name in STATEMENT_PRIORITIES}
+            for rank, _ in scheduler['waiting']:
+                queued[rank_names[rank]] += 1
+
+            wait_times = {}
+            for name, samples in scheduler['wait_times'].items():
+                ordered = sorted(samples)
+                wait_times[name] = {
+                    'avg_ms': round(sum(ordered) / len(ordered) * 1000, 1) if ordered else 0,
+                    'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1) if ordered else 0
+                }
+
+            stats[warehouse_id] = {
+                'max_concurrency': WAREHOUSE_MAX_CONCURRENCY,
+                'max_concurrency_scope': 'host',
+                'running': scheduler['running'],
+                'queue_depth': len(scheduler['waiting']),
+                'queued_by_priority': queued,
+                'admitted': dict(scheduler['admitted']),
+                'rejected': dict(scheduler['rejected']),
+                'wait_times': wait_times
+            }
+    return stats
+
+
+# ============================================================================
+# Request Deadlines
+# ============================================================================
+# Statements run on behalf of a request are tied to it. Every request gets a
+# deadline (REQUEST_DEADLINE seconds after it started, or a statement's own
+# priority timeout if that is longer, e.g. for exports), the IDs of its running
+# statements are kept on flask.g, and _run_statement checks between polls
+# whether the deadline has passed or the client has disconnected (its socket
+# reads EOF). Either way the statement is cancelled at once, which frees its
+# warehouse slot and the worker thread. Any statement still running when the
+# request ends is cancelled on teardown. A coalesced call that other requests
+# are waiting on is not cancelled when its leader's client disconnects.
+# Background threads and async jobs are not tied to a request.
+
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "120"))
+
+# Inline wait for statements run by a request, so a disconnect is noticed at the next poll (API minimum: 5s)
+REQUEST_INLINE_WAIT = '10s'
+
+# The coalesced call (see coalesce) this thread is computing, if any
+_coalescing = threading.local()
+
+
+class RequestAbandoned(HandledError):
+    """Raised (after cancelling its statements) when a request's client disconnected or its deadline passed"""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+@app.before_request
+def start_request_deadline():
+    g.request_started = time.monotonic()
+    g.statement_ids = set()
+
+
+def _client_disconnected():
+    """True if the client has closed its connection (EOF pending on the socket)"""
+    sock = request.environ.get('gunicorn.socket')
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+
+
+def request_deadline(priority=None):
+    """Monotonic deadline of the current request (None outside one).
+
+    It never falls before the STATEMENT_TIMEOUTS entry of ``priority``, so
+    exports and background-priority statements keep their own, longer budget.
+    """
+    if not has_request_context() or 'request_started' not in g:
+        return None
+    budget = max(REQUEST_DEADLINE, STATEMENT_TIMEOUTS.get(priority, 0)) if priority else REQUEST_DEADLINE
+    return g.request_started + budget
+
+
+def request_abandoned(priority=None):
+    """Return why the current request should stop ('deadline' or 'disconnect'), or None"""
+    deadline = request_deadline(priority)
+    if deadline is None:
+        return None
+    if time.monotonic() > deadline:
+        return 'deadline'
+    call = getattr(_coalescing, 'call', None)
+    if call is not None and call['waiters']:
+        return None
+    if _client_disconnected():
+        return 'disconnect'
+    return None
+
+
+def _abandoned_error(reason):
+    if reason == 'deadline':
+        return RequestAbandoned(f"{request.path} passed its deadline", reason)
+    return RequestAbandoned(f"Client disconnected from {request.path}", reason)
+
+
+def track_statement(statement_id):
+    """Record a running statement against the current request, so it is cancelled if the request ends early"""
+    if has_request_context() and 'statement_ids' in g:
+        g.statement_ids.add(statement_id)
+
+
+def untrack_statement(statement_id):
+    if has_request_context() and 'statement_ids' in g:
+        g.statement_ids.discard(statement_id)
+
+
+def cancel_statement(statement_id):
+    """Cancel a running statement (best effort) and stop tracking it"""
+    untrack_statement(statement_id)
+    try:
+        warehouse_breaker.call(lambda: get_workspace_client().statement_execution.cancel_execution(statement_id))
+        print(f"DEBUG: Cancelled statement {statement_id}")
+    except Exception as e:
+        print(f"ERROR: Failed to cancel statement {statement_id}: {str(e)}")
+
+
+@app.teardown_request
+def cancel_request_statements(error=None):
+    """Cancel statements a request left running (it raised, or stopped reading their results)"""
+    for statement_id in list(g.get('statement_ids', ())):
+        cancel_statement(statement_id)
+
+
+@app.errorhandler(RequestAbandoned)
+def request_abandoned_response(e):
+    """504 once the deadline has passed; nobody reads the response after a disconnect"""
+    print(f"DEBUG: {str(e)}")
+    if e.reason == 'deadline':
+        return jsonify({'error': str(e)}), 504
+    return Response(status=499)
+
+
+# ============================================================================
+# Warehouse Helpers
+# ============================================================================
+
+# How long (seconds) a RUNNING warehouse state is trusted before it is re-checked
+WAREHOUSE_STATE_TTL = int(os.environ.get("WAREHOUSE_STATE_TTL", "30"))
+
+# Seconds the browser is told to wait between status polls while the warehouse starts
+WAREHOUSE_START_POLL_INTERVAL = 5
+
+# Last observed warehouse state and the pending start request, shared by all requests in this worker
+_warehouse_status = {'warehouse_id': None, 'state': None, 'checked_at': 0, 'start_requested_at': None, 'error': None}
+_warehouse_status_lock = threading.Lock()
+
+
+def get_warehouse_status(refresh=False, start_if_stopped=True):
+    """Return the configured warehouse's state, starting it (once) if it is stopped"""
+    warehouse_id = os.environ.get("DATABRICKS_WAREHOUSE_ID")
+    if not warehouse_id:
+        return dict(_warehouse_status)
+
+    now = time.time()
+    ttl = WAREHOUSE_STATE_TTL if _warehouse_status['state'] == 'RUNNING' else WAREHOUSE_START_POLL_INTERVAL
+    if not refresh and _warehouse_status['warehouse_id'] == warehouse_id and now - _warehouse_status['checked_at'] < ttl:
+        return dict(_warehouse_status)
+
+    with _warehouse_status_lock:
+        if not refresh and _warehouse_status['warehouse_id'] == warehouse_id and \
+                time.time() - _warehouse_status['checked_at'] < ttl:
+            return dict(_warehouse_status)
+
+        w = get_workspace_client()
+        state = retry_idempotent(lambda: w.warehouses.get(warehouse_id), warehouse_breaker).state.value
+        _warehouse_status.update(warehouse_id=warehouse_id, state=state, checked_at=time.time(), error=None)
+
+        if state == 'RUNNING':
+            _warehouse_status['start_requested_at'] = None
+        elif state in ('STOPPED', 'STOPPING') and start_if_stopped and not _warehouse_status['start_requested_at']:
+            # Fire-and-forget: start() returns a waiter we deliberately do not block on.
+            # Other workers see STARTING on their next check and do not issue another start.
+            try:
+                warehouse_breaker.call(lambda: w.warehouses.start(warehouse_id))
+                _warehouse_status['start_requested_at'] = time.time()
+                print(f"DEBUG: Requested start of SQL warehouse {warehouse_id} (was {state})")
+            except Exception as e:
+                _warehouse_status['error'] = str(e)
+                print(f"ERROR: Failed to start SQL warehouse {warehouse_id}: {str(e)}")
+        elif state == 'STARTING' and not _warehouse_status['start_requested_at']:
+            _warehouse_status['start_requested_at'] = time.time()
+
+        return dict(_warehouse_status)
+
+
+def _get_warehouse_id(start_if_stopped=True):
+    """Return the configured warehouse ID (raising WarehouseStarting until it is RUNNING),
+    or the first RUNNING warehouse.
+
+    Background refresh threads never start a stopped warehouse; only user
+    requests that actually need fresh data do.
+    """
+    warehouse_id = os.environ.get("DATABRICKS_WAREHOUSE_ID")
+    if warehouse_id:
+        start_if_stopped = start_if_stopped and not getattr(_background_thread, 'active', False)
+        status = get_warehouse_status(start_if_stopped=start_if_stopped)
+        if status['state'] != 'RUNNING':
+            action = "start requested" if status['start_requested_at'] else "not starting it"
+            raise WarehouseStarting(f"SQL warehouse {warehouse_id} is {status['state']}; {action}")
+        return warehouse_id
+
+    for wh in retry_idempotent(lambda: list(get_workspace_client().warehouses.list()), warehouse_breaker):
+        if wh.state.value == 'RUNNING':
+            return wh.id
+
+    raise Exception("No running SQL warehouse found")
+
+
+# Priority class -> max seconds a statement may run before it is cancelled
+STATEMENT_TIMEOUTS = {
+    'interactive': float(os.environ.get("STATEMENT_TIMEOUT_INTERACTIVE", "60")),
+    'background': float(os.environ.get("STATEMENT_TIMEOUT_BACKGROUND", "240")),
+    'export': float(os.environ.get("STATEMENT_TIMEOUT_EXPORT", "240"))
+}
+
+
+class StatementFailed(Exception):
+    """Raised when a statement reaches a terminal state other than SUCCEEDED"""
+
+
+class StatementTimeout(Exception):
+    """Raised (after cancelling it) when a statement outlives its priority's timeout"""
+
+
+def _run_statement(statement, wait_timeout='30s', parameters=None, disposition=None, result_format=None,
+                   priority='background', start_warehouse=True):
+    """Submit a SQL statement and wait until it succeeds.
+
+    Runs inside a warehouse slot of the given priority class ('interactive',
+    'background' or 'export'). Waits inline for up to ``wait_timeout``, then
+    polls until the statement reaches a terminal state; a statement still
+    running after its priority's STATEMENT_TIMEOUTS entry is cancelled and
+    raises StatementTimeout. Within a request, the statement is also cancelled
+    (raising RequestAbandoned) once the request's deadline passes or its client
+    disconnects; see Request Deadlines. With
+    ``start_warehouse=False`` a stopped warehouse is left stopped. ``parameters`` is a list of
+    ``{'name', 'value', 'type'}`` dicts bound to ``:name`` markers;
+    ``disposition``/``result_format`` take the API names (e.g.
+    ``'EXTERNAL_LINKS'``, ``'ARROW_STREAM'``). Returns the final StatementResponse.
+    """
+    from databricks.sdk.service.sql import Disposition, Format, StatementParameterListItem
+
+    abandoned = request_abandoned(priority)
+    if abandoned:
+        raise _abandoned_error(abandoned)
+    if has_request_context():
+        wait_timeout = min(wait_timeout, REQUEST_INLINE_WAIT, key=lambda timeout: int(timeout.rstrip('s')))
+
+    w = get_workspace_client()
+    warehouse_id = _get_warehouse_id(start_if_stopped=start_warehouse)
+    deadline = time.monotonic() + STATEMENT_TIMEOUTS.get(priority, STATEMENT_TIMEOUTS['background'])
+    with warehouse_slot(warehouse_id, priority):
+        # Submitting is not idempotent, so it goes through the breaker without retries.
+        # Waiting inline up to wait_timeout is expected, not slow.
+        response = warehouse_breaker.call(
+            lambda: w.statement_execution.execute_statement(
+                warehouse_id=warehouse_id,
+                catalog=CATALOG,
+                schema=SCHEMA,
+                statement=statement,
+                wait_timeout=wait_timeout,
+                parameters=[StatementParameterListItem(**param) for param in parameters] if parameters else None,
+                disposition=Disposition(disposition) if disposition else None,
+                format=Format(result_format) if result_format else None
+            ),
+            slow_after=int(wait_timeout.rstrip('s')) + WAREHOUSE_SLOW_CALL_SECONDS
+        )
+
+        state = response.status.state.value if response.status and response.status.state else None
+        statement_id = response.statement_id
+        if state in ('PENDING', 'RUNNING'):
+            track_statement(statement_id)
+        while state in ('PENDING', 'RUNNING'):
+            if time.monotonic() > deadline:
+                cancel_statement(statement_id)
+                raise StatementTimeout(f"Statement {statement_id} exceeded the {priority} timeout and was cancelled")
+            abandoned = request_abandoned(priority)
+            if abandoned:
+                cancel_statement(statement_id)
+                raise _abandoned_error(abandoned)
+            time.sleep(0.5)
+            response = retry_idempotent(lambda: w.statement_execution.get_statement(statement_id), warehouse_breaker)
+            state = response.status.state.value if response.status and response.status.state else None
+        untrack_statement(statement_id)
+
+    if state != 'SUCCEEDED':
+        error = response.status.error if response.status else None
+        message = error.message if error and error.message else state
+        raise StatementFailed(f"Statement {response.statement_id} did not succeed: {message}")
+
+    return response
+
+
+def _submit_statement(statement, parameters=None, priority='interactive', row_limit=None):
+    """Submit a SQL statement without waiting for it to run; returns the statement ID.
+
+    The warehouse slot is held only for the submission call itself, so the
+    caller never blocks on execution. Poll with ``get_statement``.
+    """
+    from databricks.sdk.service.sql import StatementParameterListItem
+
+    w = get_workspace_client()
+    warehouse_id = _get_warehouse_id()
+    with warehouse_slot(warehouse_id, priority):
+        response = warehouse_breaker.call(
+            lambda: w.statement_execution.execute_statement(
+                warehouse_id=warehouse_id,
+                catalog=CATALOG,
+                schema=SCHEMA,
+                statement=statement,
+                wait_timeout='0s',
+                parameters=[StatementParameterListItem(**param) for param in parameters] if parameters else None,
+                row_limit=row_limit
+            )
+        )
+    return response.statement_id
+
+
+def _iter_result_chunks(response):
+    """Yield the ResultData of every chunk of a succeeded statement, in order"""
+    if not response.result:
+        return
+
+    w = get_workspace_client()
+    chunk = response.result
+    yield chunk
+    while chunk.next_chunk_index is not None:
+        chunk_index = chunk.next_chunk_index
+        chunk = retry_idempotent(
+            lambda: w.statement_execution.get_statement_result_chunk_n(
+                statement_id=response.statement_id,
+                chunk_index=chunk_index
+            ),
+            warehouse_breaker
+        )
+        yield chunk
+
+
+def _execute_query(statement, wait_timeout='30s', parameters=None, priority='background', start_warehouse=True):
+    """Run a SQL statement on the warehouse, or the local engine when it can answer, and return all result rows"""
+    rows = local_engine_query(statement, parameters)
+    if rows is not None:
+        return rows
+
+    response = _run_statement(statement, wait_timeout=wait_timeout, parameters=parameters, priority=priority,
+                              start_warehouse=start_warehouse)
+
+    rows = []
+    for chunk in _iter_result_chunks(response):
+        rows.extend(chunk.data_array or [])
+    return rows
+
+
+# ============================================================================
+# Table Version Probe
+# ============================================================================
+# A single information_schema lookup returns the last commit timestamp of every
+# synced table. Stats caches are keyed by that version, so unchanged tables are
+# never recomputed and a landed sync is picked up within one probe interval.
+
+_table_versions = {}
+_table_versions_time = None
+_table_versions_lock = threading.Lock()
+
+
+def get_table_versions():
+    """Return {dashboard: version} for the synced tables, probing at most once per interval.
+
+    Returns an empty dict when the probe fails, in which case callers fall back
+    to time-based expiry.
+    """
+    global _table_versions, _table_versions_time
+
+    if LOCAL_ENGINE_OFFLINE and local_engine_enabled():
+        return local_engine_versions()
+
+    now = time.time()
+    if _table_versions_time and now - _table_versions_time < TABLE_VERSION_PROBE_INTERVAL:
+        return _table_versions
+
+    # One probe per interval; concurrent callers reuse the previous answer
+    if not _table_versions_lock.acquire(blocking=False):
+        return _table_versions
+
+    try:
+        table_names = ", ".join(f"'{name}'" for name in SYNCED_TABLES.values())
+        rows = _execute_query(f"""
+            SELECT table_name, CAST(last_altered AS STRING) as last_altered
+            FROM {CATALOG}.information_schema.tables
+            WHERE table_schema = '{SCHEMA}' AND table_name IN ({table_names})
+        """, wait_timeout='10s', priority='interactive', start_warehouse=False)
+
+        versions_by_table = {row[0]: row[1] for row in rows}
+        _table_versions = {
+            dashboard: versions_by_table.get(table_name)
+            for dashboard, table_name in SYNCED_TABLES.items()
+            if versions_by_table.get(table_name)
+        }
+        print(f"DEBUG: Table versions probed: {_table_versions}")
+    except RequestAbandoned:
+        raise
+    except Exception as e:
+        print(f"ERROR: Table version probe failed: {str(e)}")
+        _table_versions = {}
+    finally:
+        _table_versions_time = time.time()
+        _table_versions_lock.release()
+
+    return _table_versions
+
+
+# ============================================================================
+# Local Engine
+# ============================================================================
+# Optional in-process analytics engine (LOCAL_ENGINE=duckdb). A background sync
+# exports each synced table to a Parquet snapshot under LOCAL_ENGINE_DIR
+# whenever its table version moves, and _execute_query runs read-only
+# statements over synced tables against those snapshots with DuckDB instead of
+# the warehouse. Anything DuckDB cannot run (Databricks-only functions,
+# TABLESAMPLE, backquoted identifiers, ...) falls back to the warehouse, as
+# does any statement touching a table whose snapshot is behind.
+# LOCAL_ENGINE_OFFLINE=true serves the snapshots as they are and never
+# contacts the warehouse for versions, so dashboards run without a workspace.
+
+LOCAL_ENGINE = os.environ.get("LOCAL_ENGINE", "").lower()
+LOCAL_ENGINE_DIR = os.environ.get("LOCAL_ENGINE_DIR", os.path.join(HUB_DATA_DIR, "local_engine"))
+LOCAL_ENGINE_SYNC_INTERVAL = int(os.environ.get("LOCAL_ENGINE_SYNC_INTERVAL", "300"))
+LOCAL_ENGINE_OFFLINE = os.environ.get("LOCAL_ENGINE_OFFLINE", "false").lower() == "true"
+
+# DuckDB threads per worker process
+LOCAL_ENGINE_THREADS = int(os.environ.get("LOCAL_ENGINE_THREADS", "2"))
+
+_LOCAL_ENGINE_MANIFEST = os.path.join(LOCAL_ENGINE_DIR, "manifest.json")
+
+# {CATALOG}.{SCHEMA}.<table> references, and :name parameter markers outside string literals
+_LOCAL_TABLE_PATTERN = re.compile(re.escape(f"{CATALOG}.{SCHEMA}.") + r"(\w+)")
+_LOCAL_PARAMETER_PATTERN = re.compile(r"('(?:[^'\\]|\\.)*')|(?<![:\w]):(\w+)")
+
+_SYNCED_DATASETS = {table_name: dataset for dataset, table_name in SYNCED_TABLES.items()}
+
+# Per process: DuckDB connection, the manifest its views were built from, table -> snapshot version
+_local_engine = {'pid': None, 'connection': None, 'manifest_mtime': None, 'tables': {}}
+_local_engine_lock = threading.Lock()
+_local_engine_available = None
+_local_engine_counts = {'local': 0, 'warehouse': 0}
+
+# Digests of statements DuckDB failed to run; they go straight to the warehouse
+_local_unsupported = set()
+LOCAL_UNSUPPORTED_MAX = 1000
+
+_local_sync_started = set()
+
+
+def local_engine_enabled():
+    """True when LOCAL_ENGINE=duckdb and duckdb and pyarrow are installed"""
+    global _local_engine_available
+
+    if LOCAL_ENGINE != 'duckdb':
+        return False
+    if _local_engine_available is None:
+        try:
+            import duckdb  # noqa: F401
+            import pyarrow.parquet  # noqa: F401
+            _local_engine_available = True
+        except ImportError:
+            print("ERROR: LOCAL_ENGINE=duckdb needs duckdb and pyarrow installed; queries use the warehouse")
+            _local_engine_available = False
+    return _local_engine_available
+
+
+def _read_local_manifest():
+    """Return {dataset: {'file', 'version', 'rows', 'synced_at'}} for the synced snapshots"""
+    try:
+        with open(_LOCAL_ENGINE_MANIFEST) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f"ERROR: Unreadable local engine manifest: {str(e)}")
+        return {}
+
+
+def _write_local_manifest(manifest):
+    temp_path = f"{_LOCAL_ENGINE_MANIFEST}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, _LOCAL_ENGINE_MANIFEST)
+
+
+def _local_engine_tables():
+    """Return {table_name: version} of the snapshots this process can query.
+
+    The DuckDB connection is opened lazily per process, with one view per
+    snapshot; views are rebuilt whenever another worker rewrites the manifest.
+    """
+    import duckdb
+
+    try:
+        manifest_mtime = os.stat(_LOCAL_ENGINE_MANIFEST).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+
+    state = _local_engine
+    if state['pid'] == os.getpid() and state['manifest_mtime'] == manifest_mtime:
+        return state['tables']
+
+    with _local_engine_lock:
+        if state['pid'] != os.getpid():
+            state.update(pid=os.getpid(), manifest_mtime=None, tables={},
+                         connection=duckdb.connect(':memory:', config={'threads': LOCAL_ENGINE_THREADS}))
+        if state['manifest_mtime'] != manifest_mtime:
+            tables = {}
+            for dataset, entry in _read_local_manifest().items():
+                table_name = SYNCED_TABLES.get(dataset)
+                if not table_name:
+                    continue
+                path = os.path.join(LOCAL_ENGINE_DIR, entry['file']).replace("'", "''")
+                state['connection'].execute(
+                    f"CREATE OR REPLACE VIEW {table_name} AS SELECT * FROM read_parquet('{path}')"
+                )
+                tables[table_name] = entry['version']
+            state['tables'] = tables
+            state['manifest_mtime'] = manifest_mtime
+            print(f"DEBUG: Local engine views loaded: {tables}")
+    return state['tables']
+
+
+def local_engine_serves(dataset):
+    """True when the local engine holds a current snapshot of a dataset's synced table.
+
+    A snapshot is current when its version matches the table version probe,
+    or when no version is known (warehouse stopped); offline, any snapshot is.
+    """
+    if not local_engine_enabled():
+        return False
+    version = _local_engine_tables().get(SYNCED_TABLES[dataset])
+    if version is None:
+        return False
+    if LOCAL_ENGINE_OFFLINE:
+        return True
+    current = get_table_versions().get(dataset)
+    return current is None or current == version
+
+
+def local_engine_versions():
+    """Return {dataset: version} of the local snapshots"""
+    return {dataset: entry['version'] for dataset, entry in _read_local_manifest().items()}
+
+
+def _local_parameter(param):
+    """Convert a ``{'name', 'value', 'type'}`` statement parameter to the Python value DuckDB binds"""
+    value = param.get('value')
+    param_type = (param.get('type') or 'STRING').upper()
+    if value is None:
+        return None
+    if param_type in ('INT', 'INTEGER', 'BIGINT', 'SMALLINT', 'TINYINT'):
+        return int(value)
+    if param_type in ('DOUBLE', 'FLOAT') or param_type.startswith('DECIMAL'):
+        return float(value)
+    if param_type == 'BOOLEAN':
+        return str(value).lower() == 'true'
+    if param_type == 'DATE':
+        return date.fromisoformat(value)
+    if param_type == 'TIMESTAMP':
+        return datetime.fromisoformat(value)
+    return value
+
+
+def _local_value(value):
+    """Render a DuckDB value the way the warehouse's JSON_ARRAY results do: as a string"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def local_engine_query(statement, parameters=None):
+    """Run a statement on the local snapshots if they can answer it.
+
+    Returns rows shaped like ``_execute_query``'s, or None when the statement
+    must go to the warehouse: it writes, reads anything but synced tables, a
+    snapshot is behind, or DuckDB cannot run it. Only parser, binder and
+    catalog errors mark a statement as unsupported; IO errors reload the
+    views and retry once.
+    """
+    if not local_engine_enabled():
+        return None
+    if not LOCAL_ENGINE_OFFLINE:
+        _start_local_sync()
+
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    tables = _LOCAL_TABLE_PATTERN.findall(statement)
+    if not tables or len(tables) != statement.count(f"{CATALOG}."):
+        return None
+    if any(table not in _SYNCED_DATASETS for table in tables):
+        return None
+    digest = hashlib.blake2b(statement.encode(), digest_size=8).digest()
+    if digest in _local_unsupported:
+        _local_engine_counts['warehouse'] += 1
+        return None
+    if not all(local_engine_serves(_SYNCED_DATASETS[table]) for table in set(tables)):
+        _local_engine_counts['warehouse'] += 1
+        return None
+
+    import duckdb
+
+    local_statement = _LOCAL_TABLE_PATTERN.sub(r"\1", statement)
+    local_statement = _LOCAL_PARAMETER_PATTERN.sub(lambda m: m.group(1) or f"${m.group(2)}", local_statement)
+    local_parameters = {param['name']: _local_parameter(param) for param in parameters} if parameters else None
+
+    rows = None
+    for attempt in range(2):
+        # A cursor is a separate connection to the same in-memory database, safe per thread
+        cursor = _local_engine['connection'].cursor()
+        try:
+            started = time.perf_counter()
+            cursor.execute(local_statement, local_parameters)
+            rows = [[_local_value(value) for value in row] for row in cursor.fetchall()]
+            break
+        except (duckdb.ParserException, duckdb.BinderException, duckdb.CatalogException) as e:
+            # Outside DuckDB's dialect: this statement always goes to the warehouse from now on
+            if LOCAL_ENGINE_OFFLINE:
+                raise
+            if len(_local_unsupported) >= LOCAL_UNSUPPORTED_MAX:
+                _local_unsupported.clear()
+            _local_unsupported.add(digest)
+            error = e
+        except duckdb.IOException as e:
+            # Another worker's sync replaced a snapshot under these views: reload them and retry once
+            if attempt == 0:
+                _local_engine['manifest_mtime'] = None
+                if all(local_engine_serves(_SYNCED_DATASETS[table]) for table in set(tables)):
+                    continue
+            if LOCAL_ENGINE_OFFLINE:
+                raise
+            error = e
+        except duckdb.Error as e:
+            if LOCAL_ENGINE_OFFLINE:
+                raise
+            error = e
+        finally:
+            cursor.close()
+
+        _local_engine_counts['warehouse'] += 1
+        print(f"DEBUG: Local engine cannot run statement, using the warehouse: {str(error).splitlines()[0]}")
+        return None
+
+    _local_engine_counts['local'] += 1
+    print(f"DEBUG: Local engine answered in {(time.perf_counter() - started) * 1000:.1f}ms ({len(rows)} rows)")
+    return rows
+
+
+def _export_local_snapshot(dataset, version):
+    """Export a synced table to a new Parquet snapshot; returns its manifest entry"""
+    import pyarrow.parquet
+
+    table_name = SYNCED_TABLES[dataset]
+    file_name = f"{table_name}-{hashlib.blake2b(version.encode(), digest_size=6).hexdigest()}.parquet"
+    path = os.path.join(LOCAL_ENGINE_DIR, file_name)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    started = time.time()
+    response = _run_statement(
+        f"SELECT * FROM {CATALOG}.{SCHEMA}.{table_name}",
+        disposition='EXTERNAL_LINKS', result_format='ARROW_STREAM', priority='export'
+    )
+
+    writer = None
+    rows = 0
+    try:
+        for batch in _iter_arrow_batches(response):
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(temp_path, batch.schema)
+            writer.write_batch(batch)
+            rows += batch.num_rows
+        if writer is None:
+            raise ValueError(f"Export of {table_name} returned no data")
+        writer.close()
+        writer = None
+        os.replace(temp_path, path)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    print(f"DEBUG: Local snapshot of {table_name} at version {version}: {rows} rows in {time.time() - started:.1f}s")
+    return {'file': file_name, 'version': version, 'rows': rows, 'synced_at': time.time()}
+
+
+def sync_local_engine():
+    """Background task: re-export every synced table whose version has moved since its snapshot (one worker at a time)"""
+    versions = get_table_versions()
+    os.makedirs(LOCAL_ENGINE_DIR, exist_ok=True)
+    with open(os.path.join(LOCAL_ENGINE_DIR, 'sync.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+
+        manifest = _read_local_manifest()
+        for dataset in SYNCED_TABLES:
+            version = versions.get(dataset)
+            if version is None or manifest.get(dataset, {}).get('version') == version:
+                continue
+            try:
+                manifest[dataset] = _export_local_snapshot(dataset, version)
+            except HandledError:
+                raise
+            except Exception as e:
+                print(f"ERROR: Local snapshot of {dataset} failed: {str(e)}")
+                continue
+            _write_local_manifest(manifest)
+
+        # Superseded snapshots; a worker still reading one falls back to the warehouse
+        current_files = {entry['file'] for entry in manifest.values()}
+        for name in os.listdir(LOCAL_ENGINE_DIR):
+            if name.endswith('.parquet') and name not in current_files:
+                os.remove(os.path.join(LOCAL_ENGINE_DIR, name))
+
+
+def _start_local_sync():
+    """Start this process's snapshot sync: one pass now, then every LOCAL_ENGINE_SYNC_INTERVAL seconds"""
+    if os.getpid() in _local_sync_started:
+        return
+    _local_sync_started.add(os.getpid())
+
+    def first_pass():
+        _background_thread.active = True
+        try:
+            sync_local_engine()
+        except Exception as e:
+            print(f"ERROR: Local engine sync failed: {str(e)}")
+
+    threading.Thread(target=first_pass, name='local-engine-first-sync', daemon=True).start()
+    ensure_background_task('local-engine-sync', sync_local_engine, LOCAL_ENGINE_SYNC_INTERVAL)
+
+
+def get_local_engine_stats():
+    """Snapshot of the local engine's tables and routing counts, for /health"""
+    if not local_engine_enabled():
+        return {'enabled': False}
+    return {
+        'enabled': True,
+        'offline': LOCAL_ENGINE_OFFLINE,
+        'snapshots': _read_local_manifest(),
+        'queries': dict(_local_engine_counts)
+    }
+
+
+# ============================================================================
+# Stats Cache
+# ============================================================================
+
+# dashboard -> {'data': ..., 'time': ..., 'version': ..., 'encoded': ...}
+_stats_cache = {}
+
+# cache key (as listed by /admin/cache) -> hits in this worker
+_cache_hits = {}
+
+# dashboard -> time of its last admin invalidation; older snapshots are not reused
+_stats_invalidated_at = {}
+
+
+def count_cache_hit(key):
+    _cache_hits[key] = _cache_hits.get(key, 0) + 1
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_BYTES = 1024
+
+
+def encode_json_body(data):
+    """Pre-encode a JSON payload once: body bytes, gzipped bytes and an ETag"""
+    body = dumps_json_bytes(data)
+    return {
+        'body': body,
+        'gzip': gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None,
+        'etag': hashlib.blake2b(body, digest_size=12).hexdigest()
+    }
+
+
+def cached_json_response(encoded):
+    """Serve a pre-encoded JSON body: 304 on a matching ETag, gzip if the client accepts it"""
+    if request.if_none_match.contains_weak(encoded['etag']):
+        response = Response(status=304)
+    elif encoded['gzip'] is not None and request.accept_encodings['gzip']:
+        response = Response(encoded['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(encoded['body'], mimetype='application/json')
+    # Weak: the identity and gzip bodies are the same representation
+    response.set_etag(encoded['etag'], weak=True)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def get_cached_stats_response(dashboard, version):
+    """Return cached stats for a dashboard as a ready-to-send response if they are still current.
+
+    An entry is current when it was computed from ``version`` of the table.
+    Without a known version, entries expire after STATS_CACHE_TTL seconds.
+    """
+    entry = _get_current_stats_entry(dashboard, version)
+    if entry:
+        return cached_json_response(entry['encoded'])
+
+    # Another worker may already have computed this version: reuse its snapshot
+    snapshot = load_snapshot(dashboard) if version is not None else None
+    if snapshot and snapshot['version'] == str(version) and not snapshot['stale_since'] and \
+            snapshot['captured_at'] > _stats_invalidated_at.get(dashboard, 0):
+        print(f"DEBUG: Filling {dashboard} stats cache from the shared snapshot (version: {version})")
+        return set_cached_stats(dashboard, snapshot['data'], version)
+    return None
+
+
+def _get_current_stats_entry(dashboard, version):
+    entry = _stats_cache.get(dashboard)
+    if not entry:
+        return None
+
+    age = time.time() - entry['time']
+    if version is not None and entry['version'] == version:
+        print(f"DEBUG: Returning cached {dashboard} stats (version: {version}, age: {age:.1f}s)")
+    elif version is None and age < STATS_CACHE_TTL:
+        print(f"DEBUG: Returning cached {dashboard} stats (age: {age:.1f}s)")
+    else:
+        return None
+    count_cache_hit(f'stats:{dashboard}')
+    return entry
+
+
+def set_cached_stats(dashboard, data, version):
+    """Cache stats for a dashboard, tagged with the table version they were computed from.
+
+    The response body is encoded (and compressed) here, once, so cache hits
+    only copy bytes. Returns the cached response.
+    """
+    encoded = encode_json_body(data)
+    _stats_cache[dashboard] = {'data': data, 'time': time.time(), 'version': version, 'encoded': encoded}
+    return cached_json_response(encoded)
+
+
+# ============================================================================
+# Local State Databases
+# ============================================================================
+# Small SQLite files under HUB_DATA_DIR hold state shared by every gunicorn
+# worker (stats snapshots, async jobs). Connections are opened lazily, one per
+# thread and process, in WAL mode so readers never block the single writer.
+
+_local_db_connections = threading.local()
+
+
+def local_db(name, schema):
+    """Per-thread connection to HUB_DATA_DIR/<name>.db, creating ``schema`` on first use"""
+    connections = getattr(_local_db_connections, 'by_name', None)
+    if connections is None or _local_db_connections.pid != os.getpid():
+        connections = _local_db_connections.by_name = {}
+        _local_db_connections.pid = os.getpid()
+
+    conn = connections.get(name)
+    if conn is None:
+        os.makedirs(HUB_DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(HUB_DATA_DIR, f'{name}.db'), timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(schema)
+        connections[name] = conn
+    return conn
+
+
+# ============================================================================
+# Snapshot Store
+# ============================================================================
+# The last successful result of each stats query is kept as a zlib-compressed
+# JSON snapshot in a SQLite file under HUB_DATA_DIR, shared by all workers.
+# When a query fails the endpoint serves the latest snapshot with an explicit
+# stale_since timestamp instead of made-up data. After a failure, every worker
+# serves the snapshot without touching the warehouse for SNAPSHOT_RETRY_INTERVAL
+# seconds. Snapshots are only read when something has gone wrong.
+
+SNAPSHOT_RETRY_INTERVAL = int(os.environ.get("SNAPSHOT_RETRY_INTERVAL", "60"))
+SNAPSHOT_MAX_KEYS = int(os.environ.get("SNAPSHOT_MAX_KEYS", "512"))
+
+_SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    key TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    version TEXT,
+    captured_at REAL NOT NULL,
+    stale_since REAL,
+    failed_at REAL,
+    last_error TEXT
+);
+"""
+
+
+def _snapshot_db():
+    return local_db('snapshots', _SNAPSHOT_SCHEMA)
+
+
+def _format_timestamp(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat() if ts else None
+
+
+def save_snapshot(key, data, version=None):
+    """Persist a successful result as the last-known-good snapshot for ``key``"""
+    try:
+        blob = zlib.compress(json.dumps(data, default=str, separators=(',', ':')).encode('utf-8'))
+        conn = _snapshot_db()
+        conn.execute(
+            "INSERT OR REPLACE INTO snapshots (key, data, version, captured_at, stale_since, failed_at, last_error) "
+            "VALUES (?, ?, ?, ?, NULL, NULL, NULL)",
+            (key, blob, None if version is None else str(version), time.time())
+        )
+        conn.execute(
+            "DELETE FROM snapshots WHERE key NOT IN "
+            "(SELECT key FROM snapshots ORDER BY captured_at DESC LIMIT ?)",
+            (SNAPSHOT_MAX_KEYS,)
+        )
+    except Exception as e:
+        print(f"ERROR: Failed to save snapshot {key}: {str(e)}")
+
+
+def load_snapshot(key):
+    """Return the stored snapshot for ``key`` (data plus timestamps), or None"""
+    try:
+        row = _snapshot_db().execute(
+            "SELECT data, version, captured_at, stale_since, failed_at, last_error FROM snapshots WHERE key = ?",
+            (key,)
+        ).fetchone()
+    except Exception as e:
+        print(f"ERROR: Failed to load snapshot {key}: {str(e)}")
+        return None
+    if row is None:
+        return None
+    return {
+        'data': json.loads(zlib.decompress(row[0])),
+        'version': row[1],
+        'captured_at': row[2],
+        'stale_since': row[3],
+        'failed_at': row[4],
+        'last_error': row[5]
+    }
+
+
+def recently_failed_snapshot(key):
+    """Return the snapshot for ``key`` if its query failed within SNAPSHOT_RETRY_INTERVAL"""
+    snapshot = load_snapshot(key)
+    if snapshot and snapshot['failed_at'] and time.time() - snapshot['failed_at'] < SNAPSHOT_RETRY_INTERVAL:
+        return snapshot
+    return None
+
+
+def mark_snapshot_failed(key, error):
+    """Record a failed refresh of ``key``, keeping the earliest stale_since"""
+    now = time.time()
+    try:
+        _snapshot_db().execute(
+            "UPDATE snapshots SET stale_since = COALESCE(stale_since, ?), failed_at = ?, last_error = ? "
+            "WHERE key = ?",
+            (now, now, error, key)
+        )
+    except Exception as e:
+        print(f"ERROR: Failed to mark snapshot {key} as failed: {str(e)}")
+    return load_snapshot(key)
+
+
+def stale_snapshot_response(key, snapshot, error=None):
+    """Serve a last-known-good snapshot, or a 503 when there is none"""
+    error = error or (snapshot and snapshot['last_error'])
+    if snapshot is None:
+        response = jsonify({'error': f'Query failed and no previous result is available: {error}'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(SNAPSHOT_RETRY_INTERVAL)
+        return response
+
+    print(f"DEBUG: Serving {key} snapshot from {_format_timestamp(snapshot['captured_at'])} "
+          f"(stale since {_format_timestamp(snapshot['stale_since'])})")
+    payload = snapshot['data']
+    if isinstance(payload, dict):
+        payload = dict(payload,
+                       stale_since=_format_timestamp(snapshot['stale_since']),
+                       snapshot_at=_format_timestamp(snapshot['captured_at']),
+                       error=f'Query failed, showing last successful result: {error}')
+    return jsonify(payload)
+
+
+# ============================================================================
+# Request Coalescing
+# ============================================================================
+# Concurrent identical requests share one warehouse execution: the first caller
+# computes, the rest wait for its result (or its exception).
+
+_inflight_calls = {}
+_inflight_calls_lock = threading.Lock()
+
+
+def coalesce(key, compute):
+    """Return compute(), running it only once for concurrent callers with the same key"""
+    with _inflight_calls_lock:
+        call = _inflight_calls.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = {'done': threading.Event(), 'result': None, 'error': None, 'waiters': 0}
+            _inflight_calls[key] = call
+        else:
+            call['waiters'] += 1
+
+    if not is_leader:
+        print(f"DEBUG: Coalescing request onto in-flight call {key}")
+        deadline = request_deadline()
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if not call['done'].wait(remaining):
+            with _inflight_calls_lock:
+                call['waiters'] -= 1
+            raise _abandoned_error('deadline')
+        if call['error'] is not None:
+            raise call['error']
+        return call['result']
+
+    # While others wait on this call, its statements outlive the leader's client
+    _coalescing.call = call
+    try:
+        call['result'] = compute()
+        return call['result']
+    except Exception as e:
+        call['error'] = e
+        raise
+    finally:
+        _coalescing.call = None
+        with _inflight_calls_lock:
+            _inflight_calls.pop(key, None)
+        call['done'].set()
+
+
+# ============================================================================
+# Background Refresh
+# ============================================================================
+# In-process indexes are rebuilt on daemon threads. Threads are started on first
+# use instead of at import time so they exist in every gunicorn worker (threads
+# do not survive the --preload fork).
+
+_background_tasks = {}
+_background_tasks_lock = threading.Lock()
+
+# Marks background refresh threads (they must not start a stopped warehouse)
+_background_thread = threading.local()
+
+
+def ensure_background_task(name, refresh, interval):
+    """Call ``refresh()`` every ``interval`` seconds on a daemon thread in this process"""
+    key = (name, os.getpid())
+    if key in _background_tasks:
+        return
+
+    with _background_tasks_lock:
+        if key in _background_tasks:
+            return
+
+        def run():
+            _background_thread.active = True
+            while True:
+                time.sleep(interval)
+                try:
+                    refresh()
+                except Exception as e:
+                    print(f"ERROR: Background task {name} failed: {str(e)}")
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        _background_tasks[key] = thread
+
+
+# ============================================================================
+# Rate Limiting
+# ============================================================================
+# Chat and insights requests are limited per session and per client with token
+# buckets, and per host with a cap on requests in flight. Bucket state lives in
+# a local SQLite file and in-flight slots are file locks, so limits hold across
+# all gunicorn workers (and a crashed worker's slots are released by the OS).
+# Async jobs (POST /api/jobs, progressive insights) take tokens from their
+# kind's buckets, and their running statements count against its in-flight cap
+# until they finish (see submit_job). Rejected requests get 429 with Retry-After.
+
+# endpoint -> (requests per minute, burst) per session; clients get CLIENT_RATE_MULTIPLIER x that
+RATE_LIMITS = {
+    'chat': (float(os.environ.get("CHAT_RATE_PER_MINUTE", "6")), int(os.environ.get("CHAT_RATE_BURST", "3"))),
+    'insights': (float(os.environ.get("INSIGHTS_RATE_PER_MINUTE", "20")),
+                 int(os.environ.get("INSIGHTS_RATE_BURST", "5"))),
+    'query': (float(os.environ.get("QUERY_RATE_PER_MINUTE", "10")), int(os.environ.get("QUERY_RATE_BURST", "3")))
+}
+CLIENT_RATE_MULTIPLIER = int(os.environ.get("CLIENT_RATE_MULTIPLIER", "3"))
+
+# endpoint -> max requests in flight on this host
+MAX_IN_FLIGHT = {
+    'chat': int(os.environ.get("CHAT_MAX_IN_FLIGHT", "8")),
+    'insights': int(os.environ.get("INSIGHTS_MAX_IN_FLIGHT", "8")),
+    'query': int(os.environ.get("QUERY_MAX_IN_FLIGHT", "4"))
+}
+IN_FLIGHT_RETRY_AFTER = 2
+
+# A job still unfinished this long after submission (nobody polls it any more) no longer counts as in flight
+JOB_IN_FLIGHT_WINDOW = int(os.environ.get("JOB_IN_FLIGHT_WINDOW", "300"))
+
+_RATE_LIMIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class RateLimited(HandledError):
+    """Raised when a request exceeds a rate limit or the in-flight cap"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _client_id():
+    """The authenticated user behind the Apps proxy, else the originating address"""
+    forwarded_for = request.headers.get('X-Forwarded-For', '')
+    return request.headers.get('X-Forwarded-Email') or \
+        (forwarded_for.split(',')[0].strip() if forwarded_for else request.remote_addr) or 'unknown'
+
+
+def _take_tokens(buckets):
+    """Atomically take one token from every ``(key, per_minute, burst)`` bucket.
+
+    Takes nothing if any bucket is empty; returns the seconds until that one
+    refills a token, or 0 on success.
+    """
+    db = local_db('rate_limits', _RATE_LIMIT_SCHEMA)
+    now = time.time()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        updates = []
+        wait = 0.0
+        for key, per_minute, burst in buckets:
+            row = db.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+            rate = per_minute / 60
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+            updates.append((key, tokens - 1))
+        if not wait:
+            db.executemany("INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                           [(key, tokens, now) for key, tokens in updates])
+        # Idle buckets are full again after a few minutes; drop them now and then
+        if random.random() < 0.01:
+            db.execute("DELETE FROM buckets WHERE updated_at < ?", (now - 3600,))
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return wait
+
+
+@contextmanager
+def _in_flight_slot(name):
+    """Hold one of the host-wide in-flight slots for ``name``, or raise RateLimited.
+
+    Running jobs of the same kind take up slots too.
+    """
+    slot_dir = os.path.join(HUB_DATA_DIR, 'in_flight')
+    os.makedirs(slot_dir, exist_ok=True)
+    for slot in range(MAX_IN_FLIGHT[name] - running_job_count(name)):
+        slot_file = open(os.path.join(slot_dir, f'{name}-{slot}.lock'), 'w')
+        try:
+            fcntl.flock(slot_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            slot_file.close()
+            continue
+        try:
+            yield
+        finally:
+            slot_file.close()
+        return
+    raise RateLimited(f"Too many {name} requests in progress; please retry shortly", IN_FLIGHT_RETRY_AFTER)
+
+
+def check_rate_limit(name):
+    """Take a token from this session's and client's ``name`` buckets, or raise RateLimited"""
+    if 'session_id' not in session:
+        session['session_id'] = str(uuid.uuid4())
+    per_minute, burst = RATE_LIMITS[name]
+    wait = _take_tokens([
+        (f"{name}:session:{session['session_id']}", per_minute, burst),
+        (f"{name}:client:{_client_id()}", per_minute * CLIENT_RATE_MULTIPLIER, burst * CLIENT_RATE_MULTIPLIER)
+    ])
+    if wait:
+        raise RateLimited(f"Too many {name} requests; please wait {math.ceil(wait)}s", wait)
+
+
+def rate_limited(name):
+    """Route decorator: enforce the ``name`` token buckets and in-flight cap"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            check_rate_limit(name)
+            with _in_flight_slot(name):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ============================================================================
+# Dashboard Rollups
+# ============================================================================
+# The flight, package and review dashboards read small rollup tables that the
+# app owns in CATALOG.SCHEMA instead of scanning the synced tables. A rollup
+# holds one row per day x dashboard dimensions with additive measures (counts,
+# sums, minimums), so every dashboard aggregate can be re-derived from it.
+#
+# A rollup is created on first run and then maintained with MERGE: only the
+# days touched since the last refresh (read from the Delta change data feed)
+# are re-aggregated from the source. Without a change feed the whole source is
+# re-aggregated, and MERGE still only rewrites groups whose measures changed.
+# hub_rollup_state records the source version each rollup reflects; a rollup
+# is only read when that matches the current table version. Refreshes run only
+# on the 'rollups' background task, every ROLLUP_REFRESH_INTERVAL seconds.
+
+ROLLUP_REFRESH_INTERVAL = int(os.environ.get("ROLLUP_REFRESH_INTERVAL", "120"))
+ROLLUP_MAX_CHANGED_DAYS = int(os.environ.get("ROLLUP_MAX_CHANGED_DAYS", "366"))
+
+# Bump when a rollup definition changes; a new key forces a full rebuild
+ROLLUP_DEFINITION_VERSION = 'v1'
+
+ROLLUP_STATE_TABLE = f"{CATALOG}.{SCHEMA}.hub_rollup_state"
+
+# dataset -> day dimension, grouping dimensions (name -> source expression) and measures
+ROLLUPS = {
+    'flights': {
+        'day': 'departure_date',
+        'dimensions': {
+            'departure_date': 'CAST(departure_date AS DATE)',
+            'airline': 'airline',
+            'origin': 'origin',
+            'destination': 'destination',
+            'cabin_class': 'cabin_class',
+            'stops': 'stops',
+            'has_price': 'price IS NOT NULL'
+        },
+        'measures': {
+            'row_count': 'COUNT(*)',
+            'price_sum': 'SUM(price)',
+            'price_count': 'COUNT(price)',
+            'price_min': 'MIN(price)',
+            'duration_sum': 'SUM(duration_minutes)',
+            'duration_count': 'COUNT(duration_minutes)',
+            'seats_sum': 'SUM(available_seats)',
+            'seats_count': 'COUNT(available_seats)'
+        }
+    },
+    'packages': {
+        'day': 'departure_date',
+        'dimensions': {
+            'departure_date': 'CAST(departure_date AS DATE)',
+            'package_type': 'package_type',
+            'destination': 'destination',
+            'departure_city': 'departure_city',
+            'duration_days': 'duration_days',
+            'has_price': 'final_price IS NOT NULL'
+        },
+        'measures': {
+            'row_count': 'COUNT(*)',
+            'price_sum': 'SUM(final_price)',
+            'price_count': 'COUNT(final_price)',
+            'price_min': 'MIN(final_price)',
+            'discount_sum': 'SUM(discount_percentage)',
+            'discount_count': 'COUNT(discount_percentage)'
+        }
+    },
+    'reviews': {
+        'day': 'review_date',
+        'dimensions': {
+            'review_date': 'CAST(review_date AS DATE)',
+            'rating': 'rating',
+            'item_type': 'item_type',
+            'company_name': 'company_name',
+            'traveler_type': 'traveler_type',
+            'verified_purchase': 'verified_purchase',
+            'would_recommend': 'would_recommend'
+        },
+        'measures': {
+            'row_count': 'COUNT(*)',
+            'helpful_sum': 'SUM(helpful_votes)',
+            'helpful_count': 'COUNT(helpful_votes)'
+        }
+    }
+}
+
+# Aggregates used by the stats queries, over the synced table or over its rollup
+STATS_AGGREGATES = {
+    'flights': {
+        'table': {
+            'count': 'COUNT(*)',
+            'avg_price': 'AVG(price)',
+            'min_price': 'MIN(price)',
+            'avg_duration': 'AVG(duration_minutes)',
+            'avg_seats': 'AVG(available_seats)',
+            'has_price': 'price IS NOT NULL'
+        },
+        'rollup': {
+            'count': 'SUM(row_count)',
+            'avg_price': 'try_divide(SUM(price_sum), SUM(price_count))',
+            'min_price': 'MIN(price_min)',
+            'avg_duration': 'try_divide(SUM(duration_sum), SUM(duration_count))',
+            'avg_seats': 'try_divide(SUM(seats_sum), SUM(seats_count))',
+            'has_price': 'has_price'
+        }
+    },
+    'packages': {
+        'table': {
+            'count': 'COUNT(*)',
+            'avg_price': 'AVG(final_price)',
+            'min_price': 'MIN(final_price)',
+            'avg_duration': 'AVG(duration_days)',
+            'avg_discount': 'AVG(discount_percentage)',
+            'has_price': 'final_price IS NOT NULL'
+        },
+        'rollup': {
+            'count': 'SUM(row_count)',
+            'avg_price': 'try_divide(SUM(price_sum), SUM(price_count))',
+            'min_price': 'MIN(price_min)',
+            'avg_duration': 'try_divide(SUM(duration_days * row_count), '
+                            'SUM(CASE WHEN duration_days IS NOT NULL THEN row_count END))',
+            'avg_discount': 'try_divide(SUM(discount_sum), SUM(discount_count))',
+            'has_price': 'has_price'
+        }
+    },
+    'reviews': {
+        'table': {
+            'count': 'COUNT(*)',
+            'avg_helpful': 'AVG(helpful_votes)',
+            'avg_rating': 'AVG(rating)',
+            'recommended': 'SUM(CASE WHEN would_recommend = true THEN 1 ELSE 0 END)',
+            'verified': 'SUM(CASE WHEN verified_purchase = true THEN 1 ELSE 0 END)'
+        },
+        'rollup': {
+            'count': 'SUM(row_count)',
+            'avg_helpful': 'try_divide(SUM(helpful_sum), SUM(helpful_count))',
+            'avg_rating': 'try_divide(SUM(rating * row_count), SUM(CASE WHEN rating IS NOT NULL THEN row_count END))',
+            'recommended': 'SUM(CASE WHEN would_recommend = true THEN row_count ELSE 0 END)',
+            'verified': 'SUM(CASE WHEN verified_purchase = true THEN row_count ELSE 0 END)'
+        }
+    }
+}
+
+# dataset -> source version the rollup reflects, as last read from hub_rollup_state
+_rollup_versions = {}
+_rollup_versions_time = None
+_rollup_versions_lock = threading.Lock()
+_rollup_locks = {dataset: threading.Lock() for dataset in ROLLUPS}
+
+
+def _rollup_table(dataset):
+    return f"{CATALOG}.{SCHEMA}.hub_rollup_{dataset}"
+
+
+def _rollup_key(dataset):
+    return f"{dataset}:{ROLLUP_DEFINITION_VERSION}"
+
+
+def get_rollup_versions():
+    """Return {dataset: source version} for the rollups, read at most once per probe interval"""
+    global _rollup_versions, _rollup_versions_time
+
+    now = time.time()
+    if _rollup_versions_time and now - _rollup_versions_time < TABLE_VERSION_PROBE_INTERVAL:
+        return _rollup_versions
+
+    if not _rollup_versions_lock.acquire(blocking=False):
+        return _rollup_versions
+
+    try:
+        rows = _execute_query(f"SELECT rollup, source_version FROM {ROLLUP_STATE_TABLE}",
+                              wait_timeout='10s', priority='interactive', start_warehouse=False)
+        versions = {row[0]: row[1] for row in rows}
+        _rollup_versions = {dataset: versions[_rollup_key(dataset)]
+                            for dataset in ROLLUPS if versions.get(_rollup_key(dataset))}
+    except RequestAbandoned:
+        raise
+    except Exception as e:
+        # Expected until the first refresh has created the state table
+        print(f"DEBUG: Rollup state unavailable: {str(e)}")
+        _rollup_versions = {}
+    finally:
+        _rollup_versions_time = time.time()
+        _rollup_versions_lock.release()
+
+    return _rollup_versions
+
+
+def _rollup_changed_days(dataset, since_version):
+    """Days touched in the source since ``since_version`` (None day included), or None if unknown"""
+    return table_changed_days(dataset, since_version, ROLLUPS[dataset]['dimensions'][ROLLUPS[dataset]['day']])
+
+
+def table_changed_days(dataset, since_version, day_expression):
+    """Values of ``day_expression`` over rows changed since ``since_version`` (from the change feed).
+
+    Returns None when there is no change feed or too many days changed; the
+    caller then re-aggregates the whole table.
+    """
+    try:
+        rows = _execute_query(f"""
+            SELECT DISTINCT CAST({day_expression} AS STRING)
+            FROM table_changes('{CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}', '{since_version}')
+        """, wait_timeout='30s')
+    except HandledError:
+        raise
+    except Exception as e:
+        print(f"DEBUG: No change feed for {dataset} ({str(e)}); re-aggregating the whole table")
+        return None
+    days = [date.fromisoformat(row[0]).isoformat() if row[0] else None for row in rows]
+    return days if len(days) <= ROLLUP_MAX_CHANGED_DAYS else None
+
+
+def _rollup_day_filter(column, days):
+    conditions = []
+    if any(days):
+        conditions.append(f"{column} IN ({', '.join(f'DATE {day!r}' for day in days if day)})")
+    if None in days:
+        conditions.append(f"{column} IS NULL")
+    return " OR ".join(conditions)
+
+
+def refresh_rollup(dataset, wait=False):
+    """Bring a dataset's rollup up to the current source version (one worker at a time).
+
+    Returns True if the rollup is current afterwards.
+    """
+    version = get_table_versions().get(dataset)
+    if version is None:
+        return False
+    if _rollup_versions.get(dataset) == version:
+        return True
+
+    # One refresh per process (thread lock) and across workers (file lock)
+    lock = _rollup_locks[dataset]
+    if not lock.acquire(blocking=wait):
+        return False
+
+    os.makedirs(HUB_DATA_DIR, exist_ok=True)
+    try:
+        return _refresh_rollup_locked(dataset, version, wait)
+    finally:
+        lock.release()
+
+
+def _refresh_rollup_locked(dataset, version, wait):
+    with open(os.path.join(HUB_DATA_DIR, f'rollup-{dataset}.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+
+        spec = ROLLUPS[dataset]
+        source_table = f"{CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}"
+        rollup_table = _rollup_table(dataset)
+        dimensions = spec['dimensions']
+        measures = spec['measures']
+        select_list = ", ".join(expression if expression == name else f"{expression} as {name}"
+                                for name, expression in list(dimensions.items()) + list(measures.items()))
+        group_by = ", ".join(dimensions.values())
+
+        _execute_query(f"""
+            CREATE TABLE IF NOT EXISTS {ROLLUP_STATE_TABLE}
+            (rollup STRING, source_version STRING, refreshed_at TIMESTAMP)
+        """)
+        # Another worker may have finished the refresh while this one waited
+        state = _execute_query(
+            f"SELECT source_version FROM {ROLLUP_STATE_TABLE} WHERE rollup = '{_rollup_key(dataset)}'"
+        )
+        previous_version = state[0][0] if state else None
+
+        started = time.time()
+        if previous_version == version:
+            changed = 'none'
+        elif previous_version is None:
+            _execute_query(f"""
+                CREATE OR REPLACE TABLE {rollup_table} AS
+                SELECT {select_list}
+                FROM {source_table}
+                GROUP BY {group_by}
+            """, wait_timeout='50s')
+            changed = 'all (initial build)'
+        else:
+            days = _rollup_changed_days(dataset, previous_version)
+            day_column = spec['day']
+            if days is None:
+                source_filter = target_filter = "TRUE"
+            else:
+                source_filter = _rollup_day_filter(dimensions[day_column], days)
+                target_filter = _rollup_day_filter(f"t.{day_column}", days)
+
+            if days != []:
+                _execute_query(f"""
+                    MERGE INTO {rollup_table} t
+                    USING (
+                        SELECT {select_list}
+                        FROM {source_table}
+                        WHERE {source_filter}
+                        GROUP BY {group_by}
+                    ) s
+                    ON {' AND '.join(f't.{name} <=> s.{name}' for name in dimensions)}
+                    WHEN MATCHED AND NOT ({' AND '.join(f't.{name} <=> s.{name}' for name in measures)}) THEN
+                        UPDATE SET {', '.join(f'{name} = s.{name}' for name in measures)}
+                    WHEN NOT MATCHED THEN INSERT *
+                    WHEN NOT MATCHED BY SOURCE AND ({target_filter}) THEN DELETE
+                """, wait_timeout='50s')
+            changed = 'all' if days is None else f"{len(days)} days"
+
+        _execute_query(f"""
+            MERGE INTO {ROLLUP_STATE_TABLE} t
+            USING (SELECT '{_rollup_key(dataset)}' as rollup, '{version}' as source_version) s
+            ON t.rollup = s.rollup
+            WHEN MATCHED THEN UPDATE SET source_version = s.source_version, refreshed_at = current_timestamp()
+            WHEN NOT MATCHED THEN INSERT (rollup, source_version, refreshed_at)
+                VALUES (s.rollup, s.source_version, current_timestamp())
+        """)
+        _rollup_versions[dataset] = version
+        print(f"DEBUG: Rollup for {dataset} merged {changed} to version {version} in {time.time() - started:.1f}s")
+        return True
+
+
+def refresh_rollups():
+    """Background task: keep every rollup at its source's current version"""
+    for dataset in ROLLUPS:
+        try:
+            refresh_rollup(dataset)
+        except HandledError:
+            raise
+        except Exception as e:
+            print(f"ERROR: Rollup refresh for {dataset} failed: {str(e)}")
+
+
+def stats_source(dataset):
+    """Return (table, aggregates) for a dashboard's stats queries: its rollup when current, else the synced table.
+
+    Rollups are only ever refreshed by the 'rollups' background task; while one
+    lags its source, requests read the synced table.
+    """
+    # The local engine scans its snapshot of the synced table faster than the rollup round trip
+    if local_engine_serves(dataset):
+        return f"{CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}", STATS_AGGREGATES[dataset]['table']
+
+    ensure_background_task('rollups', refresh_rollups, ROLLUP_REFRESH_INTERVAL)
+    version = get_table_versions().get(dataset)
+    current = version is not None and get_rollup_versions().get(dataset) == version
+    if current:
+        return _rollup_table(dataset), STATS_AGGREGATES[dataset]['rollup']
+    return f"{CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}", STATS_AGGREGATES[dataset]['table']
+
+
 # ============================================================================
 # Main Application Routes
 # ============================================================================
@@ -93,292 +2289,308 @@ def data_access():
     return render_template('data_access.html')
 
 
-# Simple cache for flight stats
-_flight_stats_cache = None
-_flight_stats_cache_time = None
+# Filters accepted by /api/flights/stats -> (SQL condition, parameter type)
+FLIGHT_STATS_FILTERS = {
+    'start_date': ('departure_date >= :start_date', 'DATE'),
+    'end_date': ('departure_date <= :end_date', 'DATE'),
+    'airline': ('LOWER(airline) = :airline', 'STRING'),
+    'origin': ('UPPER(origin) = :origin', 'STRING'),
+    'cabin_class': ('LOWER(cabin_class) = :cabin_class', 'STRING')
+}
 
-# Simple cache for package stats
-_package_stats_cache = None
-_package_stats_cache_time = None
+# Max number of filter combinations kept in the filtered flight stats cache
+FILTERED_STATS_CACHE_SIZE = int(os.environ.get("FILTERED_STATS_CACHE_SIZE", "128"))
 
-# Simple cache for review stats
-_review_stats_cache = None
-_review_stats_cache_time = None
+# canonical filter tuple -> {'data': ..., 'time': ..., 'version': ...}, least recently used first
+_filtered_flight_stats_cache = OrderedDict()
+_filtered_flight_stats_lock = threading.Lock()
 
-@app.route('/api/flights/stats', methods=['GET'])
-def get_flight_stats():
-    """Get flight statistics from Unity Catalog synced_flights table"""
-    global _flight_stats_cache, _flight_stats_cache_time
-
-    # Return cached data if less than 10 minutes old
-    import time as time_module
-    if _flight_stats_cache and _flight_stats_cache_time:
-        age = time_module.time() - _flight_stats_cache_time
-        if age < 600:  # 10 minutes (extended from 5)
-            print(f"DEBUG: Returning cached flight stats (age: {age:.1f}s)")
-            response = jsonify(_flight_stats_cache)
-            response.headers['Cache-Control'] = 'public, max-age=600'
-            return response
 
-    try:
-        print("DEBUG: Fetching fresh flight stats from database...")
-
-        # Get warehouse ID from environment variable or find a running one
-        warehouse_id = os.environ.get("DATABRICKS_WAREHOUSE_ID")
-        if not warehouse_id:
-            warehouses = list(w.warehouses.list())
-            for wh in warehouses:
-                if wh.state.value == 'RUNNING':
-                    warehouse_id = wh.id
-                    break
-            if not warehouse_id:
-                raise Exception("No running SQL warehouse found")
+def _parse_flight_filters(args):
+    """Return the canonical (normalised, sorted) filter set from request args"""
+    filters = {}
+    for name in FLIGHT_STATS_FILTERS:
+        value = args.get(name, '').strip()
+        if not value:
+            continue
+        if name in ('start_date', 'end_date'):
+            value = date.fromisoformat(value).isoformat()
+        elif name == 'origin':
+            value = value.upper()
+        else:
+            value = value.lower()
+        filters[name] = value
+    return tuple(sorted(filters.items()))
 
-        # Run separate simple queries (faster than one complex UNION ALL query)
 
-        # Query 1: Top airlines
-        airlines_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=f"""
-                SELECT
-                    airline,
-                    COUNT(*) as flight_count,
-                    AVG(price) as avg_price,
-                    AVG(duration_minutes) as avg_duration
-                FROM {CATALOG}.{SCHEMA}.synced_flights
-                WHERE airline IS NOT NULL
-                GROUP BY airline
-                ORDER BY COUNT(*) DESC
-                LIMIT 10
-            """
-        ).result()
-
-        airlines = []
-        if airlines_result and airlines_result.data_array:
-            for row in airlines_result.data_array:
-                airlines.append({
-                    'airline': row[0],
-                    'flight_count': int(row[1]) if row[1] else 0,
-                    'avg_price': float(row[2]) if row[2] else 0,
-                    'avg_duration': int(float(row[3])) if row[3] else 0
-                })
+def _compute_flight_stats(filters):
+    """Run the flight dashboard queries over synced_flights restricted to the given filters"""
+    filter_conditions = [FLIGHT_STATS_FILTERS[name][0] for name, _ in filters]
+    parameters = [{'name': name, 'value': value, 'type': FLIGHT_STATS_FILTERS[name][1]} for name, value in filters]
 
-        # Query 2: Top routes
-        routes_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=f"""
-                SELECT
-                    origin,
-                    destination,
-                    COUNT(*) as flight_count,
-                    AVG(price) as avg_price,
-                    MIN(price) as min_price
-                FROM {CATALOG}.{SCHEMA}.synced_flights
-                WHERE origin IS NOT NULL AND destination IS NOT NULL
-                GROUP BY origin, destination
-                ORDER BY COUNT(*) DESC
-                LIMIT 10
-            """
-        ).result()
+    # A user is waiting on every cache miss; only background refreshes run at background priority
+    priority = caller_priority()
 
-        routes = []
-        if routes_result and routes_result.data_array:
-            for row in routes_result.data_array:
-                routes.append({
-                    'origin': row[0],
-                    'destination': row[1],
-                    'flight_count': int(row[2]) if row[2] else 0,
-                    'avg_price': float(row[3]) if row[3] else 0,
-                    'min_price': float(row[4]) if row[4] else 0
-                })
+    # Reads the flights rollup when it is current (see Dashboard Rollups)
+    source_table, agg = stats_source('flights')
 
-        # Query 3: Cabin classes
-        cabin_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=f"""
-                SELECT
-                    cabin_class,
-                    AVG(price) as avg_price,
-                    COUNT(*) as count
-                FROM {CATALOG}.{SCHEMA}.synced_flights
-                WHERE cabin_class IS NOT NULL AND price IS NOT NULL
-                GROUP BY cabin_class
-            """
-        ).result()
-
-        cabin_classes = []
-        if cabin_result and cabin_result.data_array:
-            for row in cabin_result.data_array:
-                cabin_classes.append({
-                    'cabin_class': row[0],
-                    'avg_price': float(row[1]) if row[1] else 0,
-                    'count': int(row[2]) if row[2] else 0
-                })
+    def where(*conditions):
+        return "WHERE " + " AND ".join(list(conditions) + filter_conditions)
 
-        # Query 4: Stops analysis
-        stops_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=f"""
-                SELECT
-                    stops,
-                    COUNT(*) as count,
-                    AVG(price) as avg_price,
-                    AVG(duration_minutes) as avg_duration
-                FROM {CATALOG}.{SCHEMA}.synced_flights
-                WHERE stops IS NOT NULL
-                GROUP BY stops
-                ORDER BY stops
-            """
-        ).result()
-
-        stops = []
-        if stops_result and stops_result.data_array:
-            for row in stops_result.data_array:
-                stops.append({
-                    'stops': int(row[0]) if row[0] is not None else 0,
-                    'count': int(row[1]) if row[1] else 0,
-                    'avg_price': float(row[2]) if row[2] else 0,
-                    'avg_duration': int(float(row[3])) if row[3] else 0
-                })
+    # Run separate simple queries (faster than one complex UNION ALL query)
 
-        # Query 5: Overall statistics
-        overall_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=f"""
-                SELECT
-                    COUNT(*) as total_flights,
-                    AVG(price) as avg_price,
-                    AVG(duration_minutes) as avg_duration,
-                    AVG(available_seats) as avg_available_seats
-                FROM {CATALOG}.{SCHEMA}.synced_flights
-                WHERE price IS NOT NULL
-            """
-        ).result()
+    # Query 1: Top airlines
+    airlines_rows = _execute_query(f"""
+        SELECT
+            airline,
+            {agg['count']} as flight_count,
+            {agg['avg_price']} as avg_price,
+            {agg['avg_duration']} as avg_duration
+        FROM {source_table}
+        {where("airline IS NOT NULL")}
+        GROUP BY airline
+        ORDER BY {agg['count']} DESC
+        LIMIT 10
+    """, parameters=parameters, priority=priority)
+
+    airlines = []
+    for row in airlines_rows:
+        airlines.append({
+            'airline': row[0],
+            'flight_count': int(row[1]) if row[1] else 0,
+            'avg_price': float(row[2]) if row[2] else 0,
+            'avg_duration': int(float(row[3])) if row[3] else 0
+        })
+
+    # Query 2: Top routes
+    routes_rows = _execute_query(f"""
+        SELECT
+            origin,
+            destination,
+            {agg['count']} as flight_count,
+            {agg['avg_price']} as avg_price,
+            {agg['min_price']} as min_price
+        FROM {source_table}
+        {where("origin IS NOT NULL", "destination IS NOT NULL")}
+        GROUP BY origin, destination
+        ORDER BY {agg['count']} DESC
+        LIMIT 10
+    """, parameters=parameters, priority=priority)
+
+    routes = []
+    for row in routes_rows:
+        routes.append({
+            'origin': row[0],
+            'destination': row[1],
+            'flight_count': int(row[2]) if row[2] else 0,
+            'avg_price': float(row[3]) if row[3] else 0,
+            'min_price': float(row[4]) if row[4] else 0
+        })
+
+    # Query 3: Cabin classes
+    cabin_rows = _execute_query(f"""
+        SELECT
+            cabin_class,
+            {agg['avg_price']} as avg_price,
+            {agg['count']} as count
+        FROM {source_table}
+        {where("cabin_class IS NOT NULL", agg['has_price'])}
+        GROUP BY cabin_class
+    """, parameters=parameters, priority=priority)
+
+    cabin_classes = []
+    for row in cabin_rows:
+        cabin_classes.append({
+            'cabin_class': row[0],
+            'avg_price': float(row[1]) if row[1] else 0,
+            'count': int(row[2]) if row[2] else 0
+        })
 
+    # Query 4: Stops analysis
+    stops_rows = _execute_query(f"""
+        SELECT
+            stops,
+            {agg['count']} as count,
+            {agg['avg_price']} as avg_price,
+            {agg['avg_duration']} as avg_duration
+        FROM {source_table}
+        {where("stops IS NOT NULL")}
+        GROUP BY stops
+        ORDER BY stops
+    """, parameters=parameters, priority=priority)
+
+    stops = []
+    for row in stops_rows:
+        stops.append({
+            'stops': int(row[0]) if row[0] is not None else 0,
+            'count': int(row[1]) if row[1] else 0,
+            'avg_price': float(row[2]) if row[2] else 0,
+            'avg_duration': int(float(row[3])) if row[3] else 0
+        })
+
+    # Query 5: Overall statistics
+    overall_rows = _execute_query(f"""
+        SELECT
+            {agg['count']} as total_flights,
+            {agg['avg_price']} as avg_price,
+            {agg['avg_duration']} as avg_duration,
+            {agg['avg_seats']} as avg_available_seats
+        FROM {source_table}
+        {where(agg['has_price'])}
+    """, parameters=parameters, priority=priority)
+
+    overall = {
+        'total_flights': 0,
+        'avg_price': 0,
+        'avg_duration': 0,
+        'avg_available_seats': 0
+    }
+    if overall_rows:
+        row = overall_rows[0]
         overall = {
-            'total_flights': 0,
-            'avg_price': 0,
-            'avg_duration': 0,
-            'avg_available_seats': 0
+            'total_flights': int(row[0]) if row[0] else 0,
+            'avg_price': float(row[1]) if row[1] else 0,
+            'avg_duration': int(float(row[2])) if row[2] else 0,
+            'avg_available_seats': int(float(row[3])) if row[3] else 0
         }
-        if overall_result and overall_result.data_array and len(overall_result.data_array) > 0:
-            row = overall_result.data_array[0]
-            overall = {
-                'total_flights': int(row[0]) if row[0] else 0,
-                'avg_price': float(row[1]) if row[1] else 0,
-                'avg_duration': int(float(row[2])) if row[2] else 0,
-                'avg_available_seats': int(float(row[3])) if row[3] else 0
-            }
 
-        response_data = {
-            'airlines': airlines,
-            'routes': routes,
-            'cabin_classes': cabin_classes,
-            'stops': stops,
-            'overall': overall
-        }
+    return {
+        'airlines': airlines,
+        'routes': routes,
+        'cabin_classes': cabin_classes,
+        'stops': stops,
+        'overall': overall
+    }
+
+
+def _flight_snapshot_key(filters):
+    """Snapshot store key for a canonical filter tuple"""
+    return 'flights?' + '&'.join(f'{name}={value}' for name, value in filters) if filters else 'flights'
+
+
+def _get_filtered_flight_stats(filters, version):
+    """Serve a filter combination from the LRU cache, computing it (coalesced) on a miss"""
+    with _filtered_flight_stats_lock:
+        entry = _filtered_flight_stats_cache.get(filters)
+        if entry and (entry['version'] == version if version is not None
+                      else time.time() - entry['time'] < STATS_CACHE_TTL):
+            _filtered_flight_stats_cache.move_to_end(filters)
+            count_cache_hit(f'stats:{_flight_snapshot_key(filters)}')
+            print(f"DEBUG: Returning cached flight stats for filters {filters}")
+            return entry['data']
+
+    def compute():
+        # Only the leader snapshots the result; coalesced waiters share it
+        data = _compute_flight_stats(filters)
+        save_snapshot(_flight_snapshot_key(filters), dict(data, filters=dict(filters)), version)
+        return data
+
+    data = coalesce(('flight_stats', filters, version), compute)
+
+    with _filtered_flight_stats_lock:
+        _filtered_flight_stats_cache[filters] = {'data': data, 'time': time.time(), 'version': version}
+        _filtered_flight_stats_cache.move_to_end(filters)
+        while len(_filtered_flight_stats_cache) > FILTERED_STATS_CACHE_SIZE:
+            _filtered_flight_stats_cache.popitem(last=False)
+    return data
+
+
+@app.route('/api/flights/stats', methods=['GET'])
+def get_flight_stats():
+    """Get flight statistics from Unity Catalog synced_flights table.
+
+    Optional filters: start_date, end_date (departure_date), airline, origin, cabin_class.
+    """
+    try:
+        filters = _parse_flight_filters(request.args)
+    except ValueError:
+        return jsonify({'error': 'start_date and end_date must be YYYY-MM-DD'}), 400
+
+    version = get_table_versions().get('flights')
+
+    # Unfiltered view: return cached data if the table has not changed since it was computed
+    if not filters:
+        cached = get_cached_stats_response('flights', version)
+        if cached:
+            return cached
 
-        # Cache the result
-        _flight_stats_cache = response_data
-        _flight_stats_cache_time = time_module.time()
+    # A refresh failed moments ago (possibly in another worker): don't retry the warehouse yet
+    snapshot_key = _flight_snapshot_key(filters)
+    snapshot = recently_failed_snapshot(snapshot_key)
+    if snapshot:
+        return stale_snapshot_response(snapshot_key, snapshot)
 
-        print("DEBUG: Flight stats fetched and cached successfully")
-        response = jsonify(response_data)
+    try:
+        if filters:
+            response_data = _get_filtered_flight_stats(filters, version)
+        else:
+            def compute():
+                print("DEBUG: Fetching fresh flight stats from database...")
+                data = _compute_flight_stats(filters)
+
+                # Cache (encoding once) and snapshot the result against the table version it was computed
+                # from, in the leader only; coalesced waiters send the same encoded body
+                set_cached_stats('flights', data, version)
+                save_snapshot('flights', data, version)
+                print("DEBUG: Flight stats fetched and cached successfully")
+                return _stats_cache['flights']['encoded']
+
+            return cached_json_response(coalesce(('flight_stats', filters, version), compute))
+
+        response = jsonify(dict(response_data, filters=dict(filters)))
         response.headers['Cache-Control'] = 'public, max-age=600'
         return response
 
+    except HandledError:
+        raise
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         print(f"ERROR: Exception in flight stats endpoint: {error_details}")
         app.logger.error(f"Error in flight stats endpoint: {str(e)}\n{error_details}")
 
-        # Return mock data as fallback if query fails
-        return jsonify({
-            'airlines': [
-                {'airline': 'United', 'flight_count': 150, 'avg_price': 450.50, 'avg_duration': 180},
-                {'airline': 'Delta', 'flight_count': 142, 'avg_price': 425.75, 'avg_duration': 175},
-                {'airline': 'American Airlines', 'flight_count': 135, 'avg_price': 410.25, 'avg_duration': 170},
-                {'airline': 'Lufthansa', 'flight_count': 128, 'avg_price': 520.00, 'avg_duration': 240},
-                {'airline': 'Air France', 'flight_count': 120, 'avg_price': 485.50, 'avg_duration': 220}
-            ],
-            'routes': [
-                {'origin': 'JFK', 'destination': 'LAX', 'flight_count': 45, 'avg_price': 350.00, 'min_price': 250.00},
-                {'origin': 'LHR', 'destination': 'CDG', 'flight_count': 40, 'avg_price': 180.00, 'min_price': 120.00},
-                {'origin': 'ORD', 'destination': 'SFO', 'flight_count': 38, 'avg_price': 320.00, 'min_price': 220.00},
-                {'origin': 'ATL', 'destination': 'MIA', 'flight_count': 35, 'avg_price': 280.00, 'min_price': 180.00},
-                {'origin': 'DXB', 'destination': 'LHR', 'flight_count': 32, 'avg_price': 650.00, 'min_price': 450.00}
-            ],
-            'cabin_classes': [
-                {'cabin_class': 'First', 'avg_price': 1200.00, 'count': 150},
-                {'cabin_class': 'Business', 'avg_price': 800.00, 'count': 250},
-                {'cabin_class': 'Premium Economy', 'avg_price': 450.00, 'count': 200},
-                {'cabin_class': 'Economy', 'avg_price': 250.00, 'count': 400}
-            ],
-            'stops': [
-                {'stops': 0, 'count': 600, 'avg_price': 420.00, 'avg_duration': 180},
-                {'stops': 1, 'count': 300, 'avg_price': 320.00, 'avg_duration': 280},
-                {'stops': 2, 'count': 100, 'avg_price': 250.00, 'avg_duration': 380}
-            ],
-            'overall': {
-                'total_flights': 1000,
-                'avg_price': 385.50,
-                'avg_duration': 215,
-                'avg_available_seats': 120
-            },
-            'error': f'Query failed, showing mock data: {str(e)}'
-        })
+        # Serve the last successful result instead of failing the dashboard
+        return stale_snapshot_response(snapshot_key, mark_snapshot_failed(snapshot_key, str(e)), str(e))
 
 
 @app.route('/api/packages/stats', methods=['GET'])
 def get_package_stats():
     """Get package statistics from Unity Catalog synced_packages table"""
-    global _package_stats_cache, _package_stats_cache_time
-
-    # Return cached data if less than 10 minutes old
-    import time as time_module
-    if _package_stats_cache and _package_stats_cache_time:
-        age = time_module.time() - _package_stats_cache_time
-        if age < 600:  # 10 minutes (extended from 5)
-            print(f"DEBUG: Returning cached package stats (age: {age:.1f}s)")
-            response = jsonify(_package_stats_cache)
-            response.headers['Cache-Control'] = 'public, max-age=600'
-            return response
+    # Return cached data if the table has not changed since it was computed
+    version = get_table_versions().get('packages')
+    cached = get_cached_stats_response('packages', version)
+    if cached:
+        return cached
+
+    # A refresh failed moments ago (possibly in another worker): don't retry the warehouse yet
+    snapshot = recently_failed_snapshot('packages')
+    if snapshot:
+        return stale_snapshot_response('packages', snapshot)
 
     try:
         print("DEBUG: Fetching fresh package stats from database...")
+        source_table, agg = stats_source('packages')
 
         # Use a single query with multiple CTEs for better performance
         combined_query = f"""
         WITH type_stats AS (
             SELECT
                 package_type,
-                COUNT(*) as package_count,
-                AVG(final_price) as avg_price,
-                AVG(duration_days) as avg_duration,
-                ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) as rn
-            FROM {CATALOG}.{SCHEMA}.synced_packages
+                {agg['count']} as package_count,
+                {agg['avg_price']} as avg_price,
+                {agg['avg_duration']} as avg_duration,
+                ROW_NUMBER() OVER (ORDER BY {agg['count']} DESC) as rn
+            FROM {source_table}
             WHERE package_type IS NOT NULL
             GROUP BY package_type
         ),
         destination_stats AS (
             SELECT
                 destination,
-                COUNT(*) as package_count,
-                AVG(final_price) as avg_price,
-                MIN(final_price) as min_price,
-                ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) as rn
-            FROM {CATALOG}.{SCHEMA}.synced_packages
+                {agg['count']} as package_count,
+                {agg['avg_price']} as avg_price,
+                {agg['min_price']} as min_price,
+                ROW_NUMBER() OVER (ORDER BY {agg['count']} DESC) as rn
+            FROM {source_table}
             WHERE destination IS NOT NULL
             GROUP BY destination
         ),
@@ -386,10 +2598,10 @@ def get_package_stats():
             SELECT
                 departure_city,
                 destination,
-                COUNT(*) as package_count,
-                AVG(final_price) as avg_price,
-                ROW_NUMBER() OVER (ORDER BY COUNT(*) DESC) as rn
-            FROM {CATALOG}.{SCHEMA}.synced_packages
+                {agg['count']} as package_count,
+                {agg['avg_price']} as avg_price,
+                ROW_NUMBER() OVER (ORDER BY {agg['count']} DESC) as rn
+            FROM {source_table}
             WHERE departure_city IS NOT NULL AND destination IS NOT NULL
             GROUP BY departure_city, destination
         ),
@@ -401,21 +2613,21 @@ def get_package_stats():
                     WHEN duration_days <= 14 THEN '8-14 days'
                     ELSE '15+ days'
                 END as duration_range,
-                COUNT(*) as count,
-                AVG(final_price) as avg_price,
-                AVG(duration_days) as avg_days
-            FROM {CATALOG}.{SCHEMA}.synced_packages
+                {agg['count']} as count,
+                {agg['avg_price']} as avg_price,
+                {agg['avg_duration']} as avg_days
+            FROM {source_table}
             WHERE duration_days IS NOT NULL
             GROUP BY duration_range
         ),
         overall_stats AS (
             SELECT
-                COUNT(*) as total_packages,
-                AVG(final_price) as avg_price,
-                AVG(duration_days) as avg_duration,
-                AVG(discount_percentage) as avg_discount
-            FROM {CATALOG}.{SCHEMA}.synced_packages
-            WHERE final_price IS NOT NULL
+                {agg['count']} as total_packages,
+                {agg['avg_price']} as avg_price,
+                {agg['avg_duration']} as avg_duration,
+                {agg['avg_discount']} as avg_discount
+            FROM {source_table}
+            WHERE {agg['has_price']}
         )
         SELECT
             'types' as stat_type,
@@ -498,33 +2710,8 @@ def get_package_stats():
         FROM overall_stats
         """
 
-        # Execute single combined query
-        import time
-
-        # Find a running warehouse
-        warehouses = list(w.warehouses.list())
-        warehouse_id = None
-        for wh in warehouses:
-            if wh.state.value == 'RUNNING':
-                warehouse_id = wh.id
-                break
-
-        if not warehouse_id:
-            raise Exception("No running SQL warehouse found")
-
-        # Execute and wait for completion
-        result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=combined_query
-        )
-
-        # Wait for completion and get results
-        data = w.statement_execution.wait_get_statement_result_chunk_n(
-            statement_id=result.statement_id,
-            chunk_index=0
-        )
+        # Execute single combined query and wait for completion
+        rows = _execute_query(combined_query, priority=caller_priority())
 
         # Parse results
         package_types = []
@@ -538,8 +2725,8 @@ def get_package_stats():
             'avg_discount': 0
         }
 
-        if data and data.data_array:
-            for row in data.data_array:
+        if rows:
+            for row in rows:
                 row_type = row[0]
 
                 if row_type == 'types':
@@ -586,112 +2773,79 @@ def get_package_stats():
             'overall': overall
         }
 
-        # Cache the result
-        _package_stats_cache = response_data
-        _package_stats_cache_time = time_module.time()
+        # Cache the result against the table version it was computed from
+        response = set_cached_stats('packages', response_data, version)
+        save_snapshot('packages', response_data, version)
 
         print("DEBUG: Package stats fetched and cached successfully")
-        response = jsonify(response_data)
-        response.headers['Cache-Control'] = 'public, max-age=600'
         return response
 
+    except HandledError:
+        raise
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         print(f"ERROR: Exception in package stats endpoint: {error_details}")
         app.logger.error(f"Error in package stats endpoint: {str(e)}\n{error_details}")
 
-        # Return mock data as fallback if query fails
-        return jsonify({
-            'package_types': [
-                {'package_type': 'Flight + Hotel', 'package_count': 450, 'avg_price': 1250.00, 'avg_duration': 7},
-                {'package_type': 'Flight + Hotel + Car', 'package_count': 320, 'avg_price': 1580.00, 'avg_duration': 10},
-                {'package_type': 'Beach Holiday', 'package_count': 280, 'avg_price': 2100.00, 'avg_duration': 14},
-                {'package_type': 'City Break', 'package_count': 250, 'avg_price': 850.00, 'avg_duration': 4}
-            ],
-            'destinations': [
-                {'destination': 'Dubai', 'package_count': 120, 'avg_price': 1800.00, 'min_price': 950.00},
-                {'destination': 'Paris', 'package_count': 110, 'avg_price': 1200.00, 'min_price': 680.00},
-                {'destination': 'Barcelona', 'package_count': 95, 'avg_price': 980.00, 'min_price': 550.00},
-                {'destination': 'Tokyo', 'package_count': 85, 'avg_price': 2500.00, 'min_price': 1800.00},
-                {'destination': 'New York', 'package_count': 80, 'avg_price': 1900.00, 'min_price': 1200.00}
-            ],
-            'routes': [
-                {'departure_city': 'London', 'destination': 'Dubai', 'package_count': 45, 'avg_price': 1750.00},
-                {'departure_city': 'Paris', 'destination': 'Barcelona', 'package_count': 38, 'avg_price': 890.00},
-                {'departure_city': 'London', 'destination': 'Paris', 'package_count': 35, 'avg_price': 1100.00}
-            ],
-            'durations': [
-                {'duration_range': '1-3 days', 'count': 250, 'avg_price': 650.00, 'avg_days': 2.5},
-                {'duration_range': '4-7 days', 'count': 420, 'avg_price': 1200.00, 'avg_days': 5.8},
-                {'duration_range': '8-14 days', 'count': 280, 'avg_price': 2100.00, 'avg_days': 10.5},
-                {'duration_range': '15+ days', 'count': 50, 'avg_price': 3500.00, 'avg_days': 18.2}
-            ],
-            'overall': {
-                'total_packages': 1000,
-                'avg_price': 1485.50,
-                'avg_duration': 8,
-                'avg_discount': 15.5
-            },
-            'error': f'Query failed, showing mock data: {str(e)}'
-        })
+        # Serve the last successful result instead of failing the dashboard
+        return stale_snapshot_response('packages', mark_snapshot_failed('packages', str(e)), str(e))
 
 
 @app.route('/api/reviews/stats', methods=['GET'])
 def get_review_stats():
     """Get review statistics from Unity Catalog synced_reviews table"""
-    global _review_stats_cache, _review_stats_cache_time
-
-    # Return cached data if less than 10 minutes old
-    import time as time_module
-    if _review_stats_cache and _review_stats_cache_time:
-        age = time_module.time() - _review_stats_cache_time
-        if age < 600:  # 10 minutes (extended from 5)
-            print(f"DEBUG: Returning cached review stats (age: {age:.1f}s)")
-            response = jsonify(_review_stats_cache)
-            response.headers['Cache-Control'] = 'public, max-age=600'
-            return response
+    # Return cached data if the table has not changed since it was computed
+    version = get_table_versions().get('reviews')
+    cached = get_cached_stats_response('reviews', version)
+    if cached:
+        return cached
+
+    # A refresh failed moments ago (possibly in another worker): don't retry the warehouse yet
+    snapshot = recently_failed_snapshot('reviews')
+    if snapshot:
+        return stale_snapshot_response('reviews', snapshot)
 
     try:
         print("DEBUG: Fetching fresh review stats from database...")
+        source_table, agg = stats_source('reviews')
 
         # Use a single query with multiple CTEs for better performance
         combined_query = f"""
         WITH rating_dist AS (
             SELECT
                 rating,
-                COUNT(*) as count,
-                AVG(helpful_votes) as avg_helpful
-            FROM {CATALOG}.{SCHEMA}.synced_reviews
+                {agg['count']} as count,
+                {agg['avg_helpful']} as avg_helpful
+            FROM {source_table}
             WHERE rating IS NOT NULL
             GROUP BY rating
         ),
         item_type_stats AS (
             SELECT
                 item_type,
-                COUNT(*) as review_count,
-                AVG(rating) as avg_rating,
-                SUM(CASE WHEN would_recommend = true THEN 1 ELSE 0 END) * 100.0 / COUNT(*) as recommend_pct
-            FROM {CATALOG}.{SCHEMA}.synced_reviews
+                {agg['count']} as review_count,
+                {agg['avg_rating']} as avg_rating,
+                {agg['recommended']} * 100.0 / {agg['count']} as recommend_pct
+            FROM {source_table}
             WHERE item_type IS NOT NULL
             GROUP BY item_type
         ),
         company_stats AS (
             SELECT
                 company_name,
-                COUNT(*) as review_count,
-                AVG(rating) as avg_rating,
-                ROW_NUMBER() OVER (ORDER BY AVG(rating) DESC, COUNT(*) DESC) as rn
-            FROM {CATALOG}.{SCHEMA}.synced_reviews
+                {agg['count']} as review_count,
+                {agg['avg_rating']} as avg_rating,
+                ROW_NUMBER() OVER (ORDER BY {agg['avg_rating']} DESC, {agg['count']} DESC) as rn
+            FROM {source_table}
             WHERE company_name IS NOT NULL
             GROUP BY company_name
         ),
         traveler_stats AS (
             SELECT
                 traveler_type,
-                COUNT(*) as count,
-                AVG(rating) as avg_rating
-            FROM {CATALOG}.{SCHEMA}.synced_reviews
+                {agg['count']} as count,
+                {agg['avg_rating']} as avg_rating
+            FROM {source_table}
             WHERE traveler_type IS NOT NULL
             GROUP BY traveler_type
         ),
@@ -702,18 +2856,18 @@ def get_review_stats():
                     WHEN rating = 3 THEN 'Neutral'
                     ELSE 'Negative'
                 END as sentiment,
-                COUNT(*) as count
-            FROM {CATALOG}.{SCHEMA}.synced_reviews
+                {agg['count']} as count
+            FROM {source_table}
             WHERE rating IS NOT NULL
             GROUP BY sentiment
         ),
         overall_stats AS (
             SELECT
-                COUNT(*) as total_reviews,
-                AVG(rating) as avg_rating,
-                SUM(CASE WHEN verified_purchase = true THEN 1 ELSE 0 END) * 100.0 / COUNT(*) as verified_pct,
-                SUM(CASE WHEN would_recommend = true THEN 1 ELSE 0 END) * 100.0 / COUNT(*) as recommend_pct
-            FROM {CATALOG}.{SCHEMA}.synced_reviews
+                {agg['count']} as total_reviews,
+                {agg['avg_rating']} as avg_rating,
+                {agg['verified']} * 100.0 / {agg['count']} as verified_pct,
+                {agg['recommended']} * 100.0 / {agg['count']} as recommend_pct
+            FROM {source_table}
         )
         SELECT
             'ratings' as stat_type,
@@ -812,33 +2966,8 @@ def get_review_stats():
         FROM overall_stats
         """
 
-        # Execute single combined query
-        import time
-
-        # Find a running warehouse
-        warehouses = list(w.warehouses.list())
-        warehouse_id = None
-        for wh in warehouses:
-            if wh.state.value == 'RUNNING':
-                warehouse_id = wh.id
-                break
-
-        if not warehouse_id:
-            raise Exception("No running SQL warehouse found")
-
-        # Execute and wait for completion
-        result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=combined_query
-        )
-
-        # Wait for completion and get results
-        data = w.statement_execution.wait_get_statement_result_chunk_n(
-            statement_id=result.statement_id,
-            chunk_index=0
-        )
+        # Execute single combined query and wait for completion
+        rows = _execute_query(combined_query, priority=caller_priority())
 
         # Parse results
         ratings = []
@@ -853,8 +2982,8 @@ def get_review_stats():
             'recommend_pct': 0
         }
 
-        if data and data.data_array:
-            for row in data.data_array:
+        if rows:
+            for row in rows:
                 row_type = row[0]
 
                 if row_type == 'ratings':
@@ -895,258 +3024,2136 @@ def get_review_stats():
                         'recommend_pct': float(row[6]) if row[6] else 0
                     }
 
-        response_data = {
-            'ratings': sorted(ratings, key=lambda x: x['rating']),
-            'item_types': item_types,
-            'companies': companies,
-            'travelers': travelers,
-            'sentiment': sentiment,
-            'overall': overall
+        response_data = {
+            'ratings': sorted(ratings, key=lambda x: x['rating']),
+            'item_types': item_types,
+            'companies': companies,
+            'travelers': travelers,
+            'sentiment': sentiment,
+            'overall': overall
+        }
+
+        # Cache the result against the table version it was computed from
+        response = set_cached_stats('reviews', response_data, version)
+        save_snapshot('reviews', response_data, version)
+
+        print("DEBUG: Review stats fetched and cached successfully")
+        return response
+
+    except HandledError:
+        raise
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in review stats endpoint: {error_details}")
+        app.logger.error(f"Error in review stats endpoint: {str(e)}\n{error_details}")
+
+        # Serve the last successful result instead of failing the dashboard
+        return stale_snapshot_response('reviews', mark_snapshot_failed('reviews', str(e)), str(e))
+
+
+@app.route('/api/hotels/stats', methods=['GET'])
+def get_hotel_stats():
+    """Get hotel statistics from Unity Catalog synced_hotels table"""
+    # Return cached data if the table has not changed since it was computed
+    version = get_table_versions().get('hotels')
+    cached = get_cached_stats_response('hotels', version)
+    if cached:
+        return cached
+
+    # A refresh failed moments ago (possibly in another worker): don't retry the warehouse yet
+    snapshot = recently_failed_snapshot('hotels')
+    if snapshot:
+        return stale_snapshot_response('hotels', snapshot)
+
+    try:
+        # Query cities with highest star ratings
+        cities_query = f"""
+        SELECT
+            city,
+            AVG(star_rating) as avg_rating,
+            COUNT(*) as count
+        FROM {CATALOG}.{SCHEMA}.synced_hotels
+        WHERE city IS NOT NULL AND star_rating IS NOT NULL
+        GROUP BY city
+        ORDER BY avg_rating DESC
+        LIMIT 10
+        """
+
+        # Query average price by room type
+        room_prices_query = f"""
+        SELECT
+            room_type,
+            AVG(total_price) as avg_price,
+            COUNT(*) as count
+        FROM {CATALOG}.{SCHEMA}.synced_hotels
+        WHERE room_type IS NOT NULL AND total_price IS NOT NULL
+        GROUP BY room_type
+        ORDER BY avg_price DESC
+        """
+
+        # Query amenities breakdown
+        amenities_query = f"""
+        SELECT
+            CASE
+                WHEN free_breakfast = true AND free_cancellation = true THEN 'Both'
+                WHEN free_breakfast = true AND free_cancellation = false THEN 'Breakfast Only'
+                WHEN free_breakfast = false AND free_cancellation = true THEN 'Cancellation Only'
+                ELSE 'Neither'
+            END as type,
+            COUNT(*) as count
+        FROM {CATALOG}.{SCHEMA}.synced_hotels
+        GROUP BY type
+        """
+
+        # Query overall statistics
+        overall_query = f"""
+        SELECT
+            COUNT(*) as total_hotels,
+            AVG(star_rating) as avg_rating,
+            AVG(total_price) as avg_price
+        FROM {CATALOG}.{SCHEMA}.synced_hotels
+        WHERE star_rating IS NOT NULL AND total_price IS NOT NULL
+        """
+
+        # Execute cities query
+        cities_rows = _execute_query(cities_query, priority=caller_priority())
+
+        cities = []
+        if cities_rows:
+            for row in cities_rows:
+                cities.append({
+                    'city': row[0],
+                    'avg_rating': float(row[1]) if row[1] else 0,
+                    'count': int(row[2]) if row[2] else 0
+                })
+
+        # Execute room prices query
+        room_prices_rows = _execute_query(room_prices_query, priority=caller_priority())
+
+        room_prices = []
+        if room_prices_rows:
+            for row in room_prices_rows:
+                room_prices.append({
+                    'room_type': row[0],
+                    'avg_price': float(row[1]) if row[1] else 0,
+                    'count': int(row[2]) if row[2] else 0
+                })
+
+        # Execute amenities query
+        amenities_rows = _execute_query(amenities_query, priority=caller_priority())
+
+        amenities = []
+        if amenities_rows:
+            for row in amenities_rows:
+                amenities.append({
+                    'type': row[0],
+                    'count': int(row[1]) if row[1] else 0
+                })
+
+        # Execute overall query
+        overall_rows = _execute_query(overall_query, priority=caller_priority())
+
+        overall = {
+            'total_hotels': 0,
+            'avg_rating': 0,
+            'avg_price': 0
+        }
+        if overall_rows:
+            row = overall_rows[0]
+            overall = {
+                'total_hotels': int(row[0]) if row[0] else 0,
+                'avg_rating': float(row[1]) if row[1] else 0,
+                'avg_price': float(row[2]) if row[2] else 0
+            }
+
+        response_data = {
+            'cities': cities,
+            'room_prices': room_prices,
+            'amenities': amenities,
+            'overall': overall
+        }
+
+        # Cache the result against the table version it was computed from
+        response = set_cached_stats('hotels', response_data, version)
+        save_snapshot('hotels', response_data, version)
+
+        return response
+
+    except HandledError:
+        raise
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in hotel stats endpoint: {error_details}")
+        app.logger.error(f"Error in hotel stats endpoint: {str(e)}\n{error_details}")
+
+        # Serve the last successful result instead of failing the dashboard
+        return stale_snapshot_response('hotels', mark_snapshot_failed('hotels', str(e)), str(e))
+
+
+# ============================================================================
+# Route Price Index
+# ============================================================================
+# Per-route price statistics for every origin -> destination pair, held in
+# parallel typed arrays sorted by (origin, destination). Lookups and prefix
+# searches are bisections over those arrays, so type-ahead never touches the
+# warehouse. The index is rebuilt in the background when synced_flights changes.
+
+ROUTE_INDEX_REFRESH_INTERVAL = int(os.environ.get("ROUTE_INDEX_REFRESH_INTERVAL", "300"))
+ROUTE_SEARCH_LIMIT = 50
+
+_route_index = None
+_route_index_lock = threading.Lock()
+
+
+def _build_route_index():
+    """Load route and route x cabin aggregates and pack them into arrays"""
+    rows = _execute_query(f"""
+        SELECT
+            origin,
+            destination,
+            cabin_class,
+            COUNT(*) as flight_count,
+            MIN(price) as min_price,
+            AVG(price) as avg_price,
+            PERCENTILE_APPROX(price, 0.5) as p50_price,
+            PERCENTILE_APPROX(price, 0.9) as p90_price,
+            AVG(duration_minutes) as avg_duration,
+            GROUPING(cabin_class) as is_route_total
+        FROM {CATALOG}.{SCHEMA}.synced_flights
+        WHERE origin IS NOT NULL AND destination IS NOT NULL
+        GROUP BY GROUPING SETS ((origin, destination), (origin, destination, cabin_class))
+    """)
+
+    routes = {}
+    cabins = {}
+    for row in rows:
+        key = (row[0].upper(), row[1].upper())
+        if int(row[9]):
+            routes[key] = row
+        elif row[2] is not None:
+            cabins.setdefault(key, []).append(row)
+
+    keys = sorted(routes)
+    cabin_names = sorted({row[2] for cabin_rows in cabins.values() for row in cabin_rows})
+    cabin_codes = {name: code for code, name in enumerate(cabin_names)}
+
+    index = {
+        'origins': [key[0] for key in keys],
+        'destinations': [key[1] for key in keys],
+        'flight_count': array('I'),
+        'min_price': array('d'),
+        'avg_price': array('d'),
+        'p50_price': array('d'),
+        'p90_price': array('d'),
+        'avg_duration': array('d'),
+        # Cabin breakdown in CSR layout: route i owns cabin slots
+        # cabin_offsets[i]:cabin_offsets[i + 1]
+        'cabin_names': cabin_names,
+        'cabin_offsets': array('I', [0]),
+        'cabin_codes': array('H'),
+        'cabin_count': array('I'),
+        'cabin_avg_price': array('d'),
+        'version': get_table_versions().get('flights'),
+        'built_at': time.time()
+    }
+
+    for key in keys:
+        row = routes[key]
+        index['flight_count'].append(int(row[3]) if row[3] else 0)
+        index['min_price'].append(float(row[4]) if row[4] else 0)
+        index['avg_price'].append(float(row[5]) if row[5] else 0)
+        index['p50_price'].append(float(row[6]) if row[6] else 0)
+        index['p90_price'].append(float(row[7]) if row[7] else 0)
+        index['avg_duration'].append(float(row[8]) if row[8] else 0)
+        for cabin_row in sorted(cabins.get(key, []), key=lambda r: r[2]):
+            index['cabin_codes'].append(cabin_codes[cabin_row[2]])
+            index['cabin_count'].append(int(cabin_row[3]) if cabin_row[3] else 0)
+            index['cabin_avg_price'].append(float(cabin_row[5]) if cabin_row[5] else 0)
+        index['cabin_offsets'].append(len(index['cabin_codes']))
+
+    # Secondary ordering for destination-only prefix searches
+    index['by_destination'] = array('I', sorted(range(len(keys)), key=lambda i: (index['destinations'][i], index['origins'][i])))
+    index['sorted_destinations'] = [index['destinations'][i] for i in index['by_destination']]
+    return index
+
+
+def refresh_route_index(force=False):
+    """Rebuild the route index if synced_flights has changed since it was built"""
+    global _route_index
+
+    current = _route_index
+    version = get_table_versions().get('flights')
+    if current and not force and version is not None and current['version'] == version:
+        return current
+
+    with _route_index_lock:
+        if _route_index is not current:
+            return _route_index
+        started = time.perf_counter()
+        _route_index = _build_route_index()
+        print(f"DEBUG: Route index rebuilt with {len(_route_index['origins'])} routes "
+              f"in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return _route_index
+
+
+def _route_entry(index, i):
+    """Materialise the stats for route position i"""
+    start, end = index['cabin_offsets'][i], index['cabin_offsets'][i + 1]
+    return {
+        'origin': index['origins'][i],
+        'destination': index['destinations'][i],
+        'flight_count': index['flight_count'][i],
+        'min_price': index['min_price'][i],
+        'avg_price': round(index['avg_price'][i], 2),
+        'p50_price': index['p50_price'][i],
+        'p90_price': index['p90_price'][i],
+        'avg_duration': int(index['avg_duration'][i]),
+        'cabin_classes': [
+            {
+                'cabin_class': index['cabin_names'][index['cabin_codes'][j]],
+                'count': index['cabin_count'][j],
+                'avg_price': round(index['cabin_avg_price'][j], 2)
+            }
+            for j in range(start, end)
+        ]
+    }
+
+
+def _prefix_range(sorted_values, prefix):
+    """Return the [start, end) slice of sorted_values that starts with prefix"""
+    start = bisect.bisect_left(sorted_values, prefix)
+    end = bisect.bisect_left(sorted_values, prefix + '\uffff')
+    return start, end
+
+
+def search_routes(index, origin, destination, limit):
+    """Find routes whose origin/destination codes start with the given prefixes"""
+    if origin:
+        start, end = _prefix_range(index['origins'], origin)
+        positions = (i for i in range(start, end) if index['destinations'][i].startswith(destination))
+    elif destination:
+        start, end = _prefix_range(index['sorted_destinations'], destination)
+        positions = (index['by_destination'][i] for i in range(start, end))
+    else:
+        positions = range(len(index['origins']))
+
+    top = heapq.nlargest(limit, positions, key=lambda i: index['flight_count'][i])
+    return [_route_entry(index, i) for i in top]
+
+
+@app.route('/api/flights/routes', methods=['GET'])
+def get_flight_routes():
+    """Look up price statistics for an origin -> destination pair, with prefix search on airport codes"""
+    origin = request.args.get('origin', '').strip().upper()
+    destination = request.args.get('destination', '').strip().upper()
+    try:
+        limit = min(max(int(request.args.get('limit', 10)), 1), ROUTE_SEARCH_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    try:
+        index = _route_index or refresh_route_index()
+        ensure_background_task('route-index', refresh_route_index, ROUTE_INDEX_REFRESH_INTERVAL)
+
+        started = time.perf_counter()
+        routes = search_routes(index, origin, destination, limit)
+        exact = [route for route in routes if route['origin'] == origin and route['destination'] == destination]
+        if exact:
+            routes = exact + [route for route in routes if route is not exact[0]]
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        return jsonify({
+            'routes': routes,
+            'exact_match': bool(exact),
+            'total_routes': len(index['origins']),
+            'index_built_at': index['built_at'],
+            'lookup_ms': round(elapsed_ms, 3)
+        })
+
+    except HandledError:
+        raise
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in flight routes endpoint: {error_details}")
+        app.logger.error(f"Error in flight routes endpoint: {str(e)}\n{error_details}")
+        return jsonify({'error': f'Route lookup failed: {str(e)}'}), 500
+
+
+# ============================================================================
+# Hotel Search
+# ============================================================================
+# Columnar in-memory snapshot of synced_hotels. Equality filters (city, room
+# type, star rating, amenities) are precomputed bitmaps held as Python ints, so
+# combining them is a handful of C-level ANDs. Price and rating orderings are
+# precomputed position arrays: top-k walks the requested order and stops after
+# k matches, testing each row against the combined bitmap in O(1).
+
+HOTEL_SEARCH_REFRESH_INTERVAL = int(os.environ.get("HOTEL_SEARCH_REFRESH_INTERVAL", "600"))
+HOTEL_SEARCH_MAX_RESULTS = 100
+
+_hotel_snapshot = None
+_hotel_snapshot_lock = threading.Lock()
+
+
+def _build_hotel_snapshot():
+    """Load synced_hotels into column arrays and build the bitmap/sorted indexes"""
+    response = _run_statement(f"""
+        SELECT hotel_id, hotel_name, city, star_rating, room_type, total_price, free_breakfast, free_cancellation
+        FROM {CATALOG}.{SCHEMA}.synced_hotels
+    """, disposition='EXTERNAL_LINKS', result_format='JSON_ARRAY')
+
+    snapshot = {
+        'hotel_id': [],
+        'hotel_name': [],
+        'city': [],
+        'room_type': [],
+        'star_rating': array('d'),
+        'total_price': array('d'),
+        'city_bitmaps': {},
+        'room_type_bitmaps': {},
+        'star_bitmaps': {},
+        'free_breakfast_bitmap': 0,
+        'free_cancellation_bitmap': 0,
+        'version': get_table_versions().get('hotels'),
+        'built_at': time.time()
+    }
+
+    # Bitmaps are accumulated as lists of positions and packed once at the end
+    city_positions = {}
+    room_type_positions = {}
+    star_positions = {}
+    breakfast_positions = []
+    cancellation_positions = []
+
+    position = 0
+    for rows in _iter_external_row_batches(response):
+        for row in rows:
+            snapshot['hotel_id'].append(row[0])
+            snapshot['hotel_name'].append(row[1])
+            snapshot['city'].append(row[2])
+            snapshot['room_type'].append(row[4])
+            snapshot['star_rating'].append(float(row[3]) if row[3] is not None else float('nan'))
+            snapshot['total_price'].append(float(row[5]) if row[5] is not None else float('nan'))
+
+            if row[2]:
+                city_positions.setdefault(row[2].lower(), []).append(position)
+            if row[4]:
+                room_type_positions.setdefault(row[4].lower(), []).append(position)
+            if row[3] is not None:
+                star_positions.setdefault(float(row[3]), []).append(position)
+            if str(row[6]).lower() == 'true':
+                breakfast_positions.append(position)
+            if str(row[7]).lower() == 'true':
+                cancellation_positions.append(position)
+            position += 1
+
+    snapshot['size'] = position
+    snapshot['city_bitmaps'] = {key: _pack_bitmap(p, position) for key, p in city_positions.items()}
+    snapshot['room_type_bitmaps'] = {key: _pack_bitmap(p, position) for key, p in room_type_positions.items()}
+    snapshot['star_bitmaps'] = {key: _pack_bitmap(p, position) for key, p in star_positions.items()}
+    snapshot['free_breakfast_bitmap'] = _pack_bitmap(breakfast_positions, position)
+    snapshot['free_cancellation_bitmap'] = _pack_bitmap(cancellation_positions, position)
+
+    # Sorted orderings (NULLs excluded) for range filters and top-k
+    prices = snapshot['total_price']
+    ratings = snapshot['star_rating']
+    snapshot['by_price'] = array('I', sorted((i for i in range(position) if prices[i] == prices[i]), key=prices.__getitem__))
+    snapshot['sorted_prices'] = array('d', (prices[i] for i in snapshot['by_price']))
+    snapshot['by_rating'] = array('I', sorted((i for i in range(position) if ratings[i] == ratings[i]),
+                                              key=lambda i: (-ratings[i], prices[i])))
+    return snapshot
+
+
+def _pack_bitmap(positions, size):
+    """Pack row positions into an int bitmap (bit i set => row i matches)"""
+    bits = bytearray((size + 7) // 8)
+    for i in positions:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def refresh_hotel_snapshot(force=False):
+    """Rebuild the hotel snapshot if synced_hotels has changed since it was loaded"""
+    global _hotel_snapshot
+
+    current = _hotel_snapshot
+    version = get_table_versions().get('hotels')
+    if current and not force and version is not None and current['version'] == version:
+        return current
+
+    with _hotel_snapshot_lock:
+        if _hotel_snapshot is not current:
+            return _hotel_snapshot
+        started = time.perf_counter()
+        _hotel_snapshot = _build_hotel_snapshot()
+        print(f"DEBUG: Hotel snapshot rebuilt with {_hotel_snapshot['size']} rows "
+              f"in {(time.perf_counter() - started) * 1000:.0f}ms")
+        return _hotel_snapshot
+
+
+def _nan_to_none(value):
+    """Map the snapshot's NaN placeholder for NULL back to None so it serializes as null"""
+    return None if math.isnan(value) else value
+
+
+def search_hotels(snapshot, filters, sort, k):
+    """Return (total matches, top-k hotel dicts) for the given filters"""
+    size = snapshot['size']
+    mask = (1 << size) - 1
+
+    if filters.get('city'):
+        mask &= snapshot['city_bitmaps'].get(filters['city'].lower(), 0)
+    if filters.get('room_type'):
+        mask &= snapshot['room_type_bitmaps'].get(filters['room_type'].lower(), 0)
+    if filters.get('free_breakfast'):
+        mask &= snapshot['free_breakfast_bitmap']
+    if filters.get('free_cancellation'):
+        mask &= snapshot['free_cancellation_bitmap']
+    if filters.get('min_stars') is not None or filters.get('max_stars') is not None:
+        min_stars = filters.get('min_stars', float('-inf'))
+        max_stars = filters.get('max_stars', float('inf'))
+        star_mask = 0
+        for stars, bitmap in snapshot['star_bitmaps'].items():
+            if min_stars <= stars <= max_stars:
+                star_mask |= bitmap
+        mask &= star_mask
+
+    bits = mask.to_bytes((size + 7) // 8, 'little')
+
+    def matches(i):
+        return bits[i >> 3] >> (i & 7) & 1
+
+    prices = snapshot['total_price']
+    min_price = filters.get('min_price')
+    max_price = filters.get('max_price')
+    has_price_filter = min_price is not None or max_price is not None
+
+    # Candidate ordering: the price range is a contiguous slice of the price order
+    start, end = 0, len(snapshot['by_price'])
+    if min_price is not None:
+        start = bisect.bisect_left(snapshot['sorted_prices'], min_price)
+    if max_price is not None:
+        end = bisect.bisect_right(snapshot['sorted_prices'], max_price)
+
+    if has_price_filter:
+        total = sum(1 for j in range(start, end) if matches(snapshot['by_price'][j]))
+    else:
+        total = mask.bit_count()
+
+    if sort == 'rating':
+        ordered = snapshot['by_rating']
+        in_range = (lambda i: (min_price is None or prices[i] >= min_price) and
+                    (max_price is None or prices[i] <= max_price))
+    else:
+        ordered = snapshot['by_price'][start:end]
+        in_range = None
+
+    results = []
+    for i in ordered:
+        if matches(i) and (in_range is None or in_range(i)):
+            results.append({
+                'hotel_id': snapshot['hotel_id'][i],
+                'hotel_name': snapshot['hotel_name'][i],
+                'city': snapshot['city'][i],
+                'star_rating': _nan_to_none(snapshot['star_rating'][i]),
+                'room_type': snapshot['room_type'][i],
+                'total_price': _nan_to_none(prices[i])
+            })
+            if len(results) >= k:
+                break
+
+    return total, results
+
+
+@app.route('/api/hotels/search', methods=['GET'])
+def hotel_search():
+    """Search hotels by city, stars, price, room type and amenities, returning the top-k"""
+    def parse_float(name):
+        value = request.args.get(name, '').strip()
+        return float(value) if value else None
+
+    try:
+        filters = {
+            'city': request.args.get('city', '').strip(),
+            'room_type': request.args.get('room_type', '').strip(),
+            'free_breakfast': request.args.get('free_breakfast', '').lower() == 'true',
+            'free_cancellation': request.args.get('free_cancellation', '').lower() == 'true',
+            'min_stars': parse_float('min_stars'),
+            'max_stars': parse_float('max_stars'),
+            'min_price': parse_float('min_price'),
+            'max_price': parse_float('max_price')
+        }
+        filters = {key: value for key, value in filters.items() if value is not None and value != '' and value is not False}
+        k = min(max(int(request.args.get('k', 20)), 1), HOTEL_SEARCH_MAX_RESULTS)
+    except ValueError:
+        return jsonify({'error': 'Numeric filters must be numbers'}), 400
+
+    sort = request.args.get('sort', 'price')
+    if sort not in ('price', 'rating'):
+        return jsonify({'error': f'Unknown sort: {sort}'}), 400
+
+    try:
+        snapshot = _hotel_snapshot or refresh_hotel_snapshot()
+        ensure_background_task('hotel-snapshot', refresh_hotel_snapshot, HOTEL_SEARCH_REFRESH_INTERVAL)
+
+        started = time.perf_counter()
+        total, hotels = search_hotels(snapshot, filters, sort, k)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        return jsonify({
+            'hotels': hotels,
+            'total_matches': total,
+            'sort': sort,
+            'filters': filters,
+            'snapshot_built_at': snapshot['built_at'],
+            'search_ms': round(elapsed_ms, 3)
+        })
+
+    except HandledError:
+        raise
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in hotel search endpoint: {error_details}")
+        app.logger.error(f"Error in hotel search endpoint: {str(e)}\n{error_details}")
+        return jsonify({'error': f'Hotel search failed: {str(e)}'}), 500
+
+
+# ============================================================================
+# Review Search
+# ============================================================================
+# Full-text search over synced_reviews. The inverted index lives on disk under
+# HUB_DATA_DIR as immutable segment files plus a manifest. Every worker mmaps
+# the same segment files, so the OS page cache holds a single copy. One worker
+# at a time (flock) appends a segment containing only reviews newer than the
+# manifest watermark; small segments are compacted locally once there are too
+# many, streaming records and one term's postings at a time. Compacted-away
+# segment files are kept until the next manifest write, so a worker that read
+# the previous manifest can still open them. Posting lists are varint
+# delta-encoded (doc gap, term frequency) pairs ranked with BM25; filters are
+# checked on the doc records and only the top k documents are decoded.
+#
+# Segment layout (little-endian):
+#   header | doc records | term records (sorted by term) | postings | strings
+
+REVIEW_TEXT_COLUMN = os.environ.get("REVIEW_TEXT_COLUMN", "review_text")
+REVIEW_INDEX_REFRESH_INTERVAL = int(os.environ.get("REVIEW_INDEX_REFRESH_INTERVAL", "600"))
+REVIEW_INDEX_MAX_SEGMENTS = int(os.environ.get("REVIEW_INDEX_MAX_SEGMENTS", "8"))
+REVIEW_SEARCH_MAX_RESULTS = 100
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_REVIEW_SEGMENT_MAGIC = b'RVIDX001'
+_REVIEW_SEGMENT_HEADER = struct.Struct('<8sIIQQQQQ')
+# length, rating, review_date (epoch days), then (offset, length) string refs for
+# review_id, company_name, item_type, review text
+_REVIEW_DOC_RECORD = struct.Struct('<IBiQHQHQHQI')
+# term (offset, length), document frequency, postings (offset, length)
+_REVIEW_TERM_RECORD = struct.Struct('<QHIQI')
+
+_REVIEW_STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have i in is it its of on or our so that the their '
+    'this to was we were with you'.split()
+)
+
+_review_index = None
+_review_index_lock = threading.Lock()
+
+
+def _review_index_path(name):
+    return os.path.join(HUB_DATA_DIR, 'review_index', name)
+
+
+def _tokenize(text):
+    return [token for token in re.findall(r"[a-z0-9]+", (text or '').lower()) if token not in _REVIEW_STOPWORDS]
+
+
+def _encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_postings(buffer):
+    """Yield (doc_id, term_frequency) pairs from a delta/varint encoded posting list"""
+    doc_id = 0
+    numbers = []
+    value = shift = 0
+    for byte in buffer:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        numbers.append(value)
+        value = shift = 0
+        if len(numbers) == 2:
+            doc_id += numbers[0]
+            yield doc_id, numbers[1]
+            numbers = []
+
+
+def _write_review_segment(path, docs):
+    """Write docs (dicts with review_id, text, rating, company_name, item_type, review_date) as a segment"""
+    strings = bytearray()
+
+    def add_string(value):
+        encoded = (value or '').encode()
+        offset = len(strings)
+        strings.extend(encoded)
+        return offset, len(encoded)
+
+    doc_records = bytearray()
+    postings_by_term = {}
+    total_length = 0
+    for doc_id, doc in enumerate(docs):
+        tokens = _tokenize(doc['text'])
+        total_length += len(tokens)
+        term_counts = {}
+        for token in tokens:
+            term_counts[token] = term_counts.get(token, 0) + 1
+        for term, tf in term_counts.items():
+            postings_by_term.setdefault(term, []).append((doc_id, tf))
+
+        review_date = -1
+        if doc['review_date']:
+            review_date = (date.fromisoformat(doc['review_date'][:10]) - date(1970, 1, 1)).days
+        doc_records.extend(_REVIEW_DOC_RECORD.pack(
+            len(tokens),
+            int(float(doc['rating'])) if doc['rating'] is not None else 0,
+            review_date,
+            *add_string(doc['review_id']),
+            *add_string(doc['company_name']),
+            *add_string(doc['item_type']),
+            *add_string(doc['text'])
+        ))
+
+    term_records = bytearray()
+    postings = bytearray()
+    for term in sorted(postings_by_term, key=str.encode):
+        entries = postings_by_term[term]
+        postings_offset = len(postings)
+        previous = 0
+        for doc_id, tf in entries:
+            _encode_varint(doc_id - previous, postings)
+            _encode_varint(tf, postings)
+            previous = doc_id
+        term_records.extend(_REVIEW_TERM_RECORD.pack(
+            *add_string(term), len(entries), postings_offset, len(postings) - postings_offset
+        ))
+
+    docs_offset = _REVIEW_SEGMENT_HEADER.size
+    terms_offset = docs_offset + len(doc_records)
+    postings_offset = terms_offset + len(term_records)
+    strings_offset = postings_offset + len(postings)
+    header = _REVIEW_SEGMENT_HEADER.pack(
+        _REVIEW_SEGMENT_MAGIC, len(docs), len(postings_by_term), total_length,
+        docs_offset, terms_offset, postings_offset, strings_offset
+    )
+
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        for part in (header, doc_records, term_records, postings, strings):
+            f.write(part)
+    os.replace(temp_path, path)
+
+
+class _ReviewSegment:
+    """Read-only, memory-mapped view of one review index segment"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.doc_count, self.term_count, self.total_length,
+         self.docs_offset, self.terms_offset, self.postings_offset, self.strings_offset) = \
+            _REVIEW_SEGMENT_HEADER.unpack_from(self.data, 0)
+        if magic != _REVIEW_SEGMENT_MAGIC:
+            raise ValueError(f"Not a review index segment: {path}")
+
+    def string(self, offset, length):
+        start = self.strings_offset + offset
+        return self.data[start:start + length].decode()
+
+    def _term_at(self, i):
+        return _REVIEW_TERM_RECORD.unpack_from(self.data, self.terms_offset + i * _REVIEW_TERM_RECORD.size)
+
+    def lookup(self, term):
+        """Return (document frequency, encoded postings) for a term, or (0, b'')"""
+        target = term.encode()
+        low, high = 0, self.term_count
+        while low < high:
+            mid = (low + high) // 2
+            term_offset, term_length, df, postings_offset, postings_length = self._term_at(mid)
+            start = self.strings_offset + term_offset
+            candidate = self.data[start:start + term_length]
+            if candidate < target:
+                low = mid + 1
+            elif candidate > target:
+                high = mid
+            else:
+                start = self.postings_offset + postings_offset
+                return df, self.data[start:start + postings_length]
+        return 0, b''
+
+    def doc_length(self, doc_id):
+        return struct.unpack_from('<I', self.data, self.docs_offset + doc_id * _REVIEW_DOC_RECORD.size)[0]
+
+    def terms(self):
+        """Yield (term, document frequency, encoded postings) in term order"""
+        for i in range(self.term_count):
+            term_offset, term_length, df, postings_offset, postings_length = self._term_at(i)
+            term_start = self.strings_offset + term_offset
+            start = self.postings_offset + postings_offset
+            yield self.data[term_start:term_start + term_length], df, self.data[start:start + postings_length]
+
+    def filter_fields(self, doc_id):
+        """(rating, company_name, item_type) of a doc, without decoding its text"""
+        record = _REVIEW_DOC_RECORD.unpack_from(self.data, self.docs_offset + doc_id * _REVIEW_DOC_RECORD.size)
+        return record[1] or None, self.string(record[5], record[6]), self.string(record[7], record[8])
+
+    def doc(self, doc_id):
+        (length, rating, review_date, id_offset, id_length, company_offset, company_length,
+         item_type_offset, item_type_length, text_offset, text_length) = \
+            _REVIEW_DOC_RECORD.unpack_from(self.data, self.docs_offset + doc_id * _REVIEW_DOC_RECORD.size)
+        return {
+            'review_id': self.string(id_offset, id_length),
+            'rating': rating or None,
+            'company_name': self.string(company_offset, company_length),
+            'item_type': self.string(item_type_offset, item_type_length),
+            'review_date': (date(1970, 1, 1) + timedelta(days=review_date)).isoformat() if review_date >= 0 else None,
+            'text': self.string(text_offset, text_length),
+            'length': length
+        }
+
+
+def _read_review_manifest():
+    try:
+        with open(_review_index_path('manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_review_manifest(manifest):
+    path = _review_index_path('manifest.json')
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, path)
+
+
+def _merge_review_segments(segments, path):
+    """Write segments with disjoint docs as one segment, streaming through temporary files.
+
+    Docs are renumbered by concatenation and each term's posting lists are
+    joined in segment order, so only one term's postings are in memory at a time.
+    """
+    directory = os.path.dirname(path)
+    with tempfile.TemporaryFile(dir=directory) as doc_records, \
+            tempfile.TemporaryFile(dir=directory) as term_records, \
+            tempfile.TemporaryFile(dir=directory) as postings, \
+            tempfile.TemporaryFile(dir=directory) as strings:
+
+        def add_string(value):
+            offset = strings.tell()
+            strings.write(value)
+            return offset, len(value)
+
+        doc_bases = []
+        doc_count = total_length = 0
+        for segment in segments:
+            doc_bases.append(doc_count)
+            doc_count += segment.doc_count
+            total_length += segment.total_length
+            for doc_id in range(segment.doc_count):
+                length, rating, review_date, *refs = _REVIEW_DOC_RECORD.unpack_from(
+                    segment.data, segment.docs_offset + doc_id * _REVIEW_DOC_RECORD.size
+                )
+                copied = []
+                for offset, size in zip(refs[::2], refs[1::2]):
+                    start = segment.strings_offset + offset
+                    copied.extend(add_string(segment.data[start:start + size]))
+                doc_records.write(_REVIEW_DOC_RECORD.pack(length, rating, review_date, *copied))
+
+        def tagged_terms(number, segment):
+            for term, df, encoded in segment.terms():
+                yield term, number, df, encoded
+
+        def write_term(term, df, encoded):
+            term_records.write(_REVIEW_TERM_RECORD.pack(*add_string(term), df, postings.tell(), len(encoded)))
+            postings.write(encoded)
+
+        term_count = 0
+        term = df = encoded = previous = None
+        for next_term, number, next_df, next_postings in heapq.merge(
+                *(tagged_terms(number, segment) for number, segment in enumerate(segments))):
+            if next_term != term:
+                if term is not None:
+                    write_term(term, df, encoded)
+                    term_count += 1
+                term, df, encoded, previous = next_term, 0, bytearray(), 0
+            df += next_df
+            for doc_id, tf in _decode_postings(next_postings):
+                doc_id += doc_bases[number]
+                _encode_varint(doc_id - previous, encoded)
+                _encode_varint(tf, encoded)
+                previous = doc_id
+        if term is not None:
+            write_term(term, df, encoded)
+            term_count += 1
+
+        docs_offset = _REVIEW_SEGMENT_HEADER.size
+        terms_offset = docs_offset + doc_records.tell()
+        postings_offset = terms_offset + term_records.tell()
+        strings_offset = postings_offset + postings.tell()
+        header = _REVIEW_SEGMENT_HEADER.pack(
+            _REVIEW_SEGMENT_MAGIC, doc_count, term_count, total_length,
+            docs_offset, terms_offset, postings_offset, strings_offset
+        )
+
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(header)
+            for part in (doc_records, term_records, postings, strings):
+                part.seek(0)
+                shutil.copyfileobj(part, f)
+    os.replace(temp_path, path)
+
+
+def _compact_review_segments(manifest):
+    """Merge all segments into one; docs are disjoint across segments so this is a concatenation.
+
+    The old segment files are only retired: update_review_index removes them
+    on its next manifest write.
+    """
+    name = f"segment-{manifest['next_segment']:06d}.idx"
+    _merge_review_segments([_ReviewSegment(_review_index_path(old_name)) for old_name in manifest['segments']],
+                           _review_index_path(name))
+    old_segments = manifest['segments']
+    manifest['segments'] = [name]
+    manifest['retired'] = manifest.get('retired', []) + old_segments
+    manifest['next_segment'] += 1
+    _write_review_manifest(manifest)
+    print(f"DEBUG: Compacted {len(old_segments)} review index segments into {name}")
+
+
+def _remove_review_segments(names):
+    # Workers that still map the files keep reading them until they reload
+    for name in names:
+        try:
+            os.remove(_review_index_path(name))
+        except FileNotFoundError:
+            pass
+
+
+def update_review_index(wait=False):
+    """Append a segment with reviews newer than the watermark (one worker at a time)"""
+    os.makedirs(_review_index_path(''), exist_ok=True)
+    with open(_review_index_path('update.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return
+
+        manifest = _read_review_manifest() or {
+            'segments': [], 'next_segment': 0, 'watermark': None, 'watermark_ids': [], 'version': None
+        }
+        if wait and manifest['segments']:
+            return
+
+        version = get_table_versions().get('reviews')
+        if manifest['segments'] and version is not None and manifest['version'] == version:
+            return
+
+        # Re-read the watermark day itself and skip the reviews already indexed for it
+        where_conditions = [f"{REVIEW_TEXT_COLUMN} IS NOT NULL"]
+        if manifest['watermark']:
+            where_conditions.append(f"review_date >= DATE '{manifest['watermark']}'")
+
+        response = _run_statement(f"""
+            SELECT review_id, {REVIEW_TEXT_COLUMN}, rating, company_name, item_type, CAST(CAST(review_date AS DATE) AS STRING)
+            FROM {CATALOG}.{SCHEMA}.synced_reviews
+            WHERE {' AND '.join(where_conditions)}
+        """, disposition='EXTERNAL_LINKS', result_format='JSON_ARRAY')
+
+        already_indexed = set(manifest['watermark_ids'])
+        docs = []
+        for rows in _iter_external_row_batches(response):
+            for row in rows:
+                if str(row[0]) in already_indexed:
+                    continue
+                docs.append({
+                    'review_id': str(row[0]), 'text': row[1], 'rating': row[2],
+                    'company_name': row[3], 'item_type': row[4], 'review_date': row[5]
+                })
+
+        if docs:
+            name = f"segment-{manifest['next_segment']:06d}.idx"
+            _write_review_segment(_review_index_path(name), docs)
+            manifest['segments'].append(name)
+            manifest['next_segment'] += 1
+
+            dated = [doc for doc in docs if doc['review_date']]
+            if dated:
+                watermark = max(doc['review_date'] for doc in dated)
+                ids = [doc['review_id'] for doc in dated if doc['review_date'] == watermark]
+                if watermark == manifest['watermark']:
+                    ids.extend(manifest['watermark_ids'])
+                manifest['watermark'] = watermark
+                manifest['watermark_ids'] = ids
+
+        manifest['version'] = version
+        retired = manifest.pop('retired', [])
+        _write_review_manifest(manifest)
+        # Retired by an earlier compaction; every reader has re-read the manifest since
+        _remove_review_segments(retired)
+        print(f"DEBUG: Review index appended {len(docs)} reviews ({len(manifest['segments'])} segments)")
+
+        if len(manifest['segments']) > REVIEW_INDEX_MAX_SEGMENTS:
+            _compact_review_segments(manifest)
+
+
+def _load_review_index():
+    """Return this worker's view of the index, re-mapping segments when the manifest changes"""
+    global _review_index
+
+    try:
+        manifest_mtime = os.stat(_review_index_path('manifest.json')).st_mtime
+    except FileNotFoundError:
+        update_review_index(wait=True)
+        manifest_mtime = os.stat(_review_index_path('manifest.json')).st_mtime
+
+    if _review_index and _review_index['mtime'] == manifest_mtime:
+        return _review_index
+
+    with _review_index_lock:
+        if _review_index and _review_index['mtime'] == manifest_mtime:
+            return _review_index
+
+        manifest = _read_review_manifest()
+        previous = {name: segment for name, segment in (_review_index or {}).get('segments', [])}
+        segments = [(name, previous.get(name) or _ReviewSegment(_review_index_path(name)))
+                    for name in manifest['segments']]
+        doc_count = sum(segment.doc_count for _, segment in segments)
+        _review_index = {
+            'mtime': manifest_mtime,
+            'segments': segments,
+            'doc_count': doc_count,
+            'avg_length': sum(segment.total_length for _, segment in segments) / doc_count if doc_count else 0,
+            'watermark': manifest['watermark']
+        }
+        return _review_index
+
+
+def search_reviews(index, query, filters, k):
+    """BM25-rank reviews matching the query terms, applying rating/company/item type filters"""
+    doc_count = index['doc_count']
+    avg_length = index['avg_length'] or 1
+    scores = {}
+
+    for term in set(_tokenize(query)):
+        lookups = [(segment_number, segment, *segment.lookup(term))
+                   for segment_number, (_, segment) in enumerate(index['segments'])]
+        df = sum(lookup[2] for lookup in lookups)
+        if not df:
+            continue
+        idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+
+        for segment_number, segment, _, postings in lookups:
+            for doc_id, tf in _decode_postings(postings):
+                length = segment.doc_length(doc_id)
+                score = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+                key = (segment_number, doc_id)
+                scores[key] = scores.get(key, 0) + score
+
+    def matches(key):
+        rating, company_name, item_type = index['segments'][key[0]][1].filter_fields(key[1])
+        if filters.get('rating') is not None and rating != filters['rating']:
+            return False
+        if filters.get('min_rating') is not None and (rating or 0) < filters['min_rating']:
+            return False
+        if filters.get('company_name') and company_name.lower() != filters['company_name'].lower():
+            return False
+        if filters.get('item_type') and item_type.lower() != filters['item_type'].lower():
+            return False
+        return True
+
+    # Filter and rank on the doc records; only the top k documents are decoded
+    candidates = scores.items()
+    if any(value is not None and value != '' for value in filters.values()):
+        candidates = [(key, score) for key, score in candidates if matches(key)]
+    else:
+        candidates = list(candidates)
+
+    results = []
+    for (segment_number, doc_id), score in heapq.nlargest(k, candidates, key=lambda item: item[1]):
+        doc = index['segments'][segment_number][1].doc(doc_id)
+        doc.pop('length')
+        doc['score'] = round(score, 4)
+        results.append(doc)
+
+    return len(candidates), results
+
+
+@app.route('/api/reviews/search', methods=['GET'])
+def review_search():
+    """Full-text search over review text with BM25 ranking and rating/company/item type filters"""
+    query = request.args.get('q', '').strip()
+    if not _tokenize(query):
+        return jsonify({'error': 'Please enter a search query'}), 400
+
+    try:
+        filters = {
+            'rating': int(request.args['rating']) if request.args.get('rating') else None,
+            'min_rating': int(request.args['min_rating']) if request.args.get('min_rating') else None,
+            'company_name': request.args.get('company', '').strip(),
+            'item_type': request.args.get('item_type', '').strip()
+        }
+        k = min(max(int(request.args.get('k', 20)), 1), REVIEW_SEARCH_MAX_RESULTS)
+    except ValueError:
+        return jsonify({'error': 'rating, min_rating and k must be integers'}), 400
+
+    try:
+        index = _load_review_index()
+        ensure_background_task('review-index', update_review_index, REVIEW_INDEX_REFRESH_INTERVAL)
+
+        started = time.perf_counter()
+        total, reviews = search_reviews(index, query, filters, k)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        return jsonify({
+            'query': query,
+            'reviews': reviews,
+            'total_matches': total,
+            'indexed_reviews': index['doc_count'],
+            'indexed_through': index['watermark'],
+            'search_ms': round(elapsed_ms, 3)
+        })
+
+    except HandledError:
+        raise
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in review search endpoint: {error_details}")
+        app.logger.error(f"Error in review search endpoint: {str(e)}\n{error_details}")
+        return jsonify({'error': f'Review search failed: {str(e)}'}), 500
+
+
+# ============================================================================
+# Travel Trends API
+# ============================================================================
+# Daily rollups per dataset are kept in memory and maintained incrementally:
+# when the table version moves, only the days its change feed shows as touched
+# (inserts, updates and deletes, whatever their date) are re-aggregated; without
+# a change feed the whole table is. Weekly/monthly series are derived from the
+# daily buckets, and long ranges are downsampled with LTTB.
+
+# Dataset -> date column and the metrics averaged per period
+TREND_SOURCES = {
+    'flights': {'date_column': 'departure_date', 'metrics': {'price': 'price'}},
+    'hotels': {'date_column': 'check_in_date', 'metrics': {'price': 'total_price', 'rating': 'star_rating'}},
+    'packages': {'date_column': 'departure_date', 'metrics': {'price': 'final_price'}},
+    'reviews': {'date_column': 'review_date', 'metrics': {'rating': 'rating'}}
+}
+
+TRENDS_REFRESH_INTERVAL = int(os.environ.get("TRENDS_REFRESH_INTERVAL", "600"))
+TRENDS_MAX_POINTS = int(os.environ.get("TRENDS_MAX_POINTS", "500"))
+
+# dataset -> {'days': {date: {...sums}}, 'version': ..., 'time': ...}
+_trend_rollups = {}
+_trend_rollup_locks = {dataset: threading.Lock() for dataset in TREND_SOURCES}
+
+
+def _refresh_trend_rollup(dataset):
+    """Re-aggregate the days changed since the daily rollup's version (all days on the first build)"""
+    source = TREND_SOURCES[dataset]
+    rollup = _trend_rollups.get(dataset)
+    version = get_table_versions().get(dataset)
+
+    if rollup:
+        age = time.time() - rollup['time']
+        if (version is not None and rollup['version'] == version) or \
+                (version is None and age < TRENDS_REFRESH_INTERVAL):
+            count_cache_hit(f'trends:{dataset}')
+            return rollup
+
+    # Another request is already refreshing; serve the current rollup meanwhile
+    lock = _trend_rollup_locks[dataset]
+    if not lock.acquire(blocking=rollup is None):
+        return rollup
+
+    try:
+        if rollup is None and dataset in _trend_rollups:
+            return _trend_rollups[dataset]
+
+        rollup = _trend_rollups.get(dataset) or {'days': {}, 'version': None, 'time': 0}
+        date_column = source['date_column']
+
+        metric_columns = []
+        for metric, column in source['metrics'].items():
+            metric_columns.append(f"SUM({column}) as {metric}_sum")
+            metric_columns.append(f"COUNT({column}) as {metric}_count")
+
+        days = dict(rollup['days'])
+        changed = None
+        if days and version is not None and rollup['version'] is not None:
+            changed = table_changed_days(dataset, rollup['version'], f"CAST({date_column} AS DATE)")
+
+        where_conditions = [f"{date_column} IS NOT NULL"]
+        if changed is None:
+            days = {}
+        else:
+            changed = [day for day in changed if day]
+            # Days whose rows were all deleted must not keep their old buckets
+            for day in changed:
+                days.pop(day, None)
+            where_conditions.append(f"({_rollup_day_filter(f'CAST({date_column} AS DATE)', changed)})")
+
+        rows = []
+        if changed != []:
+            rows = _execute_query(f"""
+                SELECT
+                    CAST(CAST({date_column} AS DATE) AS STRING) as day,
+                    COUNT(*) as volume,
+                    {', '.join(metric_columns)}
+                FROM {CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}
+                WHERE {' AND '.join(where_conditions)}
+                GROUP BY CAST({date_column} AS DATE)
+            """)
+
+        for row in rows:
+            bucket = {'volume': int(row[1]) if row[1] else 0}
+            for index, metric in enumerate(source['metrics']):
+                bucket[f'{metric}_sum'] = float(row[2 + index * 2]) if row[2 + index * 2] else 0
+                bucket[f'{metric}_count'] = int(row[3 + index * 2]) if row[3 + index * 2] else 0
+            days[row[0]] = bucket
+
+        _trend_rollups[dataset] = {
+            'days': days,
+            'version': version,
+            'time': time.time()
+        }
+        scope = 'all days' if changed is None else f"{len(changed)} changed days"
+        print(f"DEBUG: Trend rollup for {dataset} re-aggregated {scope}: {len(rows)} rows ({len(days)} days total)")
+        return _trend_rollups[dataset]
+    finally:
+        lock.release()
+
+
+def _trend_period(day, granularity):
+    """Map a YYYY-MM-DD day onto the start of its daily/weekly/monthly period"""
+    if granularity == 'monthly':
+        return day[:8] + '01'
+    if granularity == 'weekly':
+        parsed = date.fromisoformat(day)
+        return (parsed - timedelta(days=parsed.weekday())).isoformat()
+    return day
+
+
+def _lttb(points, threshold):
+    """Downsample (x, y, payload) points with Largest-Triangle-Three-Buckets"""
+    if threshold >= len(points) or threshold < 3:
+        return points
+
+    sampled = [points[0]]
+    bucket_size = (len(points) - 2) / (threshold - 2)
+    previous = 0
+
+    for i in range(threshold - 2):
+        bucket_start = int(i * bucket_size) + 1
+        bucket_end = int((i + 1) * bucket_size) + 1
+
+        # Average of the next bucket is the third triangle vertex
+        next_start = bucket_end
+        next_end = min(int((i + 2) * bucket_size) + 1, len(points))
+        next_bucket = points[next_start:next_end] or [points[-1]]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+
+        ax, ay = points[previous][0], points[previous][1]
+        best_area = -1
+        best_index = bucket_start
+        for j in range(bucket_start, bucket_end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - points[j][0]) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best_index = j
+
+        sampled.append(points[best_index])
+        previous = best_index
+
+    sampled.append(points[-1])
+    return sampled
+
+
+@app.route('/api/trends', methods=['GET'])
+def get_trends():
+    """Get daily/weekly/monthly volume, price and rating series for the Travel Trends page"""
+    try:
+        dataset = request.args.get('dataset', 'flights')
+        metric = request.args.get('metric', 'volume')
+        granularity = request.args.get('granularity', 'daily')
+        start_date = request.args.get('start_date', '')
+        end_date = request.args.get('end_date', '')
+
+        if dataset not in TREND_SOURCES:
+            return jsonify({'error': f'Unknown dataset: {dataset}'}), 400
+        if metric != 'volume' and metric not in TREND_SOURCES[dataset]['metrics']:
+            return jsonify({'error': f'Unknown metric for {dataset}: {metric}'}), 400
+        if granularity not in ('daily', 'weekly', 'monthly'):
+            return jsonify({'error': f'Unknown granularity: {granularity}'}), 400
+
+        try:
+            start_date = date.fromisoformat(start_date).isoformat() if start_date else ''
+            end_date = date.fromisoformat(end_date).isoformat() if end_date else ''
+        except ValueError:
+            return jsonify({'error': 'start_date and end_date must be YYYY-MM-DD'}), 400
+
+        try:
+            max_points = min(int(request.args.get('max_points', TRENDS_MAX_POINTS)), TRENDS_MAX_POINTS)
+        except ValueError:
+            return jsonify({'error': 'max_points must be an integer'}), 400
+        # LTTB keeps the first and last points, so fewer than 3 would return every point
+        if max_points < 3:
+            return jsonify({'error': 'max_points must be at least 3'}), 400
+
+        rollup = _refresh_trend_rollup(dataset)
+
+        # Re-aggregate daily buckets into the requested periods
+        periods = {}
+        for day, bucket in rollup['days'].items():
+            if (start_date and day < start_date) or (end_date and day > end_date):
+                continue
+            period = periods.setdefault(_trend_period(day, granularity), {})
+            for key, value in bucket.items():
+                period[key] = period.get(key, 0) + value
+
+        points = []
+        for index, period_start in enumerate(sorted(periods)):
+            period = periods[period_start]
+            if metric == 'volume':
+                value = period['volume']
+            elif period[f'{metric}_count']:
+                value = round(period[f'{metric}_sum'] / period[f'{metric}_count'], 2)
+            else:
+                continue
+            points.append((index, value, {'period': period_start, 'value': value, 'volume': period['volume']}))
+
+        sampled = _lttb(points, max_points)
+
+        return jsonify({
+            'dataset': dataset,
+            'metric': metric,
+            'granularity': granularity,
+            'date_column': TREND_SOURCES[dataset]['date_column'],
+            'total_points': len(points),
+            'downsampled': len(sampled) < len(points),
+            'points': [point[2] for point in sampled],
+            'refreshed_at': rollup['time']
+        })
+
+    except HandledError:
+        raise
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in trends endpoint: {error_details}")
+        app.logger.error(f"Error in trends endpoint: {str(e)}\n{error_details}")
+        return jsonify({'error': f'Failed to load trends: {str(e)}'}), 500
+
+
+# ============================================================================
+# Approximate Queries
+# ============================================================================
+# Opt-in approximate mode, per endpoint (APPROX_ENDPOINTS) and per request
+# (?approx=true|false). On the warehouse side it swaps exact distinct counts
+# and percentiles for approx_count_distinct/approx_percentile. In the app,
+# per-day HyperLogLog registers and histogram_numeric centroids are cached for
+# each (dataset, column), merged on demand into a distinct count and a
+# t-digest for any date range. Like the trend rollups, a refresh re-reads only
+# the days the change feed shows as touched since the sketches' version (all
+# days without a change feed), on a background thread while requests keep
+# answering from the current sketches. Every approximate result carries error
+# bounds.
+
+APPROX_ENDPOINTS = {name.strip() for name in os.environ.get("APPROX_ENDPOINTS", "distribution").split(',')
+                    if name.strip()}
+APPROX_RELATIVE_SD = float(os.environ.get("APPROX_RELATIVE_SD", "0.05"))
+APPROX_PERCENTILE_ACCURACY = int(os.environ.get("APPROX_PERCENTILE_ACCURACY", "1000"))
+DISTRIBUTION_PERCENTILES = (0.25, 0.5, 0.75, 0.9, 0.99)
+
+# 2^11 registers: 1.04 / sqrt(2048) = 2.3% standard error
+HLL_PRECISION = 11
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_RELATIVE_SD = 1.04 / math.sqrt(HLL_REGISTERS)
+SKETCH_DAILY_CENTROIDS = 100
+TDIGEST_COMPRESSION = 100
+
+_NUMERIC_TYPE = re.compile(r'(TINYINT|SMALLINT|INT|INTEGER|BIGINT|LONG|FLOAT|DOUBLE|REAL|DECIMAL|NUMERIC)(\s*\(.*\))?$',
+                           re.IGNORECASE)
+
+# (dataset, column) -> {'days': {date: {'count', 'registers', 'centroids'}}, 'version', 'time'}
+_daily_sketches = {}
+_daily_sketches_lock = threading.Lock()
+_daily_sketch_locks = {}
+
+
+def approx_mode(endpoint, value=None):
+    """Whether a request runs approximately: an explicit approx flag wins, else the endpoint default"""
+    if value is None or value == '':
+        return endpoint in APPROX_ENDPOINTS
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+def distinct_count_bounds(estimate, relative_sd):
+    """95% interval (two standard errors) around an approximate distinct count"""
+    return {
+        'lower': max(0, int(estimate * (1 - 2 * relative_sd))),
+        'upper': int(math.ceil(estimate * (1 + 2 * relative_sd))),
+        'relative_sd': round(relative_sd, 4),
+        'confidence': 0.95
+    }
+
+
+def _hll_estimate(registers):
+    """HyperLogLog cardinality estimate with the small-range (linear counting) correction"""
+    m = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / sum(2.0 ** -rank for rank in registers)
+    zeros = registers.count(0)
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * math.log(m / zeros)
+    return estimate
+
+
+class _TDigest:
+    """Merging t-digest (k1 scale function) over weighted (mean, weight) centroids"""
+
+    def __init__(self, compression=TDIGEST_COMPRESSION):
+        self.compression = compression
+        self.centroids = []
+        self.total = 0.0
+
+    def _scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * min(max(q, 0.0), 1.0) - 1)
+
+    def add(self, centroids):
+        merged = sorted(self.centroids + [(mean, weight) for mean, weight in centroids if weight > 0])
+        self.total = sum(weight for _, weight in merged)
+        self.centroids = []
+        if not merged:
+            return
+
+        mean, weight = merged[0]
+        cumulative = 0.0
+        k_lower = self._scale(0.0)
+        for next_mean, next_weight in merged[1:]:
+            if self._scale((cumulative + weight + next_weight) / self.total) - k_lower <= 1:
+                mean = (mean * weight + next_mean * next_weight) / (weight + next_weight)
+                weight += next_weight
+            else:
+                self.centroids.append((mean, weight))
+                cumulative += weight
+                k_lower = self._scale(cumulative / self.total)
+                mean, weight = next_mean, next_weight
+        self.centroids.append((mean, weight))
+
+    def quantile(self, q):
+        """Interpolate between centroid midpoints"""
+        if not self.centroids:
+            return None
+        target = q * self.total
+        cumulative = 0.0
+        previous = None
+        for mean, weight in self.centroids:
+            midpoint = cumulative + weight / 2
+            if target <= midpoint:
+                if previous is None:
+                    return mean
+                fraction = (target - previous[0]) / (midpoint - previous[0])
+                return previous[1] + fraction * (mean - previous[1])
+            previous = (midpoint, mean)
+            cumulative += weight
+        return self.centroids[-1][0]
+
+    def rank_error(self, q):
+        """Half the weight of the centroid covering quantile q, as a fraction of all weight"""
+        target = q * self.total
+        cumulative = 0.0
+        for _, weight in self.centroids:
+            cumulative += weight
+            if cumulative >= target:
+                return weight / 2 / self.total
+        return 0.0
+
+
+def _refresh_daily_sketches(dataset, column, numeric, wait=True):
+    """Re-sketch the days changed since the daily sketches' version (all days on the first build).
+
+    Without ``wait`` a missing or stale sketch set is refreshed on a background
+    thread and the current sketches are returned (None while the first build
+    runs, so the caller can answer from the warehouse meanwhile).
+    """
+    key = (dataset, column)
+    sketches = _daily_sketches.get(key)
+    version = get_table_versions().get(dataset)
+
+    if sketches:
+        if (version is not None and sketches['version'] == version) or \
+                (version is None and time.time() - sketches['time'] < TRENDS_REFRESH_INTERVAL):
+            count_cache_hit(f'sketches:{dataset}.{column}')
+            return sketches
+
+    with _daily_sketches_lock:
+        lock = _daily_sketch_locks.setdefault(key, threading.Lock())
+
+    if not wait:
+        if not lock.locked():
+            def build():
+                _background_thread.active = True
+                try:
+                    _refresh_daily_sketches(dataset, column, numeric)
+                except Exception as e:
+                    print(f"ERROR: Sketch build for {dataset}.{column} failed: {str(e)}")
+
+            threading.Thread(target=build, name=f'sketch-{dataset}-{column}', daemon=True).start()
+        return sketches
+
+    # Another thread is already refreshing; keep the current sketches meanwhile
+    if not lock.acquire(blocking=sketches is None):
+        return sketches
+
+    try:
+        if sketches is None and key in _daily_sketches:
+            return _daily_sketches[key]
+
+        sketches = _daily_sketches.get(key) or {'days': {}, 'version': None, 'time': 0}
+        date_column = TREND_SOURCES[dataset]['date_column']
+        table_name = f"{CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}"
+
+        days = dict(sketches['days'])
+        changed = None
+        if days and version is not None and sketches['version'] is not None:
+            changed = table_changed_days(dataset, sketches['version'], f"CAST({date_column} AS DATE)")
+
+        where_conditions = [f"{date_column} IS NOT NULL", f"{column} IS NOT NULL"]
+        if changed is None:
+            days = {}
+        else:
+            changed = [day for day in changed if day]
+            # Days whose rows were all deleted must not keep their old sketches
+            for day in changed:
+                days.pop(day, None)
+            where_conditions.append(f"({_rollup_day_filter(f'CAST({date_column} AS DATE)', changed)})")
+
+        # HLL register per (day, bucket): low bits of xxhash64 pick the bucket,
+        # the rank is the position of the first set bit in the remaining bits
+        remaining_bits = 64 - HLL_PRECISION
+        histogram = f"to_json(histogram_numeric(CAST(value AS DOUBLE), {SKETCH_DAILY_CENTROIDS}))" \
+            if numeric else "NULL"
+        rows = []
+        if changed != []:
+            rows = _execute_query(f"""
+                WITH hashed AS (
+                    SELECT CAST(CAST({date_column} AS DATE) AS STRING) as day, {column} as value,
+                           xxhash64({column}) as h
+                    FROM {table_name}
+                    WHERE {' AND '.join(where_conditions)}
+                ),
+                registers AS (
+                    SELECT day, CAST(pmod(h, {HLL_REGISTERS}) AS INT) as bucket,
+                           MAX(CASE WHEN shiftrightunsigned(h, {HLL_PRECISION}) = 0 THEN {remaining_bits + 1}
+                                    ELSE {remaining_bits} - CAST(FLOOR(LOG2(shiftrightunsigned(h, {HLL_PRECISION}))) AS INT)
+                               END) as rank
+                    FROM hashed
+                    GROUP BY day, bucket
+                ),
+                daily_registers AS (
+                    SELECT day, concat_ws(',', collect_list(concat(bucket, ':', rank))) as registers
+                    FROM registers
+                    GROUP BY day
+                ),
+                daily AS (
+                    SELECT day, COUNT(*) as count, {histogram} as histogram
+                    FROM hashed
+                    GROUP BY day
+                )
+                SELECT daily.day, daily.count, daily_registers.registers, daily.histogram
+                FROM daily JOIN daily_registers ON daily.day = daily_registers.day
+            """, wait_timeout='50s')
+
+        for row in rows:
+            registers = bytearray(HLL_REGISTERS)
+            for pair in (row[2] or '').split(','):
+                if pair:
+                    bucket, rank = pair.split(':')
+                    registers[int(bucket)] = int(rank)
+            centroids = [(point['x'], point['y']) for point in json.loads(row[3])] if row[3] else []
+            days[row[0]] = {'count': int(row[1]) if row[1] else 0, 'registers': registers, 'centroids': centroids}
+
+        _daily_sketches[key] = {
+            'days': days,
+            'version': version,
+            'time': time.time()
+        }
+        scope = 'all days' if changed is None else f"{len(changed)} changed days"
+        print(f"DEBUG: Daily sketches for {dataset}.{column} re-sketched {scope}: {len(rows)} days ({len(days)} total)")
+        return _daily_sketches[key]
+    finally:
+        lock.release()
+
+
+def _sketch_distribution(sketches, start_date, end_date, numeric):
+    """Merge the daily sketches inside [start_date, end_date] into one answer"""
+    registers = bytearray(HLL_REGISTERS)
+    digest = _TDigest()
+    count = 0
+    days = 0
+    centroids = []
+    for day, sketch in sketches['days'].items():
+        if (start_date and day < start_date) or (end_date and day > end_date):
+            continue
+        days += 1
+        count += sketch['count']
+        registers = bytearray(map(max, registers, sketch['registers']))
+        centroids.extend(sketch['centroids'])
+    if numeric:
+        digest.add(centroids)
+
+    distinct = _hll_estimate(registers) if count else 0
+    result = {
+        'method': 'sketch',
+        'days': days,
+        'count': count,
+        'distinct_values': dict(distinct_count_bounds(distinct, HLL_RELATIVE_SD), estimate=int(round(distinct)))
+    }
+    if numeric and digest.total:
+        percentiles = {}
+        for q in DISTRIBUTION_PERCENTILES:
+            # A daily centroid can span up to 1/SKETCH_DAILY_CENTROIDS of that day's ranks
+            error = max(digest.rank_error(q), 0.5 / SKETCH_DAILY_CENTROIDS)
+            percentiles[f'p{round(q * 100)}'] = {
+                'value': digest.quantile(q),
+                'lower': digest.quantile(max(0.0, q - error)),
+                'upper': digest.quantile(min(1.0, q + error)),
+                'rank_error': round(error, 4)
+            }
+        result['percentiles'] = percentiles
+    return result
+
+
+def _warehouse_distribution(dataset, column, start_date, end_date, numeric, approx):
+    """Distinct count and percentiles computed on the warehouse, exactly or with approx_* functions"""
+    date_column = TREND_SOURCES[dataset]['date_column']
+    where_conditions = [f"{column} IS NOT NULL"]
+    parameters = []
+    if start_date:
+        where_conditions.append(f"{date_column} >= :start_date")
+        parameters.append({'name': 'start_date', 'value': start_date, 'type': 'DATE'})
+    if end_date:
+        where_conditions.append(f"{date_column} <= :end_date")
+        parameters.append({'name': 'end_date', 'value': end_date, 'type': 'DATE'})
+
+    quantiles = ', '.join(str(q) for q in DISTRIBUTION_PERCENTILES)
+    if approx:
+        distinct_sql = f"approx_count_distinct({column}, {APPROX_RELATIVE_SD})"
+        percentile_sql = f"approx_percentile({column}, array({quantiles}), {APPROX_PERCENTILE_ACCURACY})"
+    else:
+        distinct_sql = f"COUNT(DISTINCT {column})"
+        percentile_sql = f"percentile({column}, array({quantiles}))"
+
+    rows = _execute_query(f"""
+        SELECT COUNT(*) as count, {distinct_sql} as distinct_values,
+               {f'to_json({percentile_sql})' if numeric else 'NULL'} as percentiles
+        FROM {CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}
+        WHERE {' AND '.join(where_conditions)}
+    """, parameters=parameters, priority='interactive')
+
+    row = rows[0] if rows else [0, 0, None]
+    distinct = int(row[1]) if row[1] else 0
+    result = {
+        'method': 'warehouse',
+        'count': int(row[0]) if row[0] else 0,
+        'distinct_values': dict(distinct_count_bounds(distinct, APPROX_RELATIVE_SD), estimate=distinct)
+        if approx else {'estimate': distinct}
+    }
+    if row[2]:
+        values = json.loads(row[2])
+        result['percentiles'] = {
+            f'p{round(q * 100)}': dict({'value': value}, rank_error=round(1.0 / APPROX_PERCENTILE_ACCURACY, 4))
+            if approx else {'value': value}
+            for q, value in zip(DISTRIBUTION_PERCENTILES, values)
         }
+    return result
 
-        # Cache the result
-        _review_stats_cache = response_data
-        _review_stats_cache_time = time_module.time()
 
-        print("DEBUG: Review stats fetched and cached successfully")
-        response = jsonify(response_data)
-        response.headers['Cache-Control'] = 'public, max-age=600'
-        return response
+@app.route('/api/distribution/<dataset>/<column>', methods=['GET'])
+def get_distribution(dataset, column):
+    """Row count, distinct values and percentiles of a column over a date range.
 
+    ?approx=true answers from the cached daily sketches (or warehouse approx_*
+    functions while they are being built); ?approx=false computes exactly.
+    """
+    try:
+        if dataset not in TREND_SOURCES:
+            return jsonify({'error': f'Unknown dataset: {dataset}'}), 400
+
+        start_date = request.args.get('start_date', '')
+        end_date = request.args.get('end_date', '')
+        try:
+            start_date = date.fromisoformat(start_date).isoformat() if start_date else ''
+            end_date = date.fromisoformat(end_date).isoformat() if end_date else ''
+        except ValueError:
+            return jsonify({'error': 'start_date and end_date must be YYYY-MM-DD'}), 400
+
+        column_types = dict(_get_table_columns(dataset))
+        if column not in column_types:
+            return jsonify({'error': f'Unknown column for {dataset}: {column}'}), 400
+        numeric = bool(_NUMERIC_TYPE.match(column_types[column] or ''))
+
+        approx = approx_mode('distribution', request.args.get('approx'))
+        started = time.perf_counter()
+        if approx:
+            sketches = _refresh_daily_sketches(dataset, column, numeric, wait=False)
+            if sketches is not None:
+                result = _sketch_distribution(sketches, start_date, end_date, numeric)
+            else:
+                result = _warehouse_distribution(dataset, column, start_date, end_date, numeric, approx=True)
+        else:
+            result = _warehouse_distribution(dataset, column, start_date, end_date, numeric, approx=False)
+
+        return jsonify(dict(result,
+                            dataset=dataset,
+                            column=column,
+                            approximate=approx,
+                            filters={'start_date': start_date, 'end_date': end_date},
+                            elapsed_ms=round((time.perf_counter() - started) * 1000, 1)))
+
+    except HandledError:
+        raise
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
-        print(f"ERROR: Exception in review stats endpoint: {error_details}")
-        app.logger.error(f"Error in review stats endpoint: {str(e)}\n{error_details}")
-
-        # Return mock data as fallback if query fails
-        return jsonify({
-            'ratings': [
-                {'rating': 1, 'count': 50, 'avg_helpful': 2.5},
-                {'rating': 2, 'count': 80, 'avg_helpful': 3.2},
-                {'rating': 3, 'count': 150, 'avg_helpful': 4.1},
-                {'rating': 4, 'count': 350, 'avg_helpful': 5.8},
-                {'rating': 5, 'count': 370, 'avg_helpful': 7.2}
-            ],
-            'item_types': [
-                {'item_type': 'Flight', 'review_count': 450, 'avg_rating': 4.2, 'recommend_pct': 78.5},
-                {'item_type': 'Hotel', 'review_count': 380, 'avg_rating': 4.3, 'recommend_pct': 82.1},
-                {'item_type': 'Package', 'review_count': 170, 'avg_rating': 4.5, 'recommend_pct': 85.3}
-            ],
-            'companies': [
-                {'company_name': 'Delta Air Lines', 'review_count': 85, 'avg_rating': 4.6},
-                {'company_name': 'Marriott Hotels', 'review_count': 72, 'avg_rating': 4.5},
-                {'company_name': 'United Airlines', 'review_count': 68, 'avg_rating': 4.4},
-                {'company_name': 'Hilton Hotels', 'review_count': 65, 'avg_rating': 4.4},
-                {'company_name': 'British Airways', 'review_count': 58, 'avg_rating': 4.3}
-            ],
-            'travelers': [
-                {'traveler_type': 'Business', 'count': 320, 'avg_rating': 4.1},
-                {'traveler_type': 'Leisure', 'count': 450, 'avg_rating': 4.4},
-                {'traveler_type': 'Family', 'count': 230, 'avg_rating': 4.3}
-            ],
-            'sentiment': [
-                {'sentiment': 'Positive', 'count': 720},
-                {'sentiment': 'Neutral', 'count': 150},
-                {'sentiment': 'Negative', 'count': 130}
-            ],
-            'overall': {
-                'total_reviews': 1000,
-                'avg_rating': 4.25,
-                'verified_pct': 72.5,
-                'recommend_pct': 80.3
-            },
-            'error': f'Query failed, showing mock data: {str(e)}'
-        })
+        print(f"ERROR: Exception in distribution endpoint: {error_details}")
+        return jsonify({'error': f'Failed to get distribution: {str(e)}'}), 500
 
 
-@app.route('/api/hotels/stats', methods=['GET'])
-def get_hotel_stats():
-    """Get hotel statistics from Unity Catalog synced_hotels table"""
+# ============================================================================
+# Data Access API
+# ============================================================================
+# Raw rows from the synced tables. Browsing uses keyset (seek) pagination on
+# each table's key column, so page 1000 costs the same as page 1. Exports ask
+# the warehouse for EXTERNAL_LINKS results and pipe each chunk to the client
+# as soon as it is downloaded, so worker memory is bounded by a single chunk.
+
+# Unique, ordered key column per synced table used for seek pagination; a table
+# whose key column does not exist cannot be browsed (501) until it is configured
+DATA_KEY_COLUMNS = {
+    'flights': os.environ.get("FLIGHTS_KEY_COLUMN", "flight_id"),
+    'hotels': os.environ.get("HOTELS_KEY_COLUMN", "hotel_id"),
+    'packages': os.environ.get("PACKAGES_KEY_COLUMN", "package_id"),
+    'reviews': os.environ.get("REVIEWS_KEY_COLUMN", "review_id")
+}
+
+DATA_PAGE_SIZE = int(os.environ.get("DATA_PAGE_SIZE", "100"))
+DATA_MAX_PAGE_SIZE = int(os.environ.get("DATA_MAX_PAGE_SIZE", "1000"))
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'JSON_ARRAY'),
+    'ndjson': ('application/x-ndjson', 'JSON_ARRAY'),
+    'parquet': ('application/vnd.apache.parquet', 'ARROW_STREAM')
+}
+
+# dataset -> {'version': ..., 'columns': [(name, data_type), ...]}
+_table_columns = {}
+
+
+def _get_table_columns(dataset):
+    """Return [(column_name, data_type)] for a synced table, cached per table version"""
+    version = get_table_versions().get(dataset)
+    cached = _table_columns.get(dataset)
+    if cached and cached['version'] == version:
+        return cached['columns']
+
+    rows = _execute_query(f"""
+        SELECT column_name, data_type
+        FROM {CATALOG}.information_schema.columns
+        WHERE table_schema = '{SCHEMA}' AND table_name = '{SYNCED_TABLES[dataset]}'
+        ORDER BY ordinal_position
+    """, priority='interactive')
+    columns = [(row[0], row[1]) for row in rows]
+    _table_columns[dataset] = {'version': version, 'columns': columns}
+    return columns
+
+
+def _parse_projection(dataset):
+    """Validate the ?columns= projection against the table schema.
+
+    Returns (selected column names, {name: data_type}); raises ValueError on
+    unknown columns.
+    """
+    column_types = dict(_get_table_columns(dataset))
+    requested = [name.strip() for name in request.args.get('columns', '').split(',') if name.strip()]
+    if not requested:
+        return list(column_types), column_types
+
+    unknown = [name for name in requested if name not in column_types]
+    if unknown:
+        raise ValueError(f"Unknown columns for {dataset}: {', '.join(unknown)}")
+    return requested, column_types
+
+
+def _encode_cursor(key_value):
+    return base64.urlsafe_b64encode(json.dumps([key_value]).encode()).decode()
+
+
+def _decode_cursor(cursor):
     try:
-        # Query cities with highest star ratings
-        cities_query = f"""
-        SELECT
-            city,
-            AVG(star_rating) as avg_rating,
-            COUNT(*) as count
-        FROM {CATALOG}.{SCHEMA}.synced_hotels
-        WHERE city IS NOT NULL AND star_rating IS NOT NULL
-        GROUP BY city
-        ORDER BY avg_rating DESC
-        LIMIT 10
-        """
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))[0]
+    except Exception:
+        raise ValueError("Invalid cursor")
 
-        # Query average price by room type
-        room_prices_query = f"""
-        SELECT
-            room_type,
-            AVG(total_price) as avg_price,
-            COUNT(*) as count
-        FROM {CATALOG}.{SCHEMA}.synced_hotels
-        WHERE room_type IS NOT NULL AND total_price IS NOT NULL
-        GROUP BY room_type
-        ORDER BY avg_price DESC
-        """
 
-        # Query amenities breakdown
-        amenities_query = f"""
-        SELECT
-            CASE
-                WHEN free_breakfast = true AND free_cancellation = true THEN 'Both'
-                WHEN free_breakfast = true AND free_cancellation = false THEN 'Breakfast Only'
-                WHEN free_breakfast = false AND free_cancellation = true THEN 'Cancellation Only'
-                ELSE 'Neither'
-            END as type,
-            COUNT(*) as count
-        FROM {CATALOG}.{SCHEMA}.synced_hotels
-        GROUP BY type
-        """
+def _open_external_link(link):
+    """Open a presigned result link; the Databricks auth header must not be sent"""
+    req = urllib.request.Request(link.external_link, headers=link.http_headers or {})
+    return urllib.request.urlopen(req, timeout=60)
 
-        # Query overall statistics
-        overall_query = f"""
-        SELECT
-            COUNT(*) as total_hotels,
-            AVG(star_rating) as avg_rating,
-            AVG(total_price) as avg_price
-        FROM {CATALOG}.{SCHEMA}.synced_hotels
-        WHERE star_rating IS NOT NULL AND total_price IS NOT NULL
-        """
 
-        # Execute queries using SQL warehouse
-        from databricks.sdk.service.sql import StatementState
+def _iter_external_row_batches(response):
+    """Yield the rows of each EXTERNAL_LINKS + JSON_ARRAY result chunk, one chunk at a time"""
+    for chunk in _iter_result_chunks(response):
+        for link in chunk.external_links or []:
+            with _open_external_link(link) as link_response:
+                yield json.load(link_response)
 
-        # Get warehouse ID from environment variable or find a running one
-        warehouse_id = os.environ.get("DATABRICKS_WAREHOUSE_ID")
-        if not warehouse_id:
-            warehouses = list(w.warehouses.list())
-            for wh in warehouses:
-                if wh.state.value == 'RUNNING':
-                    warehouse_id = wh.id
-                    break
-            if not warehouse_id:
-                raise Exception("No running SQL warehouse found")
 
-        # Execute cities query
-        cities_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=cities_query
-        ).result()
+def _iter_arrow_batches(response):
+    """Yield the Arrow record batches of an EXTERNAL_LINKS + ARROW_STREAM result, one link at a time"""
+    import pyarrow.ipc
 
-        cities = []
-        if cities_result and cities_result.data_array:
-            for row in cities_result.data_array:
-                cities.append({
-                    'city': row[0],
-                    'avg_rating': float(row[1]) if row[1] else 0,
-                    'count': int(row[2]) if row[2] else 0
-                })
+    for chunk in _iter_result_chunks(response):
+        for link in chunk.external_links or []:
+            with _open_external_link(link) as link_response:
+                yield from pyarrow.ipc.open_stream(link_response)
 
-        # Execute room prices query
-        room_prices_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=room_prices_query
-        ).result()
 
-        room_prices = []
-        if room_prices_result and room_prices_result.data_array:
-            for row in room_prices_result.data_array:
-                room_prices.append({
-                    'room_type': row[0],
-                    'avg_price': float(row[1]) if row[1] else 0,
-                    'count': int(row[2]) if row[2] else 0
-                })
+@app.route('/api/data/<table>', methods=['GET'])
+def get_table_rows(table):
+    """Browse raw rows of a synced table with keyset pagination and column projection"""
+    if table not in SYNCED_TABLES:
+        return jsonify({'error': f'Unknown table: {table}'}), 400
 
-        # Execute amenities query
-        amenities_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=amenities_query
-        ).result()
+    try:
+        columns, column_types = _parse_projection(table)
+        limit = min(max(int(request.args.get('limit', DATA_PAGE_SIZE)), 1), DATA_MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor', '')
+        after = _decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    key_column = DATA_KEY_COLUMNS[table]
+    if key_column not in column_types:
+        return jsonify({
+            'error': f"Cannot browse {table}: its key column {key_column} does not exist; "
+                     f"set {table.upper()}_KEY_COLUMN to a unique, ordered column"
+        }), 501
 
-        amenities = []
-        if amenities_result and amenities_result.data_array:
-            for row in amenities_result.data_array:
-                amenities.append({
-                    'type': row[0],
-                    'count': int(row[1]) if row[1] else 0
-                })
+    try:
+        select_columns = columns if key_column in columns else columns + [key_column]
 
-        # Execute overall query
-        overall_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=overall_query
-        ).result()
+        parameters = []
+        where_clause = ""
+        if after is not None:
+            where_clause = f"WHERE `{key_column}` > :after"
+            parameters.append({'name': 'after', 'value': str(after), 'type': column_types[key_column]})
 
-        overall = {
-            'total_hotels': 0,
-            'avg_rating': 0,
-            'avg_price': 0
-        }
-        if overall_result and overall_result.data_array and len(overall_result.data_array) > 0:
-            row = overall_result.data_array[0]
-            overall = {
-                'total_hotels': int(row[0]) if row[0] else 0,
-                'avg_rating': float(row[1]) if row[1] else 0,
-                'avg_price': float(row[2]) if row[2] else 0
-            }
+        rows = _execute_query(f"""
+            SELECT {', '.join(f'`{name}`' for name in select_columns)}
+            FROM {CATALOG}.{SCHEMA}.{SYNCED_TABLES[table]}
+            {where_clause}
+            ORDER BY `{key_column}`
+            LIMIT {limit + 1}
+        """, parameters=parameters, priority='interactive')
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        key_index = select_columns.index(key_column)
 
         return jsonify({
-            'cities': cities,
-            'room_prices': room_prices,
-            'amenities': amenities,
-            'overall': overall
+            'table': table,
+            'columns': columns,
+            'key_column': key_column,
+            'rows': [{name: row[i] for i, name in enumerate(select_columns) if name in columns} for row in rows],
+            'has_more': has_more,
+            'next_cursor': _encode_cursor(rows[-1][key_index]) if has_more and rows else None
         })
 
+    except HandledError:
+        raise
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
-        print(f"ERROR: Exception in hotel stats endpoint: {error_details}")
-        app.logger.error(f"Error in hotel stats endpoint: {str(e)}\n{error_details}")
+        print(f"ERROR: Exception in data browse endpoint: {error_details}")
+        app.logger.error(f"Error in data browse endpoint: {str(e)}\n{error_details}")
+        return jsonify({'error': f'Failed to load rows: {str(e)}'}), 500
+
+
+class _ParquetStreamSink:
+    """Write-only file object that hands buffered Parquet bytes back to the response"""
+
+    def __init__(self):
+        self.buffer = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        return data
+
+
+def _stream_rows_export(response, columns, export_format):
+    """Yield CSV/NDJSON bytes one warehouse result chunk at a time"""
+    if export_format == 'csv':
+        out = io.StringIO()
+        csv.writer(out).writerow(columns)
+        yield out.getvalue().encode()
+
+    for rows in _iter_external_row_batches(response):
+        out = io.StringIO()
+        if export_format == 'csv':
+            csv.writer(out).writerows(rows)
+        else:
+            for row in rows:
+                out.write(json.dumps(dict(zip(columns, row))))
+                out.write('\n')
+        yield out.getvalue().encode()
+
+
+def _stream_parquet_export(response):
+    """Yield Parquet bytes, converting each Arrow record batch into a row group as it arrives"""
+    import pyarrow.parquet
+
+    sink = _ParquetStreamSink()
+    writer = None
+    for batch in _iter_arrow_batches(response):
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(sink, batch.schema)
+        writer.write_batch(batch)
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+    yield sink.drain()
+
+
+@app.route('/api/data/<table>/export', methods=['GET'])
+def export_table(table):
+    """Stream a full synced table as CSV, NDJSON or Parquet"""
+    if table not in SYNCED_TABLES:
+        return jsonify({'error': f'Unknown table: {table}'}), 400
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unsupported export format: {export_format}'}), 400
+
+    if export_format == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            return jsonify({'error': 'Parquet export requires pyarrow to be installed'}), 501
 
-        # Return mock data as fallback if query fails
-        return jsonify({
-            'cities': [
-                {'city': 'Paris', 'avg_rating': 4.8, 'count': 250},
-                {'city': 'London', 'avg_rating': 4.7, 'count': 220},
-                {'city': 'New York', 'avg_rating': 4.6, 'count': 300},
-                {'city': 'Tokyo', 'avg_rating': 4.5, 'count': 180},
-                {'city': 'Barcelona', 'avg_rating': 4.4, 'count': 150},
-                {'city': 'Amsterdam', 'avg_rating': 4.3, 'count': 140},
-                {'city': 'Rome', 'avg_rating': 4.2, 'count': 160},
-                {'city': 'Dubai', 'avg_rating': 4.1, 'count': 190},
-                {'city': 'Singapore', 'avg_rating': 4.0, 'count': 120},
-                {'city': 'Sydney', 'avg_rating': 3.9, 'count': 110}
-            ],
-            'room_prices': [
-                {'room_type': 'Suite', 'avg_price': 450.50, 'count': 120},
-                {'room_type': 'Deluxe', 'avg_price': 320.75, 'count': 250},
-                {'room_type': 'Standard', 'avg_price': 180.25, 'count': 400},
-                {'room_type': 'Economy', 'avg_price': 95.00, 'count': 230}
-            ],
-            'amenities': [
-                {'type': 'Both', 'count': 450},
-                {'type': 'Breakfast Only', 'count': 280},
-                {'type': 'Cancellation Only', 'count': 190},
-                {'type': 'Neither', 'count': 80}
-            ],
-            'overall': {
-                'total_hotels': 1000,
-                'avg_rating': 4.3,
-                'avg_price': 245.50
-            },
-            'error': f'Query failed, showing mock data: {str(e)}'
+    try:
+        columns, _ = _parse_projection(table)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        mimetype, result_format = EXPORT_FORMATS[export_format]
+        response = _run_statement(f"""
+            SELECT {', '.join(f'`{name}`' for name in columns)}
+            FROM {CATALOG}.{SCHEMA}.{SYNCED_TABLES[table]}
+        """, disposition='EXTERNAL_LINKS', result_format=result_format, priority='export')
+
+        if export_format == 'parquet':
+            body = _stream_parquet_export(response)
+        else:
+            body = _stream_rows_export(response, columns, export_format)
+
+        print(f"DEBUG: Streaming {export_format} export of {table} (statement {response.statement_id})")
+        return Response(stream_with_context(body), mimetype=mimetype, headers={
+            'Content-Disposition': f'attachment; filename={SYNCED_TABLES[table]}.{export_format}'
         })
 
+    except HandledError:
+        raise
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in data export endpoint: {error_details}")
+        app.logger.error(f"Error in data export endpoint: {str(e)}\n{error_details}")
+        return jsonify({'error': f'Failed to export table: {str(e)}'}), 500
+
+
+# ============================================================================
+# Chat Grounding
+# ============================================================================
+# Common questions ("which airline is cheapest?") are answered by the same
+# aggregates the dashboards already cache. Before calling the supervisor, the
+# relevant sections of the stored stats snapshots are picked by keyword and
+# entity matching and attached to the system prompt within a token budget, so
+# the agent can answer without generating SQL. Only cached data is used; a
+# missing snapshot never triggers a warehouse query here.
+
+GROUNDING_TOKEN_BUDGET = int(os.environ.get("GROUNDING_TOKEN_BUDGET", "600"))
+
+# (dataset, stats section, label, keyword prefixes, entity field, row formatter).
+# Prices carry the currency their dashboard shows: £ for flights and packages, $ for hotels.
+GROUNDING_TOPICS = [
+    ('flights', 'airlines', 'Top airlines by flight count',
+     ('airline', 'carrier', 'cheap', 'expensive', 'fare', 'price', 'cost'), 'airline',
+     lambda r: f"{r['airline']} {r['flight_count']} flights, avg £{r['avg_price']:.2f}, avg {r['avg_duration']}min"),
+    ('flights', 'routes', 'Busiest flight routes',
+     ('route', 'busiest', 'popular', 'origin', 'destination', 'between', 'airport'), 'destination',
+     lambda r: f"{r['origin']}-{r['destination']} {r['flight_count']} flights, avg £{r['avg_price']:.2f}, "
+               f"min £{r['min_price']:.2f}"),
+    ('flights', 'cabin_classes', 'Flight cabin classes',
+     ('cabin', 'class', 'economy', 'business', 'first', 'premium'), 'cabin_class',
+     lambda r: f"{r['cabin_class']} {r['count']} flights, avg £{r['avg_price']:.2f}"),
+    ('flights', 'stops', 'Flights by number of stops',
+     ('stop', 'direct', 'nonstop', 'layover', 'connect'), None,
+     lambda r: f"{r['stops']} stops {r['count']} flights, avg £{r['avg_price']:.2f}, avg {r['avg_duration']}min"),
+    ('flights', 'overall', 'All flights',
+     ('flight', 'fly', 'flying', 'seat', 'duration'), None,
+     lambda r: f"{r['total_flights']} flights, avg £{r['avg_price']:.2f}, avg {r['avg_duration']}min, "
+               f"avg {r['avg_available_seats']} seats available"),
+    ('hotels', 'cities', 'Hotel cities by rating',
+     ('hotel', 'city', 'cities', 'stay', 'rated', 'rating', 'best'), 'city',
+     lambda r: f"{r['city']} {r['count']} hotels, avg rating {r['avg_rating']:.2f}"),
+    ('hotels', 'room_prices', 'Hotel room types',
+     ('room', 'suite', 'night', 'cheap', 'expensive', 'price', 'cost'), 'room_type',
+     lambda r: f"{r['room_type']} {r['count']} hotels, avg ${r['avg_price']:.2f}"),
+    ('hotels', 'amenities', 'Hotel amenities',
+     ('amenit', 'wifi', 'pool', 'spa', 'gym', 'parking', 'breakfast', 'facilit'), 'type',
+     lambda r: f"{r['type']} {r['count']}"),
+    ('hotels', 'overall', 'All hotels',
+     ('hotel', 'accommodation'), None,
+     lambda r: f"{r['total_hotels']} hotels, avg rating {r['avg_rating']:.2f}, avg ${r['avg_price']:.2f}"),
+    ('packages', 'destinations', 'Package destinations',
+     ('package', 'holiday', 'vacation', 'destination', 'trip', 'deal'), 'destination',
+     lambda r: f"{r['destination']} {r['package_count']} packages, avg £{r['avg_price']:.2f}, "
+               f"from £{r['min_price']:.2f}"),
+    ('packages', 'package_types', 'Package types',
+     ('package', 'type', 'inclusive', 'kind'), 'package_type',
+     lambda r: f"{r['package_type']} {r['package_count']} packages, avg £{r['avg_price']:.2f}, "
+               f"avg {r['avg_duration']} days"),
+    ('packages', 'durations', 'Packages by duration',
+     ('duration', 'long', 'days', 'week', 'short'), None,
+     lambda r: f"{r['duration_range']} {r['count']} packages, avg £{r['avg_price']:.2f}"),
+    ('packages', 'overall', 'All packages',
+     ('package', 'discount'), None,
+     lambda r: f"{r['total_packages']} packages, avg £{r['avg_price']:.2f}, avg {r['avg_duration']} days, "
+               f"avg discount {r['avg_discount']:.1f}%"),
+    ('reviews', 'sentiment', 'Review sentiment',
+     ('sentiment', 'positive', 'negative', 'happy', 'complain', 'feedback', 'review'), 'sentiment',
+     lambda r: f"{r['sentiment']} {r['count']}"),
+    ('reviews', 'companies', 'Companies by reviews',
+     ('company', 'companies', 'best', 'worst', 'rated', 'rating', 'review'), 'company_name',
+     lambda r: f"{r['company_name']} {r['review_count']} reviews, avg rating {r['avg_rating']:.2f}"),
+    ('reviews', 'item_types', 'Reviews by product',
+     ('product', 'categor', 'review'), 'item_type',
+     lambda r: f"{r['item_type']} {r['review_count']} reviews, avg rating {r['avg_rating']:.2f}, "
+               f"{r['recommend_pct']:.0f}% recommend"),
+    ('reviews', 'travelers', 'Reviews by traveller type',
+     ('traveler', 'traveller', 'family', 'families', 'solo', 'couple', 'business'), 'traveler_type',
+     lambda r: f"{r['traveler_type']} {r['count']} reviews, avg rating {r['avg_rating']:.2f}"),
+    ('reviews', 'overall', 'All reviews',
+     ('review', 'customer', 'satisf', 'recommend', 'verified'), None,
+     lambda r: f"{r['total_reviews']} reviews, avg rating {r['avg_rating']:.2f}, "
+               f"{r['verified_pct']:.0f}% verified, {r['recommend_pct']:.0f}% recommend")
+]
+
+# dataset -> (snapshot captured_at, [(topic index, text, entity names)])
+_grounding_blocks = {}
+
+
+def _get_grounding_blocks(dataset):
+    """Render the grounding lines for a dataset's stored stats snapshot, re-rendering only when it changes"""
+    snapshot = load_snapshot(dataset)
+    if snapshot is None:
+        return [], None
+
+    cached = _grounding_blocks.get(dataset)
+    if cached and cached[0] == snapshot['captured_at']:
+        return cached[1], snapshot['captured_at']
+
+    blocks = []
+    for index, (topic_dataset, section, label, _, entity_field, format_row) in enumerate(GROUNDING_TOPICS):
+        if topic_dataset != dataset or not snapshot['data'].get(section):
+            continue
+        rows = snapshot['data'][section]
+        rows = rows if isinstance(rows, list) else [rows]
+        try:
+            text = f"{label}: " + "; ".join(format_row(row) for row in rows)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"ERROR: Cannot format grounding for {dataset}.{section}: {str(e)}")
+            continue
+        entities = {str(row[entity_field]).lower() for row in rows if entity_field and row.get(entity_field)}
+        blocks.append((index, text, entities))
+
+    _grounding_blocks[dataset] = (snapshot['captured_at'], blocks)
+    return blocks, snapshot['captured_at']
+
+
+def build_chat_grounding(message, token_budget=GROUNDING_TOKEN_BUDGET):
+    """Pick cached aggregates relevant to ``message``; returns (prompt text, topic labels)"""
+    text = message.lower()
+    words = re.findall(r"[a-z]+", text)
+    datasets = sorted({topic[0] for topic in GROUNDING_TOPICS})
+
+    candidates = []
+    oldest = None
+    for dataset in datasets:
+        blocks, captured_at = _get_grounding_blocks(dataset)
+        for index, block_text, entities in blocks:
+            keywords = GROUNDING_TOPICS[index][3]
+            score = sum(1 for keyword in keywords if any(word.startswith(keyword) for word in words))
+            # Naming a known airline, city, company, ... is a stronger signal than a keyword
+            score += 3 * sum(1 for entity in entities if len(entity) > 2 and entity in text)
+            if score:
+                candidates.append((-score, index, block_text, captured_at))
+
+    lines = []
+    labels = []
+    used = 0
+    for _, index, block_text, captured_at in sorted(candidates):
+        # Roughly four characters per token
+        cost = len(block_text) // 4 + 1
+        if used + cost > token_budget:
+            continue
+        lines.append(f"- {block_text}")
+        labels.append(f"{GROUNDING_TOPICS[index][0]}.{GROUNDING_TOPICS[index][1]}")
+        used += cost
+        oldest = captured_at if oldest is None else min(oldest, captured_at)
+
+    if not lines:
+        return '', []
+    header = f"Pre-computed aggregates from the dashboards (as of {_format_timestamp(oldest)}):"
+    return header + "\n" + "\n".join(lines), labels
+
 
 @app.route('/api/chat', methods=['POST'])
+@rate_limited('chat')
 def chat():
     """Handle chat messages and interact with the multi-agent supervisor"""
     try:
@@ -1182,6 +5189,16 @@ You can help users:
 Always be helpful, accurate, and provide data-driven insights when possible.
 Use SQL queries against the Delta tables to retrieve relevant information."""
 
+        grounding, grounded_on = build_chat_grounding(user_message)
+        if grounding:
+            system_message += f"""
+
+{grounding}
+
+If these aggregates answer the question, answer from them directly without querying the tables.
+Query the tables only for details they do not cover."""
+            print(f"DEBUG: Grounding chat prompt with {grounded_on}")
+
         # Format messages for the endpoint
         messages = [
             {"role": "system", "content": system_message},
@@ -1195,10 +5212,11 @@ Use SQL queries against the Delta tables to retrieve relevant information."""
 
         print(f"DEBUG: Sending payload to endpoint {ENDPOINT_NAME}: {payload}")
 
-        response = w.serving_endpoints.query(
+        w = get_workspace_client()
+        response = serving_breaker.call(lambda: w.serving_endpoints.query(
             name=ENDPOINT_NAME,
             dataframe_records=[payload]
-        )
+        ))
 
         print(f"DEBUG: Received response: {response}")
         print(f"DEBUG: Response type: {type(response)}")
@@ -1292,11 +5310,13 @@ Use SQL queries against the Delta tables to retrieve relevant information."""
 
         return jsonify({
             'response': assistant_message,
-            'session_id': session_id
+            'session_id': session_id,
+            'grounded_on': grounded_on
         })
 
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         print(f"ERROR: Exception in chat endpoint: {error_details}")
         app.logger.error(f"Error in chat endpoint: {str(e)}\n{error_details}")
@@ -1326,10 +5346,114 @@ def get_stats():
     })
 
 
+@app.errorhandler(RateLimited)
+def rate_limited_response(e):
+    """Reject requests over a rate limit or the in-flight cap"""
+    print(f"DEBUG: {str(e)}")
+    retry_after = max(1, math.ceil(e.retry_after))
+    response = jsonify({'error': str(e), 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+@app.errorhandler(WarehouseQueueTimeout)
+def warehouse_busy(e):
+    """Fail fast when the warehouse admission queue is full"""
+    print(f"ERROR: {str(e)}")
+    response = jsonify({'error': str(e), 'warehouse_scheduler': get_scheduler_stats()})
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+
+@app.errorhandler(CircuitOpenError)
+def circuit_open(e):
+    """Fail fast while a dependency's circuit breaker is open"""
+    print(f"ERROR: {str(e)}")
+    response = jsonify({'error': str(e), 'circuit_breakers': get_breaker_stats()})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+
+@app.errorhandler(WarehouseStarting)
+def warehouse_starting(e):
+    """Tell the client to poll while the warehouse starts instead of serving fallback data"""
+    print(f"DEBUG: {str(e)}")
+    response = jsonify({
+        'status': 'starting',
+        'message': 'The SQL warehouse is starting. Data will load automatically once it is ready.',
+        'status_url': '/api/warehouse/status',
+        'retry_after': WAREHOUSE_START_POLL_INTERVAL
+    })
+    response.status_code = 202
+    response.headers['Retry-After'] = str(WAREHOUSE_START_POLL_INTERVAL)
+    return response
+
+
+@app.route('/api/warehouse/status', methods=['GET'])
+def warehouse_status():
+    """Current state of the configured SQL warehouse, for clients waiting on a start"""
+    try:
+        status = get_warehouse_status()
+        return jsonify({
+            'warehouse_id': status['warehouse_id'],
+            'state': status['state'],
+            'ready': status['state'] == 'RUNNING' or not status['warehouse_id'],
+            # Waiting will not help: the warehouse is gone or starting it failed
+            'failed': status['state'] in ('DELETED', 'DELETING') or status['error'] is not None,
+            'start_requested_at': status['start_requested_at'],
+            'error': status['error'],
+            'retry_after': WAREHOUSE_START_POLL_INTERVAL
+        })
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in warehouse status endpoint: {error_details}")
+        return jsonify({'error': f'Failed to get warehouse status: {str(e)}'}), 500
+
+
+@app.route('/api/warehouse/scheduler', methods=['GET'])
+def warehouse_scheduler_stats():
+    """Queue depth, running statements and queue wait times for monitoring"""
+    return jsonify(get_scheduler_stats())
+
+
+@app.route('/api/version', methods=['GET'])
+def get_data_version():
+    """Per-dataset data versions, so browsers can revalidate cached stats without refetching them.
+
+    A dataset's version is null while it is unknown (e.g. the warehouse is stopped).
+    It carries a suffix after an admin cache invalidation, so browsers drop their copies too.
+    """
+    versions = get_table_versions()
+    return jsonify({
+        'app_version': APP_VERSION,
+        'datasets': {dataset: _with_cache_epoch(versions.get(dataset)) for dataset in SYNCED_TABLES}
+    })
+
+
+@app.route('/sw.js')
+def service_worker():
+    """Serve the service worker from the site root so it can control every page"""
+    response = send_from_directory(app.static_folder, 'js/sw.js', mimetype='application/javascript')
+    response.headers['Service-Worker-Allowed'] = '/'
+    return response
+
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy', 'version': '1.0.0'})
+    return jsonify({
+        'status': 'healthy',
+        'version': APP_VERSION,
+        'workspace_client_ready': _workspace_client is not None,
+        'startup_profile': _startup_profile,
+        'warehouse_scheduler': get_scheduler_stats(),
+        'circuit_breakers': get_breaker_stats(),
+        'sdk_http_pool': get_sdk_pool_stats(),
+        'local_engine': get_local_engine_stats()
+    })
 
 
 @app.route('/api/test', methods=['POST'])
@@ -1343,163 +5467,432 @@ def test():
             'session_id': 'test-123'
         })
     except Exception as e:
-        import traceback
         return jsonify({
             'error': str(e),
             'details': traceback.format_exc()
         }), 500
 
 
-@app.route('/api/insights', methods=['POST'])
-def get_insights():
-    """Generate insights based on filters from the Insights Bot"""
-    try:
-        data = request.json
-        company_name = data.get('company_name', '').strip()
-        start_date = data.get('start_date', '')
-        end_date = data.get('end_date', '')
-        attribute = data.get('attribute', '')
-
-        if not attribute:
-            return jsonify({'error': 'Please select an insight attribute'}), 400
-
-        # Parse attribute to get table and column
-        parts = attribute.split('.')
-        if len(parts) != 2:
-            return jsonify({'error': 'Invalid attribute format'}), 400
-
-        table_type, column_name = parts
-
-        # Map table types to actual table names
-        table_map = {
-            'flights': 'synced_flights',
-            'hotels': 'synced_hotels',
-            'packages': 'synced_packages',
-            'reviews': 'synced_reviews'
+# Insights attribute tables and the columns the optional filters apply to
+INSIGHTS_COMPANY_COLUMNS = {
+    'flights': 'airline',
+    'hotels': 'hotel_name',
+    'packages': 'package_type',
+    'reviews': 'company_name'
+}
+INSIGHTS_DATE_COLUMNS = {
+    'flights': 'departure_date',
+    'hotels': 'check_in_date',
+    'packages': 'departure_date',
+    'reviews': 'review_date'
+}
+
+# Numeric attributes are summarised as histograms instead of a top-10 of exact values
+INSIGHTS_NUMERIC_BINS = int(os.environ.get("INSIGHTS_NUMERIC_BINS", "10"))
+INSIGHTS_SUMMARY_PERCENTILES = (0.25, 0.5, 0.75, 0.9, 0.99)
+
+# (dataset, column) -> {'width': [...], 'quantile': [...], 'version': ..., 'time': ...}
+_numeric_bin_edges = {}
+
+# Progressive insights preview a TABLESAMPLE sized to read about this many rows
+INSIGHTS_SAMPLE_TARGET_ROWS = int(os.environ.get("INSIGHTS_SAMPLE_TARGET_ROWS", "200000"))
+
+# dataset -> {'rows': ..., 'version': ..., 'time': ...}
+_table_row_counts = {}
+
+
+def _get_table_row_count(dataset):
+    """Row count of a synced table, cached per table version"""
+    version = get_table_versions().get(dataset)
+    cached = _table_row_counts.get(dataset)
+    if cached and (cached['version'] == version if version is not None
+                   else time.time() - cached['time'] < STATS_CACHE_TTL):
+        return cached['rows']
+
+    rows = _execute_query(f"SELECT COUNT(*) FROM {CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}",
+                          wait_timeout='10s', priority='interactive')
+    row_count = int(rows[0][0]) if rows and rows[0][0] else 0
+    _table_row_counts[dataset] = {'rows': row_count, 'version': version, 'time': time.time()}
+    return row_count
+
+
+def _get_numeric_bin_edges(dataset, column):
+    """Equal-width and quantile bin edges (and distinct count) of a numeric column over the whole table.
+
+    Edges come from one MIN/MAX/approx_percentile pass and are cached per table
+    version, so every filter combination is binned the same way.
+    """
+    version = get_table_versions().get(dataset)
+    cached = _numeric_bin_edges.get((dataset, column))
+    if cached and (cached['version'] == version if version is not None
+                   else time.time() - cached['time'] < STATS_CACHE_TTL):
+        return cached
+
+    quantiles = ', '.join(str(i / INSIGHTS_NUMERIC_BINS) for i in range(1, INSIGHTS_NUMERIC_BINS))
+    rows = _execute_query(f"""
+        SELECT
+            CAST(MIN({column}) AS DOUBLE) as low,
+            CAST(MAX({column}) AS DOUBLE) as high,
+            to_json(approx_percentile(CAST({column} AS DOUBLE), array({quantiles}), {APPROX_PERCENTILE_ACCURACY})),
+            approx_count_distinct({column}, {APPROX_RELATIVE_SD}) as distinct_values
+        FROM {CATALOG}.{SCHEMA}.{SYNCED_TABLES[dataset]}
+        WHERE {column} IS NOT NULL
+    """, wait_timeout='20s', priority='interactive')
+
+    row = rows[0] if rows else [None, None, None, None]
+    low = float(row[0]) if row[0] is not None else 0.0
+    high = float(row[1]) if row[1] is not None else 0.0
+    step = (high - low) / INSIGHTS_NUMERIC_BINS
+    interior = json.loads(row[2]) if row[2] else []
+
+    edges = {
+        'width': [low + step * i for i in range(INSIGHTS_NUMERIC_BINS)] + [high],
+        # Skewed columns repeat percentiles; duplicate edges would give empty bins
+        'quantile': sorted({low, high, *(float(value) for value in interior if value is not None)}),
+        'distinct': int(row[3]) if row[3] is not None else 0,
+        'version': version,
+        'time': time.time()
+    }
+    _numeric_bin_edges[(dataset, column)] = edges
+    print(f"DEBUG: Bin edges for {dataset}.{column}: [{low}, {high}], {len(edges['quantile']) - 1} quantile bins")
+    return edges
+
+
+def _numeric_insights_queries(column_name, table_name, where_clause, edges, distinct_sql):
+    """One-pass equal-width and quantile histogram, plus a min/max/percentile summary"""
+    width_edges = edges['width']
+    quantile_edges = edges['quantile']
+    bins = INSIGHTS_NUMERIC_BINS
+    value = f"CAST({column_name} AS DOUBLE)"
+
+    if width_edges[-1] > width_edges[0]:
+        # width_bucket puts the maximum in bin N + 1 and rows outside the cached range in 0 / N + 1
+        width_bin = f"LEAST(GREATEST(width_bucket({value}, {width_edges[0]!r}, {width_edges[-1]!r}, {bins}), 1), {bins})"
+    else:
+        width_bin = "1"
+    quantile_cases = ' '.join(f"WHEN {value} < {edge!r} THEN {index}"
+                              for index, edge in enumerate(quantile_edges[1:-1], start=1))
+    quantile_bin = f"CASE {quantile_cases} ELSE {max(len(quantile_edges) - 1, 1)} END" if quantile_cases else "1"
+
+    width_array = ', '.join(repr(edge) for edge in width_edges)
+    quantile_array = ', '.join(repr(edge) for edge in (quantile_edges if len(quantile_edges) > 1
+                                                        else quantile_edges * 2))
+
+    query = f"""
+        WITH binned AS (
+            SELECT {width_bin} as width_bin, {quantile_bin} as quantile_bin
+            FROM {table_name}
+            {where_clause}
+            {"AND" if where_clause else "WHERE"} {column_name} IS NOT NULL
+        ),
+        counts AS (
+            SELECT
+                CASE WHEN grouping(width_bin) = 0 THEN 'width' ELSE 'quantile' END as kind,
+                COALESCE(width_bin, quantile_bin) as bin,
+                COUNT(*) as count
+            FROM binned
+            GROUP BY GROUPING SETS ((width_bin), (quantile_bin))
+        ),
+        bins AS (
+            SELECT 'width' as kind, explode(sequence(1, {bins})) as bin
+            UNION ALL
+            SELECT 'quantile' as kind, explode(sequence(1, {max(len(quantile_edges) - 1, 1)})) as bin
+        )
+        SELECT
+            bins.kind,
+            bins.bin,
+            COALESCE(counts.count, 0) as count,
+            element_at(CASE WHEN bins.kind = 'width' THEN array({width_array}) ELSE array({quantile_array}) END,
+                       bins.bin) as lower,
+            element_at(CASE WHEN bins.kind = 'width' THEN array({width_array}) ELSE array({quantile_array}) END,
+                       bins.bin + 1) as upper
+        FROM bins LEFT JOIN counts ON counts.kind = bins.kind AND counts.bin = bins.bin
+        ORDER BY bins.kind, bins.bin
+    """
+
+    percentiles = ', '.join(str(q) for q in INSIGHTS_SUMMARY_PERCENTILES)
+    stats_query = f"""
+        SELECT
+            COUNT(*) as total_records,
+            {distinct_sql} as unique_values,
+            MIN({value}) as min_value,
+            MAX({value}) as max_value,
+            AVG({value}) as avg_value,
+            to_json(approx_percentile({value}, array({percentiles}), {APPROX_PERCENTILE_ACCURACY})) as percentiles
+        FROM {table_name}
+        {where_clause}
+    """
+    return query, stats_query
+
+
+def _format_bin_edge(value):
+    return f"{value:,.0f}" if float(value).is_integer() or abs(value) >= 1000 else f"{value:,.2f}"
+
+
+def _format_numeric_insights(rows, stats_row):
+    """Histogram bins (with shares) and the summary of a numeric attribute"""
+    histogram = {'equal_width': [], 'quantile': []}
+    for kind, bin_index, count, lower, upper in rows or []:
+        histogram['equal_width' if kind == 'width' else 'quantile'].append({
+            'bin': int(bin_index),
+            'lower': float(lower) if lower is not None else None,
+            'upper': float(upper) if upper is not None else None,
+            'count': int(count) if count else 0
+        })
+    for bins in histogram.values():
+        total = sum(item['count'] for item in bins)
+        for item in bins:
+            item['percentage'] = round(item['count'] * 100.0 / total, 1) if total else 0
+            item['label'] = f"{_format_bin_edge(item['lower'])} – {_format_bin_edge(item['upper'])}" \
+                if item['lower'] is not None and item['upper'] is not None else 'N/A'
+
+    summary = None
+    if stats_row and len(stats_row) > 2:
+        percentiles = json.loads(stats_row[5]) if stats_row[5] else []
+        summary = {
+            'min': float(stats_row[2]) if stats_row[2] is not None else None,
+            'max': float(stats_row[3]) if stats_row[3] is not None else None,
+            'avg': round(float(stats_row[4]), 2) if stats_row[4] is not None else None,
+            'percentiles': {f'p{round(q * 100)}': value for q, value in zip(INSIGHTS_SUMMARY_PERCENTILES, percentiles)},
+            'percentile_rank_error': round(1.0 / APPROX_PERCENTILE_ACCURACY, 4)
         }
+    return histogram, summary
+
+
+def _insights_sample_percent(row_count):
+    """TABLESAMPLE percentage that reads about INSIGHTS_SAMPLE_TARGET_ROWS rows, or None for small tables"""
+    if row_count <= INSIGHTS_SAMPLE_TARGET_ROWS * 2:
+        return None
+    return max(round(100.0 * INSIGHTS_SAMPLE_TARGET_ROWS / row_count, 4), 0.0001)
+
+
+def _build_insights_queries(data, sample_percent=None, statements=True):
+    """Validate an insights request and build its two statements.
+
+    Numeric attributes with more distinct values than INSIGHTS_NUMERIC_BINS get
+    a histogram and summary instead of a top-10 of exact values. With ``sample_percent`` both statements read a TABLESAMPLE
+    of the table; ``statements=False`` only validates and describes the
+    request. Raises ValueError with a user-facing message for invalid input.
+    """
+    company_name = (data.get('company_name') or '').strip()
+    start_date = data.get('start_date') or ''
+    end_date = data.get('end_date') or ''
+    attribute = data.get('attribute') or ''
+    approx = approx_mode('insights', data.get('approx'))
+
+    if not attribute:
+        raise ValueError('Please select an insight attribute')
+
+    # Parse attribute to get table and column
+    parts = attribute.split('.')
+    if len(parts) != 2 or not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', parts[1]):
+        raise ValueError('Invalid attribute format')
+
+    table_type, column_name = parts
+    if table_type not in SYNCED_TABLES:
+        raise ValueError(f'Unknown table type: {table_type}')
+
+    column_types = dict(_get_table_columns(table_type))
+    if column_types and column_name not in column_types:
+        raise ValueError(f'Unknown column for {table_type}: {column_name}')
+    numeric = bool(_NUMERIC_TYPE.match(column_types.get(column_name) or ''))
+    # Numeric columns with no more distinct values than bins (ratings, stops, ...) keep their exact values
+    edges = _get_numeric_bin_edges(table_type, column_name) if numeric else None
+    numeric = numeric and edges['distinct'] > INSIGHTS_NUMERIC_BINS
+
+    spec = {
+        'attribute': attribute,
+        'column_name': column_name,
+        'table': table_type,
+        'numeric': numeric,
+        'approximate': approx,
+        'filters': {
+            'company_name': company_name,
+            'start_date': start_date,
+            'end_date': end_date
+        }
+    }
+    if not statements:
+        return spec
+
+    table_name = f"{CATALOG}.{SCHEMA}.{SYNCED_TABLES[table_type]}"
+    if sample_percent:
+        table_name += f" TABLESAMPLE ({sample_percent} PERCENT)"
+
+    # Build WHERE clause based on filters
+    where_conditions = []
+    parameters = []
+    if company_name:
+        where_conditions.append(f"LOWER({INSIGHTS_COMPANY_COLUMNS[table_type]}) LIKE LOWER(:company_pattern)")
+        parameters.append({'name': 'company_pattern', 'value': f'%{company_name}%', 'type': 'STRING'})
+    if start_date:
+        where_conditions.append(f"{INSIGHTS_DATE_COLUMNS[table_type]} >= :start_date")
+        parameters.append({'name': 'start_date', 'value': start_date, 'type': 'STRING'})
+    if end_date:
+        where_conditions.append(f"{INSIGHTS_DATE_COLUMNS[table_type]} <= :end_date")
+        parameters.append({'name': 'end_date', 'value': end_date, 'type': 'STRING'})
+
+    where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
+
+    distinct_sql = f"approx_count_distinct({column_name}, {APPROX_RELATIVE_SD})" if approx \
+        else f"COUNT(DISTINCT {column_name})"
+
+    if numeric:
+        query, stats_query = _numeric_insights_queries(
+            column_name, table_name, where_clause, edges, distinct_sql
+        )
+        return dict(spec, query=query, stats_query=stats_query, parameters=parameters)
 
-        if table_type not in table_map:
-            return jsonify({'error': f'Unknown table type: {table_type}'}), 400
-
-        table_name = f"{CATALOG}.{SCHEMA}.{table_map[table_type]}"
+    # Top values of the selected column
+    query = f"""
+        SELECT
+            {column_name} as attribute_value,
+            COUNT(*) as count,
+            COUNT(*) * 100.0 / SUM(COUNT(*)) OVER() as percentage
+        FROM {table_name}
+        {where_clause}
+        {"AND" if where_clause else "WHERE"} {column_name} IS NOT NULL
+        GROUP BY {column_name}
+        ORDER BY count DESC
+        LIMIT 10
+    """
 
-        # Get warehouse ID
-        warehouse_id = os.environ.get("DATABRICKS_WAREHOUSE_ID")
-        if not warehouse_id:
-            warehouses = list(w.warehouses.list())
-            for wh in warehouses:
-                if wh.state.value == 'RUNNING':
-                    warehouse_id = wh.id
-                    break
-            if not warehouse_id:
-                return jsonify({'error': 'No running SQL warehouse found'}), 500
-
-        # Build WHERE clause based on filters
-        where_conditions = []
-
-        # Company name filter (search in relevant columns based on table)
-        if company_name:
-            company_columns = {
-                'flights': 'airline',
-                'hotels': 'hotel_name',
-                'packages': 'package_type',
-                'reviews': 'company_name'
-            }
-            company_col = company_columns.get(table_type)
-            if company_col:
-                where_conditions.append(f"LOWER({company_col}) LIKE LOWER('%{company_name}%')")
-
-        # Date filter (search in relevant date columns based on table)
-        if start_date or end_date:
-            date_columns = {
-                'flights': 'departure_date',
-                'hotels': 'check_in_date',
-                'packages': 'departure_date',
-                'reviews': 'review_date'
+    # Additional statistics; approximate mode skips the exact distinct count
+    stats_query = f"""
+        SELECT
+            COUNT(*) as total_records,
+            {distinct_sql} as unique_values
+        FROM {table_name}
+        {where_clause}
+    """
+
+    return dict(spec, query=query, stats_query=stats_query, parameters=parameters)
+
+
+def _format_insights(spec, rows, stats_rows, sample_percent=None):
+    """Build the insights response from the rows of both statements.
+
+    Sampled rows are scaled up to table-level estimates, with a 95% margin
+    (in percentage points) on each value's share.
+    """
+    histogram = summary = None
+    if spec['numeric']:
+        # Equal-width bins double as the list the Insights Bot renders
+        histogram, summary = _format_numeric_insights(rows, stats_rows[0] if stats_rows else None)
+        insights = [{'value': item['label'], 'count': item['count'], 'percentage': item['percentage']}
+                    for item in histogram['equal_width']]
+    else:
+        insights = []
+        for row in rows or []:
+            insights.append({
+                'value': str(row[0]) if row[0] is not None else 'N/A',
+                'count': int(row[1]) if row[1] else 0,
+                'percentage': round(float(row[2]), 1) if row[2] else 0
+            })
+
+    total_records = 0
+    unique_values = 0
+    if stats_rows:
+        row = stats_rows[0]
+        total_records = int(row[0]) if row[0] else 0
+        unique_values = int(row[1]) if row[1] else 0
+
+    result = {
+        'success': True,
+        'attribute': spec['attribute'],
+        'column_name': spec['column_name'],
+        'table': spec['table'],
+        'total_records': total_records,
+        'unique_values': unique_values,
+        'insights': insights,
+        'filters': spec['filters'],
+        'approximate': spec['approximate'],
+        'numeric': spec['numeric']
+    }
+    if spec['numeric']:
+        result.update(histogram=histogram, summary=summary)
+    if spec['approximate']:
+        result['error_bounds'] = {'unique_values': distinct_count_bounds(unique_values, APPROX_RELATIVE_SD)}
+
+    if sample_percent:
+        scale = 100.0 / sample_percent
+        for item in insights:
+            share = item['percentage'] / 100
+            # Sampled non-null rows, recovered from this value's count and share
+            sample_size = item['count'] / share if share else 0
+            item['count'] = int(round(item['count'] * scale))
+            item['margin'] = round(196 * math.sqrt(share * (1 - share) / sample_size), 1) if sample_size else None
+        for bins in (histogram or {}).values():
+            for item in bins:
+                item['count'] = int(round(item['count'] * scale))
+        result.update(
+            total_records=int(round(total_records * scale)),
+            preview=True,
+            sample={
+                'percent': sample_percent,
+                'rows': total_records,
+                'confidence': 0.95,
+                # Distinct values seen in a sample only bound the true number from below
+                'unique_values_is_lower_bound': True
             }
-            date_col = date_columns.get(table_type)
-            if date_col:
-                if start_date:
-                    where_conditions.append(f"{date_col} >= '{start_date}'")
-                if end_date:
-                    where_conditions.append(f"{date_col} <= '{end_date}'")
+        )
+    return result
 
-        where_clause = ""
-        if where_conditions:
-            where_clause = "WHERE " + " AND ".join(where_conditions)
 
-        # Build insights query based on the selected attribute
-        # Generate aggregated insights for the selected column
-        query = f"""
-            SELECT
-                {column_name} as attribute_value,
-                COUNT(*) as count,
-                COUNT(*) * 100.0 / SUM(COUNT(*)) OVER() as percentage
-            FROM {table_name}
-            {where_clause}
-            {"WHERE" if not where_clause else "AND"} {column_name} IS NOT NULL
-            GROUP BY {column_name}
-            ORDER BY count DESC
-            LIMIT 10
-        """.replace("WHERE AND", "WHERE")
-
-        # Execute query
-        result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=query
-        ).result()
+def _progressive_insights(params, spec):
+    """Submit the exact insights job, then answer at once with a preview from a table sample"""
+    job, _ = submit_job('insights', params)
+    if job['state'] == 'SUCCEEDED':
+        return jsonify({'job': _job_view(job), 'result': job['result'], 'preview': None})
 
-        insights = []
-        if result and result.data_array:
-            for row in result.data_array:
-                insights.append({
-                    'value': str(row[0]) if row[0] is not None else 'N/A',
-                    'count': int(row[1]) if row[1] else 0,
-                    'percentage': round(float(row[2]), 1) if row[2] else 0
-                })
+    preview = None
+    try:
+        sample_percent = _insights_sample_percent(_get_table_row_count(spec['table']))
+        if sample_percent:
+            sampled = _build_insights_queries(params, sample_percent=sample_percent)
+            rows = _execute_query(sampled['query'], wait_timeout='10s', parameters=sampled['parameters'],
+                                  priority='interactive')
+            stats_rows = _execute_query(sampled['stats_query'], wait_timeout='10s',
+                                        parameters=sampled['parameters'], priority='interactive')
+            preview = _format_insights(sampled, rows, stats_rows, sample_percent=sample_percent)
+    except HandledError:
+        raise
+    except Exception as e:
+        # The exact job is still running; the client just waits for it
+        print(f"ERROR: Sampled insights preview failed: {str(e)}")
 
-        # Get additional statistics
-        stats_query = f"""
-            SELECT
-                COUNT(*) as total_records,
-                COUNT(DISTINCT {column_name}) as unique_values
-            FROM {table_name}
-            {where_clause}
-        """
+    # 200, not 202: a 202 from the data endpoints means the warehouse is starting (see fetchWhenReady)
+    return jsonify({'job': _job_view(job), 'result': None, 'preview': preview})
 
-        stats_result = w.statement_execution.execute_statement(
-            warehouse_id=warehouse_id,
-            catalog=CATALOG,
-            schema=SCHEMA,
-            statement=stats_query
-        ).result()
 
-        total_records = 0
-        unique_values = 0
-        if stats_result and stats_result.data_array and len(stats_result.data_array) > 0:
-            row = stats_result.data_array[0]
-            total_records = int(row[0]) if row[0] else 0
-            unique_values = int(row[1]) if row[1] else 0
+@app.route('/api/insights', methods=['POST'])
+@rate_limited('insights')
+def get_insights():
+    """Generate insights based on filters from the Insights Bot.
 
-        return jsonify({
-            'success': True,
-            'attribute': attribute,
-            'column_name': column_name,
-            'table': table_type,
-            'total_records': total_records,
-            'unique_values': unique_values,
-            'insights': insights,
-            'filters': {
-                'company_name': company_name,
-                'start_date': start_date,
-                'end_date': end_date
-            }
-        })
+    Blocks until both statements finish unless ``progressive`` is set: then it
+    returns a sampled preview plus the exact result's job, and the client polls
+    or follows the job (its ``status_url``/``events_url``) for the refined numbers.
+    """
+    try:
+        data = dict(request.json or {})
+        progressive = data.pop('progressive', False)
+        try:
+            spec = _build_insights_queries(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if progressive:
+            return _progressive_insights(data, spec)
+
+        rows = _execute_query(spec['query'], parameters=spec['parameters'], priority='interactive')
+        stats_rows = _execute_query(spec['stats_query'], parameters=spec['parameters'], priority='interactive')
 
+        return jsonify(_format_insights(spec, rows, stats_rows))
+
+    except HandledError:
+        raise
     except Exception as e:
-        import traceback
         error_details = traceback.format_exc()
         print(f"ERROR: Exception in insights endpoint: {error_details}")
         return jsonify({
@@ -1508,5 +5901,711 @@ def get_insights():
         }), 500
 
 
+# ============================================================================
+# Async Jobs
+# ============================================================================
+# Long-running statements are submitted with wait_timeout=0s and tracked in a
+# SQLite job table shared by all workers, so no request thread waits on the
+# warehouse. Clients poll GET /api/jobs/<id> or follow its SSE stream; each
+# poll checks statement status at most once per JOB_POLL_INTERVAL (across all
+# workers) and the first poll to see every statement succeed builds the result.
+# Identical submissions share one job until its result expires.
+
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", "600"))
+JOB_MAX_AGE = int(os.environ.get("JOB_MAX_AGE", "3600"))
+JOB_EVENTS_MAX_SECONDS = int(os.environ.get("JOB_EVENTS_MAX_SECONDS", "20"))
+JOB_QUERY_MAX_ROWS = int(os.environ.get("JOB_QUERY_MAX_ROWS", "10000"))
+# Ad-hoc SQL jobs are admin-only (see admin_required) and off unless enabled
+JOBS_ALLOW_ADHOC_SQL = os.environ.get("JOBS_ALLOW_ADHOC_SQL", "false").lower() == "true"
+
+JOB_TERMINAL_STATES = ('SUCCEEDED', 'FAILED', 'CANCELED')
+
+# A job stuck in SUBMITTING/FINISHING this long (its worker died) is failed or retried
+JOB_CLAIM_TIMEOUT = 60
+
+_JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    key TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    statement_ids TEXT,
+    state TEXT NOT NULL,
+    error TEXT,
+    result BLOB,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    checked_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key);
+"""
+
+_ADHOC_SQL_FORBIDDEN = re.compile(
+    r'\b(insert|update|delete|merge|drop|create|alter|truncate|grant|revoke|copy|optimize|vacuum|'
+    r'refresh|cache|uncache|msck|use|set|reset|call|restore|clone)\b',
+    re.IGNORECASE
+)
+
+# Functions that reach outside the synced tables (files, secrets, the network, models, dynamic table names)
+_ADHOC_SQL_FORBIDDEN_FUNCTIONS = re.compile(
+    r'\b(secret|try_secret|read_files|read_kafka|read_kinesis|read_pubsub|read_pulsar|read_statestore|'
+    r'http_request|remote_query|vector_search|identifier|ai_\w+)\s*\(',
+    re.IGNORECASE
+)
+
+# String literals and comments, blanked out before the statement is checked
+_ADHOC_SQL_LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+
+def _jobs_db():
+    return local_db('jobs', _JOB_SCHEMA)
+
+
+def _plan_insights_job(params):
+    spec = _build_insights_queries(params)
+    statements = [(spec['query'], spec['parameters'], None), (spec['stats_query'], spec['parameters'], None)]
+    # The rows are formatted with the spec they were queried with (numeric or top values), not a re-derived one
+    return statements, {key: value for key, value in spec.items() if key not in ('query', 'stats_query', 'parameters')}
+
+
+def _finish_insights_job(spec, results):
+    return _format_insights(spec, results[0]['rows'], results[1]['rows'])
+
+
+def _check_adhoc_sql(statement):
+    """Raise ValueError unless ``statement`` is a single read-only SELECT over the synced tables"""
+    code = _ADHOC_SQL_LITERALS.sub("''", statement).replace('`', '')
+    if not re.match(r'\s*(select|with)\b', code, re.IGNORECASE) or ';' in code or _ADHOC_SQL_FORBIDDEN.search(code):
+        raise ValueError('Only a single read-only SELECT statement can be submitted')
+    if _ADHOC_SQL_FORBIDDEN_FUNCTIONS.search(code):
+        raise ValueError('This function cannot be used in ad-hoc SQL')
+
+    synced = set(SYNCED_TABLES.values())
+    allowed = {name.lower() for name in synced} | {f"{CATALOG}.{SCHEMA}.{name}".lower() for name in synced}
+    ctes = {name.lower() for name in re.findall(r'\b(\w+)\s+as\s*\(', code, re.IGNORECASE)}
+    for target in re.findall(r'\b(?:from|join)\s+([\w.]+)', code, re.IGNORECASE):
+        if target.lower() not in allowed | ctes:
+            raise ValueError(f'Ad-hoc SQL can only read the synced tables ({", ".join(sorted(synced))}); got {target}')
+    # Comma joins would let a second table past the FROM check
+    if re.search(r'\b(?:from|join)\s+[\w.]+(?:\s+(?:as\s+)?\w+)?\s*,', code, re.IGNORECASE):
+        raise ValueError('Use explicit JOINs in ad-hoc SQL')
+    for name in re.findall(r'\b\w+\.\w+\.\w+\b', code):
+        if name.lower() not in allowed:
+            raise ValueError(f'Ad-hoc SQL can only read the synced tables; got {name}')
+
+
+def _plan_query_job(params):
+    if not JOBS_ALLOW_ADHOC_SQL:
+        raise ValueError('Ad-hoc SQL jobs are disabled')
+    statement = (params.get('statement') or '').strip().rstrip(';').strip()
+    _check_adhoc_sql(statement)
+    return [(statement, None, JOB_QUERY_MAX_ROWS)], None
+
+
+def _finish_query_job(spec, results):
+    result = results[0]
+    return {
+        'columns': result['columns'],
+        'rows': result['rows'],
+        'row_count': len(result['rows']),
+        'truncated': result['truncated']
+    }
+
+
+# kind -> (plan(params) -> ([(statement, parameters, row_limit)], spec), finish(spec, results) -> result);
+# the spec is stored with the job (params['planned']) so the result is built the way the statements were
+JOB_KINDS = {
+    'insights': (_plan_insights_job, _finish_insights_job),
+    'query': (_plan_query_job, _finish_query_job)
+}
+
+
+def _load_job(job_id):
+    row = _jobs_db().execute(
+        "SELECT id, kind, params, statement_ids, state, error, result, created_at, updated_at, checked_at, "
+        "expires_at FROM jobs WHERE id = ?", (job_id,)
+    ).fetchone()
+    if row is None or row[10] < time.time():
+        return None
+    return {
+        'id': row[0],
+        'kind': row[1],
+        'params': json.loads(row[2]),
+        'statement_ids': json.loads(row[3]) if row[3] else [],
+        'state': row[4],
+        'error': row[5],
+        'result': json.loads(zlib.decompress(row[6])) if row[6] else None,
+        'created_at': row[7],
+        'updated_at': row[8],
+        'checked_at': row[9],
+        'expires_at': row[10]
+    }
+
+
+def _update_job(job_id, **fields):
+    fields['updated_at'] = time.time()
+    assignments = ', '.join(f'{name} = ?' for name in fields)
+    _jobs_db().execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+
+def _collect_statement_result(response):
+    """Columns and rows of a succeeded statement"""
+    manifest = response.manifest
+    rows = []
+    for chunk in _iter_result_chunks(response):
+        rows.extend(chunk.data_array or [])
+    return {
+        'columns': [column.name for column in manifest.schema.columns] if manifest and manifest.schema else [],
+        'rows': rows,
+        'truncated': bool(manifest and manifest.truncated)
+    }
+
+
+def _cancel_statements(statement_ids):
+    for statement_id in statement_ids:
+        cancel_statement(statement_id)
+
+
+def _count_running_jobs(db, kind, now):
+    return db.execute(
+        "SELECT COUNT(*) FROM jobs WHERE kind = ? AND state IN ('SUBMITTING', 'RUNNING', 'FINISHING') "
+        "AND created_at > ?", (kind, now - JOB_IN_FLIGHT_WINDOW)
+    ).fetchone()[0]
+
+
+def running_job_count(kind):
+    """Jobs of ``kind`` still running on the warehouse; they count against its in-flight cap"""
+    if kind not in JOB_KINDS:
+        return 0
+    return _count_running_jobs(_jobs_db(), kind, time.time())
+
+
+def submit_job(kind, params):
+    """Create (or join an identical, unexpired) job; returns (job, deduplicated).
+
+    A new job is refused with RateLimited while its kind's in-flight cap is
+    taken up by running jobs.
+    """
+    plan, _ = JOB_KINDS[kind]
+    statements, spec = plan(params)  # validates params (ValueError)
+
+    key = f"{kind}:{json.dumps(params, sort_keys=True, separators=(',', ':'))}"
+    db = _jobs_db()
+    now = time.time()
+
+    # Look up and insert atomically so concurrent workers share one job
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("DELETE FROM jobs WHERE expires_at < ?", (now,))
+        existing = db.execute(
+            "SELECT id FROM jobs WHERE key = ? AND state NOT IN ('FAILED', 'CANCELED') "
+            "ORDER BY created_at DESC LIMIT 1", (key,)
+        ).fetchone()
+        if existing is None:
+            running = _count_running_jobs(db, kind, now)
+            if running >= MAX_IN_FLIGHT[kind]:
+                raise RateLimited(f"Too many {kind} requests in progress; please retry shortly",
+                                  IN_FLIGHT_RETRY_AFTER)
+            job_id = uuid.uuid4().hex
+            db.execute(
+                "INSERT INTO jobs (id, key, kind, params, state, created_at, updated_at, checked_at, expires_at) "
+                "VALUES (?, ?, ?, ?, 'SUBMITTING', ?, ?, ?, ?)",
+                (job_id, key, kind, json.dumps(dict(params, planned=spec)), now, now, now, now + JOB_MAX_AGE)
+            )
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+
+    if existing is not None:
+        print(f"DEBUG: Job {kind} deduplicated onto {existing[0]}")
+        return _refresh_job(existing[0]), True
+
+    statement_ids = []
+    try:
+        for statement, parameters, row_limit in statements:
+            statement_ids.append(_submit_statement(statement, parameters=parameters, row_limit=row_limit))
+    except Exception:
+        _cancel_statements(statement_ids)
+        db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        raise
+
+    _update_job(job_id, statement_ids=json.dumps(statement_ids), state='RUNNING')
+    print(f"DEBUG: Job {job_id} ({kind}) submitted statements {statement_ids}")
+    return _load_job(job_id), False
+
+
+def _refresh_job(job_id):
+    """Load a job, advancing it from the warehouse's statement states when due"""
+    job = _load_job(job_id)
+    if job is None or job['state'] in JOB_TERMINAL_STATES:
+        return job
+
+    now = time.time()
+    if job['state'] in ('SUBMITTING', 'FINISHING'):
+        if now - job['checked_at'] < JOB_CLAIM_TIMEOUT:
+            return job
+        if job['state'] == 'SUBMITTING':
+            _update_job(job_id, state='FAILED', error='Job submission did not complete',
+                        expires_at=now + JOB_RESULT_TTL)
+            return _load_job(job_id)
+    elif now - job['checked_at'] < JOB_POLL_INTERVAL:
+        return job
+
+    # Claim this check so only one worker polls the warehouse for the job
+    claimed = _jobs_db().execute(
+        "UPDATE jobs SET checked_at = ? WHERE id = ? AND checked_at = ? AND state = ?",
+        (now, job_id, job['checked_at'], job['state'])
+    ).rowcount
+    if not claimed:
+        return _load_job(job_id)
+
+    finishing = False
+    try:
+        w = get_workspace_client()
+        responses = [retry_idempotent(lambda: w.statement_execution.get_statement(statement_id), warehouse_breaker)
+                     for statement_id in job['statement_ids']]
+        states = [response.status.state.value if response.status and response.status.state else None
+                  for response in responses]
+
+        failed = [response for response, state in zip(responses, states)
+                  if state in ('FAILED', 'CANCELED', 'CLOSED')]
+        if failed:
+            _cancel_statements([response.statement_id for response, state in zip(responses, states)
+                                if state in ('PENDING', 'RUNNING')])
+            error = failed[0].status.error
+            message = error.message if error and error.message else states[responses.index(failed[0])]
+            _update_job(job_id, state='FAILED', error=f"Statement {failed[0].statement_id} did not succeed: {message}",
+                        expires_at=time.time() + JOB_RESULT_TTL)
+        elif all(state == 'SUCCEEDED' for state in states):
+            finishing = True
+            _update_job(job_id, state='FINISHING')
+            _, finish = JOB_KINDS[job['kind']]
+            result = finish(job['params']['planned'], [_collect_statement_result(response) for response in responses])
+            _update_job(job_id, state='SUCCEEDED', expires_at=time.time() + JOB_RESULT_TTL,
+                        result=zlib.compress(json.dumps(result, default=str).encode('utf-8')))
+            print(f"DEBUG: Job {job_id} ({job['kind']}) succeeded")
+    except Exception as e:
+        print(f"ERROR: Failed to refresh job {job_id}: {traceback.format_exc()}")
+        # Statement polling errors are retried on the next poll; a failure building the result is final
+        if finishing:
+            _update_job(job_id, state='FAILED', error=str(e), expires_at=time.time() + JOB_RESULT_TTL)
+
+    return _load_job(job_id)
+
+
+def _job_view(job):
+    view = {
+        'job_id': job['id'],
+        'kind': job['kind'],
+        'state': job['state'],
+        'error': job['error'],
+        'created_at': _format_timestamp(job['created_at']),
+        'updated_at': _format_timestamp(job['updated_at']),
+        'expires_at': _format_timestamp(job['expires_at']),
+        'status_url': f"/api/jobs/{job['id']}",
+        'events_url': f"/api/jobs/{job['id']}/events"
+    }
+    if job['state'] == 'SUCCEEDED':
+        view['result'] = job['result']
+    return view
+
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    """Submit an insights or ad-hoc query job and return its ID immediately.
+
+    Body: {"kind": "insights" | "query", "params": {...}}. Insights params are
+    the /api/insights body; query params are {"statement": "SELECT ..."}, a
+    read-only statement over the synced tables. Query jobs need
+    JOBS_ALLOW_ADHOC_SQL and admin credentials (see admin_required).
+    """
+    try:
+        data = request.json or {}
+        kind = data.get('kind')
+        params = data.get('params') or {}
+        if kind not in JOB_KINDS:
+            return jsonify({'error': f"kind must be one of: {', '.join(JOB_KINDS)}"}), 400
+        if kind == 'query':
+            denied = admin_denied()
+            if denied:
+                return denied
+        check_rate_limit(kind)
+        if not isinstance(params, dict):
+            return jsonify({'error': 'params must be an object'}), 400
+
+        try:
+            job, deduplicated = submit_job(kind, params)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        response = jsonify(dict(_job_view(job), deduplicated=deduplicated))
+        response.status_code = 200 if job['state'] in JOB_TERMINAL_STATES else 202
+        response.headers['Location'] = f"/api/jobs/{job['id']}"
+        return response
+
+    except HandledError:
+        raise
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in job submission: {error_details}")
+        return jsonify({'error': f'Failed to submit job: {str(e)}'}), 500
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Job state, plus its result once it has succeeded"""
+    try:
+        job = _refresh_job(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown or expired job'}), 404
+        return jsonify(_job_view(job))
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in job status endpoint: {error_details}")
+        return jsonify({'error': f'Failed to get job: {str(e)}'}), 500
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a job's statements on the warehouse"""
+    try:
+        job = _load_job(job_id)
+        if job is None:
+            return jsonify({'error': 'Unknown or expired job'}), 404
+        if job['state'] not in JOB_TERMINAL_STATES:
+            _cancel_statements(job['statement_ids'])
+            _update_job(job_id, state='CANCELED', expires_at=time.time() + JOB_RESULT_TTL)
+            print(f"DEBUG: Job {job_id} canceled")
+        return jsonify(_job_view(_load_job(job_id)))
+    except Exception as e:
+        error_details = traceback.format_exc()
+        print(f"ERROR: Exception in job cancel endpoint: {error_details}")
+        return jsonify({'error': f'Failed to cancel job: {str(e)}'}), 500
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-sent events with the job's state until it finishes.
+
+    The stream closes after JOB_EVENTS_MAX_SECONDS so a request thread is never
+    held for long; EventSource reconnects on its own.
+    """
+    def generate():
+        deadline = time.monotonic() + JOB_EVENTS_MAX_SECONDS
+        last_state = None
+        yield f"retry: {int(JOB_POLL_INTERVAL * 1000)}\n\n"
+        while True:
+            job = _refresh_job(job_id)
+            if job is None:
+                yield f"event: error\ndata: {json.dumps({'error': 'Unknown or expired job'})}\n\n"
+                return
+            if job['state'] != last_state:
+                last_state = job['state']
+                event = 'done' if job['state'] in JOB_TERMINAL_STATES else 'status'
+                yield f"event: {event}\ndata: {json.dumps(_job_view(job), default=str)}\n\n"
+            if job['state'] in JOB_TERMINAL_STATES or time.monotonic() >= deadline:
+                return
+            time.sleep(JOB_POLL_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'X-Accel-Buffering': 'no'
+    })
+
+
+# ============================================================================
+# Cache Administration
+# ============================================================================
+# /admin/cache lists this worker's in-process caches (plus the shared snapshot
+# store), invalidates them by dashboard, table or key pattern, and warms
+# endpoints. Invalidations are appended to a local SQLite log that every worker
+# polls from a before_request hook, so they reach all gunicorn workers within
+# CACHE_INVALIDATION_POLL_INTERVAL. Warmed stats are shared through the
+# snapshot store. Access needs ADMIN_TOKEN or an address in ADMIN_EMAILS.
+
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get("ADMIN_EMAILS", "").split(",") if email.strip()}
+CACHE_INVALIDATION_POLL_INTERVAL = float(os.environ.get("CACHE_INVALIDATION_POLL_INTERVAL", "1"))
+
+# Endpoints that may be warmed (GET, path prefix)
+WARMABLE_PATHS = ('/api/flights/stats', '/api/packages/stats', '/api/hotels/stats', '/api/reviews/stats',
+                  '/api/trends', '/api/distribution/', '/api/version')
+
+_CACHE_ADMIN_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invalidations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dataset TEXT,
+    pattern TEXT,
+    created_at REAL NOT NULL,
+    requested_by TEXT
+);
+"""
+
+# Per process: id of the last invalidation applied (also the browser cache epoch)
+_cache_admin_state = {'pid': None, 'last_id': 0, 'checked_at': 0.0}
+_cache_admin_lock = threading.Lock()
+
+
+def _cache_admin_db():
+    return local_db('cache_admin', _CACHE_ADMIN_SCHEMA)
+
+
+def _cache_stores():
+    """(prefix, cache, key formatter, dataset of key) for every in-process cache that can be invalidated"""
+    return [
+        ('stats', _stats_cache, str, str),
+        ('stats', _filtered_flight_stats_cache, _flight_snapshot_key, lambda key: 'flights'),
+        ('trends', _trend_rollups, str, str),
+        ('sketches', _daily_sketches, lambda key: f"{key[0]}.{key[1]}", lambda key: key[0]),
+        ('grounding', _grounding_blocks, str, str),
+        ('columns', _table_columns, str, str),
+        ('row_counts', _table_row_counts, str, str),
+        ('bins', _numeric_bin_edges, lambda key: f"{key[0]}.{key[1]}", lambda key: key[0])
+    ]
+
+
+def _entry_time(entry):
+    if isinstance(entry, dict):
+        return entry.get('time')
+    if isinstance(entry, tuple) and entry and isinstance(entry[0], (int, float)):
+        return entry[0]
+    return None
+
+
+def _with_cache_epoch(version):
+    epoch = _cache_admin_state['last_id']
+    return f"{version}~{epoch}" if version is not None and epoch else version
+
+
+def _invalidate_local(dataset=None, pattern=None, created_at=None):
+    """Drop this worker's cache entries for ``dataset`` ('all' for every one) or matching ``pattern``"""
+    global _table_versions_time, _rollup_versions_time
+
+    affected = set()
+    dropped = 0
+    for prefix, cache, format_key, dataset_of in _cache_stores():
+        for raw_key in list(cache):
+            name = f"{prefix}:{format_key(raw_key)}"
+            owner = dataset_of(raw_key)
+            if dataset in ('all', owner) or (pattern and fnmatch.fnmatchcase(name, pattern)):
+                if cache.pop(raw_key, None) is not None:
+                    dropped += 1
+                _cache_hits.pop(name, None)
+                affected.add(owner)
+
+    if dataset == 'all':
+        affected.update(SYNCED_TABLES)
+    elif dataset:
+        affected.add(dataset)
+    for owner in affected:
+        _stats_invalidated_at[owner] = created_at or time.time()
+
+    # Re-read table and rollup versions on the next request
+    _table_versions_time = None
+    _rollup_versions_time = None
+    return dropped
+
+
+@app.before_request
+def poll_cache_invalidations():
+    apply_cache_invalidations()
+
+
+def apply_cache_invalidations(force=False):
+    """Apply invalidations logged by any worker since this one last looked (throttled unless ``force``)"""
+    state = _cache_admin_state
+    now = time.monotonic()
+    if not force and state['pid'] == os.getpid() and now - state['checked_at'] < CACHE_INVALIDATION_POLL_INTERVAL:
+        return
+    if not _cache_admin_lock.acquire(blocking=force):
+        return
+
+    try:
+        db = _cache_admin_db()
+        if state['pid'] != os.getpid():
+            # A new worker has nothing cached yet: only catch up on the epoch
+            state['last_id'] = db.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+            state['pid'] = os.getpid()
+        else:
+            for invalidation_id, dataset, pattern, created_at in db.execute(
+                    "SELECT id, dataset, pattern, created_at FROM invalidations WHERE id > ? ORDER BY id",
+                    (state['last_id'],)).fetchall():
+                dropped = _invalidate_local(dataset, pattern, created_at)
+                state['last_id'] = invalidation_id
+                print(f"DEBUG: Applied cache invalidation {invalidation_id} "
+                      f"({dataset or pattern}): dropped {dropped} entries")
+    except Exception as e:
+        print(f"ERROR: Failed to apply cache invalidations: {str(e)}")
+    finally:
+        state['checked_at'] = time.monotonic()
+        _cache_admin_lock.release()
+
+
+def _admin_user():
+    """Return who is calling the admin API, or None if they are not allowed to"""
+    email = request.headers.get('X-Forwarded-Email', '').lower()
+    if email and email in ADMIN_EMAILS:
+        return email
+    token = request.headers.get('X-Admin-Token') or request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN):
+        return email or 'token'
+    return None
+
+
+def admin_denied():
+    """Return a 403 response unless the caller is an admin, else None"""
+    if not ADMIN_TOKEN and not ADMIN_EMAILS:
+        return jsonify({'error': 'The admin API is disabled; set ADMIN_TOKEN or ADMIN_EMAILS'}), 403
+    if _admin_user() is None:
+        return jsonify({'error': 'Admin credentials required'}), 403
+    return None
+
+
+def admin_required(view):
+    """Route decorator: restrict a view to ADMIN_TOKEN holders and ADMIN_EMAILS"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        return admin_denied() or view(*args, **kwargs)
+    return wrapper
+
+
+def _warm_paths(paths):
+    """Request each path in this worker so its caches (and the shared snapshots) are filled"""
+    results = []
+    for path in paths:
+        if not isinstance(path, str) or not path.split('?')[0].startswith(WARMABLE_PATHS):
+            results.append({'path': path, 'error': 'Not a warmable path'})
+            continue
+        started = time.perf_counter()
+        with app.test_request_context(path, method='GET'):
+            response = app.full_dispatch_request()
+        results.append({
+            'path': path,
+            'status': response.status_code,
+            'ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+    return results
+
+
+@app.route('/admin/cache', methods=['GET'])
+@admin_required
+def list_cache():
+    """List this worker's cache entries (key, age, size, hits) and the shared snapshots.
+
+    Optional ``pattern`` filters keys with shell-style wildcards, e.g. ``stats:flights*``.
+    """
+    pattern = request.args.get('pattern', '*')
+    now = time.time()
+    entries = []
+    for prefix, cache, format_key, _ in _cache_stores():
+        for raw_key, entry in list(cache.items()):
+            name = f"{prefix}:{format_key(raw_key)}"
+            if not fnmatch.fnmatchcase(name, pattern):
+                continue
+            stored_at = _entry_time(entry)
+            entries.append({
+                'key': name,
+                'age_s': round(now - stored_at, 1) if stored_at else None,
+                'size_bytes': len(entry['encoded']['body']) if isinstance(entry, dict) and 'encoded' in entry
+                else len(pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)),
+                'hits': _cache_hits.get(name, 0),
+                'version': entry.get('version') if isinstance(entry, dict) else None
+            })
+
+    snapshots = []
+    for key, size, version, captured_at, stale_since in _snapshot_db().execute(
+            "SELECT key, length(data), version, captured_at, stale_since FROM snapshots ORDER BY key"):
+        if fnmatch.fnmatchcase(f"snapshot:{key}", pattern):
+            snapshots.append({
+                'key': f"snapshot:{key}",
+                'age_s': round(now - captured_at, 1),
+                'size_bytes': size,
+                'version': version,
+                'stale_since': _format_timestamp(stale_since)
+            })
+
+    recent = _cache_admin_db().execute(
+        "SELECT id, dataset, pattern, created_at, requested_by FROM invalidations ORDER BY id DESC LIMIT 20"
+    ).fetchall()
+    return jsonify({
+        'worker_pid': os.getpid(),
+        'entries': sorted(entries, key=lambda entry: entry['key']),
+        'snapshots': snapshots,
+        'invalidations': [
+            {'id': row[0], 'dataset': row[1], 'pattern': row[2], 'created_at': _format_timestamp(row[3]),
+             'requested_by': row[4]}
+            for row in recent
+        ]
+    })
+
+
+@app.route('/admin/cache/invalidate', methods=['POST'])
+@admin_required
+def invalidate_cache():
+    """Invalidate caches in every worker.
+
+    Body: one of ``dashboard`` (a dataset name or 'all'), ``table`` (a synced
+    table name) or ``pattern`` (wildcards over the listed keys; ``snapshot:*``
+    keys also delete the shared snapshots). Optional ``warm``: paths to request
+    afterwards, e.g. ["/api/flights/stats"].
+    """
+    data = request.json or {}
+    dataset = data.get('dashboard')
+    table = data.get('table')
+    pattern = data.get('pattern')
+
+    if table:
+        dataset = next((name for name, table_name in SYNCED_TABLES.items() if table_name == table), None)
+        if dataset is None:
+            return jsonify({'error': f'Unknown table: {table}'}), 400
+    if dataset and dataset != 'all' and dataset not in SYNCED_TABLES:
+        return jsonify({'error': f'Unknown dashboard: {dataset}'}), 400
+    if bool(dataset) == bool(pattern):
+        return jsonify({'error': 'Give exactly one of dashboard, table or pattern'}), 400
+
+    now = time.time()
+    db = _cache_admin_db()
+    invalidation_id = db.execute(
+        "INSERT INTO invalidations (dataset, pattern, created_at, requested_by) VALUES (?, ?, ?, ?)",
+        (dataset, pattern, now, _admin_user())
+    ).lastrowid
+
+    deleted_snapshots = 0
+    if pattern and pattern.startswith('snapshot:'):
+        keys = [row[0] for row in _snapshot_db().execute("SELECT key FROM snapshots")
+                if fnmatch.fnmatchcase(f"snapshot:{row[0]}", pattern)]
+        for key in keys:
+            _snapshot_db().execute("DELETE FROM snapshots WHERE key = ?", (key,))
+        deleted_snapshots = len(keys)
+
+    # Apply here right away; the other workers pick it up from the log
+    apply_cache_invalidations(force=True)
+    print(f"DEBUG: Cache invalidation {invalidation_id} ({dataset or pattern}) requested by {_admin_user()}")
+
+    return jsonify({
+        'invalidation_id': invalidation_id,
+        'dashboard': dataset,
+        'pattern': pattern,
+        'deleted_snapshots': deleted_snapshots,
+        'propagates_within_s': CACHE_INVALIDATION_POLL_INTERVAL,
+        'warmed': _warm_paths(data.get('warm') or [])
+    })
+
+
+@app.route('/admin/cache/warm', methods=['POST'])
+@admin_required
+def warm_cache():
+    """Fill caches now by requesting the given paths. Body: {"paths": ["/api/flights/stats", ...]}"""
+    paths = (request.json or {}).get('paths')
+    if not isinstance(paths, list) or not paths:
+        return jsonify({'error': 'paths must be a non-empty list'}), 400
+    return jsonify({'worker_pid': os.getpid(), 'warmed': _warm_paths(paths)})
+
+_startup_profile['module_load_ms'] = round((time.perf_counter() - _BOOT_STARTED) * 1000, 1)
+print(f"INFO: App module loaded in {_startup_profile['module_load_ms']}ms (pid {os.getpid()}): {_startup_profile}")
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=False)
@@ -114,7 +114,10 @@ async function handleMessage(message) {
         }
 
         // Check if there's an error in the response
-        if (data.error) {
+        if (response.status === 429) {
+            // Rate limited: the message says how long to wait
+            addMessage(data.error, 'bot');
+        } else if (data.error) {
             console.error('Backend error:', data.error);
             console.error('Error details:', data.details);
             addMessage(`Error: ${data.error}\n\nDetails: ${data.details || 'No additional details'}`, 'bot');
@@ -0,0 +1,258 @@
+// Shared dashboard helpers
+
+// Fetch a data endpoint, waiting out a cold SQL warehouse.
+// The API answers 202 {status: 'starting', status_url, retry_after} while the
+// warehouse boots; poll the status URL until it is ready, then retry the request.
+// Gives up (throwing) if the warehouse fails to start or is deleted, if the status
+// URL keeps failing, or after WAREHOUSE_START_MAX_WAIT_MS.
+const WAREHOUSE_START_MAX_WAIT_MS = 10 * 60 * 1000;
+const WAREHOUSE_STATUS_MAX_ERRORS = 5;
+
+async function fetchWhenReady(url, options = {}, onWaiting = null) {
+    const startedAt = Date.now();
+    while (true) {
+        const response = await fetch(url, options);
+        if (response.status !== 202) {
+            return response;
+        }
+
+        const pending = await response.json();
+        console.log('Warehouse starting, waiting:', pending);
+        if (onWaiting) {
+            onWaiting(pending);
+        } else {
+            showWarehouseStarting(pending.message);
+        }
+
+        const interval = (pending.retry_after || 5) * 1000;
+        let statusErrors = 0;
+        while (true) {
+            if (Date.now() - startedAt > WAREHOUSE_START_MAX_WAIT_MS) {
+                throw warehouseStartFailed('The SQL warehouse did not start in time. Please try again later.');
+            }
+            await new Promise(resolve => setTimeout(resolve, interval));
+            try {
+                const statusResponse = await fetch(pending.status_url);
+                const status = await statusResponse.json();
+                if (!statusResponse.ok) {
+                    throw new Error(status.error || `HTTP ${statusResponse.status}`);
+                }
+                if (status.ready) {
+                    break;
+                }
+                if (status.failed) {
+                    throw warehouseStartFailed(`The SQL warehouse cannot start (${status.error || status.state}).`);
+                }
+                statusErrors = 0;
+            } catch (error) {
+                if (error.warehouseStartFailed) {
+                    throw error;
+                }
+                console.error('Warehouse status check failed:', error);
+                statusErrors += 1;
+                if (statusErrors >= WAREHOUSE_STATUS_MAX_ERRORS) {
+                    throw warehouseStartFailed(`Could not check the SQL warehouse status: ${error.message}`);
+                }
+            }
+        }
+        hideWarehouseStarting();
+    }
+}
+
+function warehouseStartFailed(message) {
+    showWarehouseStarting(message);
+    document.getElementById('warehouse-starting-banner').classList.add('warehouse-start-failed');
+    const error = new Error(message);
+    error.warehouseStartFailed = true;
+    return error;
+}
+
+function showWarehouseStarting(message) {
+    let banner = document.getElementById('warehouse-starting-banner');
+    if (!banner) {
+        banner = document.createElement('div');
+        banner.id = 'warehouse-starting-banner';
+        banner.className = 'warehouse-starting-banner';
+        const content = document.querySelector('.dashboard-content') || document.body;
+        content.prepend(banner);
+    }
+    banner.textContent = message || 'The SQL warehouse is starting. Data will load automatically once it is ready.';
+}
+
+function hideWarehouseStarting() {
+    const banner = document.getElementById('warehouse-starting-banner');
+    if (banner) {
+        banner.remove();
+    }
+}
+
+// Flag stats served from the last successful snapshot after a failed refresh
+function showStaleNotice(data) {
+    if (!data || !data.stale_since) {
+        return;
+    }
+    const notice = document.createElement('div');
+    notice.className = 'warehouse-starting-banner stale-data-notice';
+    notice.textContent = 'Showing data from ' + new Date(data.snapshot_at).toLocaleString() +
+        '; refreshing has failed since ' + new Date(data.stale_since).toLocaleString() + '.';
+    const content = document.querySelector('.dashboard-content') || document.body;
+    content.querySelectorAll('.stale-data-notice').forEach(el => el.remove());
+    content.prepend(notice);
+}
+
+// Resolve with a job (from POST /api/jobs or a progressive response) once it has finished.
+// Follows the job's server-sent events, falling back to polling its status URL.
+async function waitForJob(job) {
+    const terminal = ['SUCCEEDED', 'FAILED', 'CANCELED'];
+    while (!terminal.includes(job.state)) {
+        job = await waitForJobUpdate(job);
+    }
+    return job;
+}
+
+function fetchJob(statusUrl) {
+    return fetch(statusUrl)
+        .then(response => response.json().then(body => response.ok ? body : { state: 'FAILED', error: body.error }))
+        .catch(error => ({ state: 'FAILED', error: error.message }));
+}
+
+function waitForJobUpdate(job) {
+    return new Promise(resolve => {
+        if (!window.EventSource) {
+            setTimeout(() => fetchJob(job.status_url).then(resolve), 1000);
+            return;
+        }
+        const events = new EventSource(job.events_url);
+        events.addEventListener('done', event => {
+            events.close();
+            resolve(JSON.parse(event.data));
+        });
+        events.addEventListener('error', event => {
+            // Stream closed (it is capped server-side) or failed: re-check the job
+            events.close();
+            if (event.data) {
+                resolve({ state: 'FAILED', error: JSON.parse(event.data).error });
+            } else {
+                fetchJob(job.status_url).then(resolve);
+            }
+        });
+    });
+}
+
+// ---------------------------------------------------------------------------
+// Versioned stats cache
+// ---------------------------------------------------------------------------
+// Stats payloads are kept in IndexedDB, tagged with the dataset version from
+// /api/version. Dashboards render the local copy immediately, then refetch only
+// if the server's version has moved on (or is unknown). If the backend is
+// unreachable the local copy stays on screen.
+
+const STATS_DB_NAME = 'intelligence-hub';
+const STATS_STORE = 'stats';
+
+function openStatsDb() {
+    return new Promise((resolve, reject) => {
+        if (!window.indexedDB) {
+            reject(new Error('IndexedDB unavailable'));
+            return;
+        }
+        const open = indexedDB.open(STATS_DB_NAME, 1);
+        open.onupgradeneeded = () => open.result.createObjectStore(STATS_STORE);
+        open.onsuccess = () => resolve(open.result);
+        open.onerror = () => reject(open.error);
+    });
+}
+
+async function statsCacheGet(key) {
+    try {
+        const db = await openStatsDb();
+        return await new Promise((resolve, reject) => {
+            const get = db.transaction(STATS_STORE).objectStore(STATS_STORE).get(key);
+            get.onsuccess = () => resolve(get.result || null);
+            get.onerror = () => reject(get.error);
+        });
+    } catch (error) {
+        console.warn('Stats cache read failed:', error);
+        return null;
+    }
+}
+
+async function statsCachePut(key, entry) {
+    try {
+        const db = await openStatsDb();
+        await new Promise((resolve, reject) => {
+            const tx = db.transaction(STATS_STORE, 'readwrite');
+            tx.objectStore(STATS_STORE).put(entry, key);
+            tx.oncomplete = resolve;
+            tx.onerror = () => reject(tx.error);
+        });
+    } catch (error) {
+        console.warn('Stats cache write failed:', error);
+    }
+}
+
+function destroyCharts() {
+    if (typeof Chart === 'undefined') {
+        return;
+    }
+    document.querySelectorAll('canvas').forEach(canvas => {
+        const chart = Chart.getChart(canvas);
+        if (chart) {
+            chart.destroy();
+        }
+    });
+}
+
+// Render a dashboard's stats from the local cache, then revalidate against /api/version
+async function loadDashboardStats(dataset, url, render) {
+    const cached = await statsCacheGet(url);
+    if (cached) {
+        console.log('Rendering cached stats:', url, cached.version);
+        await render(cached.data);
+    }
+
+    let version = null;
+    let appVersion = null;
+    try {
+        const versions = await (await fetch('/api/version')).json();
+        version = versions.datasets[dataset] || null;
+        appVersion = versions.app_version;
+        if (cached && version !== null && cached.version === version && cached.appVersion === appVersion) {
+            return;
+        }
+    } catch (error) {
+        if (cached) {
+            console.warn('Version check failed, keeping cached stats:', error);
+            return;
+        }
+    }
+
+    try {
+        const response = await fetchWhenReady(url);
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || `HTTP ${response.status}`);
+        }
+        // Snapshot fallbacks are not cached: the next visit should try for fresh data
+        if (!data.stale_since && version !== null) {
+            await statsCachePut(url, { version: version, appVersion: appVersion, data: data, storedAt: Date.now() });
+        }
+        if (cached) {
+            // Let charts queued by the cached render draw first, then replace them
+            await new Promise(resolve => requestAnimationFrame(resolve));
+            destroyCharts();
+        }
+        await render(data);
+    } catch (error) {
+        if (!cached) {
+            throw error;
+        }
+        console.warn('Stats refresh failed, keeping cached stats:', error);
+    }
+}
+
+if ('serviceWorker' in navigator) {
+    window.addEventListener('load', () => {
+        navigator.serviceWorker.register('/sw.js').catch(error => console.warn('Service worker registration failed:', error));
+    });
+}
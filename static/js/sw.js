@@ -0,0 +1,97 @@
+// Service worker for the Intelligence Hub dashboards.
+// - Chart.js from the CDN is versioned in its URL, so it is served cache-first.
+// - Static assets are served from cache and refreshed in the background.
+// - Pages are network-first with a cached fallback, so dashboards still open
+//   while the backend is briefly unavailable.
+// API responses are not cached here; stats live in IndexedDB (see dashboard.js).
+
+const CACHE_NAME = 'intelligence-hub-v1';
+const PRECACHE_URLS = [
+    'https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js',
+    '/static/css/dashboard.css',
+    '/static/js/dashboard.js',
+    '/static/images/skyscanner_logo.png'
+];
+
+self.addEventListener('install', event => {
+    event.waitUntil(
+        caches.open(CACHE_NAME)
+            .then(cache => Promise.all(PRECACHE_URLS.map(url =>
+                cache.add(new Request(url, { mode: url.startsWith('http') ? 'no-cors' : 'same-origin' }))
+                    .catch(error => console.warn('Precache failed for', url, error))
+            )))
+            .then(() => self.skipWaiting())
+    );
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(
+        caches.keys()
+            .then(names => Promise.all(names.filter(name => name !== CACHE_NAME).map(name => caches.delete(name))))
+            .then(() => self.clients.claim())
+    );
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    if (request.method !== 'GET') {
+        return;
+    }
+
+    const url = new URL(request.url);
+    if (url.origin === self.location.origin && url.pathname.startsWith('/api/')) {
+        return;
+    }
+
+    if (url.hostname === 'cdn.jsdelivr.net') {
+        event.respondWith(cacheFirst(request));
+    } else if (url.origin === self.location.origin && url.pathname.startsWith('/static/')) {
+        event.respondWith(staleWhileRevalidate(request, event));
+    } else if (request.mode === 'navigate') {
+        event.respondWith(networkFirst(request));
+    }
+});
+
+async function cacheFirst(request) {
+    const cached = await caches.match(request);
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(request);
+    const cache = await caches.open(CACHE_NAME);
+    cache.put(request, response.clone());
+    return response;
+}
+
+async function staleWhileRevalidate(request, event) {
+    const cache = await caches.open(CACHE_NAME);
+    const cached = await cache.match(request);
+    const refresh = fetch(request).then(response => {
+        if (response.ok) {
+            cache.put(request, response.clone());
+        }
+        return response;
+    });
+    if (cached) {
+        event.waitUntil(refresh.catch(() => {}));
+        return cached;
+    }
+    return refresh;
+}
+
+async function networkFirst(request) {
+    const cache = await caches.open(CACHE_NAME);
+    try {
+        const response = await fetch(request);
+        if (response.ok) {
+            cache.put(request, response.clone());
+        }
+        return response;
+    } catch (error) {
+        const cached = await cache.match(request);
+        if (cached) {
+            return cached;
+        }
+        throw error;
+    }
+}